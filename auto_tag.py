@@ -29,173 +29,488 @@
 
 
 from __future__ import with_statement
+import collections
 import hashlib
+import itertools
 import logging
 import operator
+import os
 import re
+import urlparse
 
 import packages
 from beautifulsoup.BeautifulSoup import BeautifulSoup
 from beautifulsoup.BeautifulSoup import Comment
+from beautifulsoup.BeautifulSoup import Declaration
+from beautifulsoup.BeautifulSoup import NavigableString
+from beautifulsoup.BeautifulSoup import ProcessingInstruction
 from beautifulsoup.BeautifulSoup import SGMLParseError
-from nltk.stem.porter import PorterStemmer
+from beautifulsoup.BeautifulSoup import UnicodeDammit
 
 from config import STOP_WORDS, FETCH_BAD_TAGS, FETCH_GOOD_TAGS, FETCH_MIN_COUNT
+from config import FETCH_EXTRACTOR, FETCH_MAX_WORDS
+from config import TOKENIZE_CACHE_CHARS, TOKENIZE_CACHE_SECS
+import extract
 import fetch
+import lru
+import stemmer
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    # We're not running on Google App Engine (or with its SDK), so we can only
+    # remember pages' words in this process.
+    memcache = None
 
 
 _log = logging.getLogger(__name__)
+_stop_words_cache = {}
+# A page's words can run to FETCH_MAX_WORDS, so bound how many characters of
+# titles and words we remember, not how many pages.
+_tokens_cache = lru.LRUCache(TOKENIZE_CACHE_CHARS, sizeof=lambda tokens:
+                             len(tokens[0] or u'') + len(tokens[1]))
+
+# A word is a run of letters, digits, apostrophes, and HTML entities.  ([^\W_]
+# is a letter or a digit.  Byte strings' apostrophes are only ASCII.)
+_ENTITY = re.compile(r'&#?[A-Za-z0-9]+?;')
+_WORD = re.compile(r"(?:[^\W_]|'|&#?[A-Za-z0-9]+?;)+")
+_UNICODE_WORD = re.compile(ur"(?:[^\W_]|['\u2019]|&#?[A-Za-z0-9]+?;)+",
+                           re.UNICODE)
+_UNICODE_APOSTROPHES = {ord(u"'"): None, ord(u'\u2019'): None}
+
+# Byte order marks (longest first), and where HTML declares its encoding:
+_BOMS = (('\x00\x00\xfe\xff', 'utf-32-be'), ('\xff\xfe\x00\x00', 'utf-32-le'),
+         ('\xef\xbb\xbf', 'utf-8'), ('\xfe\xff', 'utf-16-be'),
+         ('\xff\xfe', 'utf-16-le'))
+_META_CHARSET = re.compile(r'''<meta[^>]+charset\s*=\s*["']?([-\w.:]+)''',
+                           re.IGNORECASE)
+_META_CHARSET_BYTES = 1024      # The <meta> tag must be in the first 1 KB.
+
+# Where HTML declares its canonical URL (<link rel="canonical" href="...">):
+_LINK = re.compile(r'<link\b([^>]*)>', re.IGNORECASE)
+_ATTRIBUTE = re.compile(
+    r'''([-\w]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+_HEAD_END = re.compile(r'</head\s*>|<body\b', re.IGNORECASE)
+_CANONICAL_BYTES = 64 * 1024    # The <link> tag must be in the first 64 KB.
+
+
+def tokenize_url(url, max_words=FETCH_MAX_WORDS, validators=(None, None),
+                 html_hash=None):
+    """Parse web content into a URL, MIME type, title, word list, and hash.
 
+    The URL is where we ended up after following redirects, or the canonical
+    URL that the page declares (see _canonical_url).  Also return whether we
+    truncated the content, either when we fetched it (see
+    fetch.FETCH_MAX_BYTES) or when we tokenized it (to max_words), and the
+    content's validators (its ETag and Last-Modified headers).
 
-def tokenize_url(url):
-    """Parse web content into a URL, MIME type, title, word list, and hash.
+    If we're passed the validators and the hash from when we last tokenized
+    the URL, then we ask the server for the content only if it's changed since.
+    If it hasn't, then we don't tokenize it again:  we return the same hash
+    (so that the caller knows that nothing's changed), and None for the title
+    and the words.
 
     Example usage:
         >>> url = 'http://www.gutenberg.org/files/11/11-h/11-h.htm'
-        >>> url, mime_type, title, words, hash = tokenize_url(url)
+        >>> url, mime_type, title, words, hash, truncated, validators = \\
+        ...     tokenize_url(url)
         >>> title
         u"\\r\\n    Alice's Adventures in Wonderland,\\r\\n    by Lewis Carroll\\r\\n"
+        >>> truncated
+        False
+        >>> tokenize_url(url, validators=validators, html_hash=hash)[2:5]
+        (None, None, 'ac408a71dc1b903424a03b9d494d3914')
     """
     _log.debug('tokenizing %s' % url)
-    url, status_code, mime_type, content = fetch.Factory()(url)
-    if content is None:
+    fetcher = fetch.Factory()
+    etag, last_modified = validators if html_hash is not None else (None, None)
+    url, status_code, mime_type, content = fetcher(
+        url, etag=etag, last_modified=last_modified)
+    return _tokenize_fetched(fetcher, url, mime_type, content, max_words,
+                             html_hash)
+
+
+def tokenize_urls(urls, max_words=FETCH_MAX_WORDS):
+    """Fetch and tokenize many URLs at once.  Generate results as they come.
+
+    For each URL, generate the URL as specified and what tokenize_url would
+    have returned for it, in the order that we finish fetching them (see
+    fetch.fetch_many).  Unlike tokenize_url, always fetch unconditionally.
+    """
+    for requested_url, fetcher, (url, status_code, mime_type, content) in \
+            fetch.Factory().fetch_many(urls):
+        yield requested_url, _tokenize_fetched(fetcher, url, mime_type,
+                                               content, max_words)
+
+
+def _tokenize_fetched(fetcher, url, mime_type, content, max_words,
+                      html_hash=None):
+    """Tokenize content that we've fetched (see tokenize_url)."""
+    validators = fetcher.etag, fetcher.last_modified
+    if fetcher.not_modified:
+        _log.debug("not tokenizing %s (hasn't changed since last)" % url)
+        title, words, hash, truncated = None, None, html_hash, False
+    elif content is None:
         _log.warning("couldn't tokenize %s (couldn't fetch content)" % url)
-        title, words, hash = url, [], None
+        title, words, hash, truncated = url, [], None, False
     else:
-        title, words, hash = tokenize_html(content)
+        title, words, hash, truncated = tokenize_html(
+            content, max_words=max_words, charset=fetcher.charset)
         if (title, words, hash) == (None, None, None):
-            title, words, hash = url, [], None
+            title, words, hash, truncated = url, [], None, False
             _log.warning("couldn't tokenize %s (couldn't soupify HTML)" % url)
         else:
             if title is None:
                 title = url
+            truncated = truncated or fetcher.truncated
             _log.debug('tokenized %s' % url)
-    return url, mime_type, title, words, hash
+        url = _canonical_url(url, content)
+    return url, mime_type, title, words, hash, truncated, validators
 
 
-def tokenize_html(html):
+def _canonical_url(url, html):
+    """Return the canonical URL that an HTML page declares, or the page's URL.
+
+    Only believe a <link rel="canonical"> in the page's <head> that stays on
+    the page's site (a page can't speak for another site), and that doesn't
+    point a page deep in the site to the site's home page (a common
+    misconfiguration).
+
+    Example usage:
+        >>> html = '<head><link href="/a?b=1&amp;c=2" rel="Canonical"></head>'
+        >>> _canonical_url('http://www.google.com/a?c=2&b=1&utm=x', html)
+        'http://www.google.com/a?b=1&c=2'
+        >>> _canonical_url('http://google.com/a', '<link rel=canonical href=/>')
+        'http://google.com/a'
+        >>> _canonical_url('http://google.com/a',
+        ...                '<link rel=canonical href=http://yahoo.com/a>')
+        'http://google.com/a'
+        >>> _canonical_url('http://google.com/a', '<body><p>No link</p></body>')
+        'http://google.com/a'
+    """
+    if not isinstance(html, str):
+        return url
+    match = _HEAD_END.search(html, 0, _CANONICAL_BYTES)
+    end = match.start() if match else _CANONICAL_BYTES
+    for link in _LINK.finditer(html, 0, end):
+        attributes = {}
+        for match in _ATTRIBUTE.finditer(link.group(1)):
+            value = match.group(2) or match.group(3) or match.group(4) or ''
+            attributes[match.group(1).lower()] = value.strip()
+        if 'canonical' in attributes.get('rel', '').lower().split():
+            break
+    else:
+        return url
+    href = attributes.get('href', '').replace('&amp;', '&')
+    canonical = fetch.Factory().normalize(urlparse.urljoin(url, href))
+    if canonical is None or canonical == url:
+        return url
+    old, new = urlparse.urlsplit(url), urlparse.urlsplit(canonical)
+    if _site(old[1]) != _site(new[1]):
+        _log.debug('not believing canonical URL %s for %s (another site)' %
+                   (canonical, url))
+        return url
+    if new[2] == '/' and not new[3] and old[2] != '/':
+        _log.debug('not believing canonical URL %s for %s (home page)' %
+                   (canonical, url))
+        return url
+    _log.debug('canonical URL for %s is %s' % (url, canonical))
+    return canonical
+
+
+def _site(host):
+    """Return the site that a host belongs to (ignoring www.)."""
+    return host[4:] if host.startswith('www.') else host
+
+
+def tokenize_html(html, extractor=FETCH_EXTRACTOR, max_words=None,
+                  charset=None):
     """Parse an HTML document into a title, word list, and hash.
 
+    The extractor is either 'fast' (extract.py) or 'soup' (BeautifulSoup).  If
+    max_words isn't None, then keep only the document's first max_words words.
+    Also return whether we dropped any words.  The charset, if specified, is
+    the encoding that the HTTP Content-Type header declared (see _decode).
+
+    The same content always produces the same title and words, so we hash the
+    content first, and remember each hash's title and words (in this process,
+    and in memcache).  That way, when a page hasn't changed since we last
+    fetched it, or when two URLs serve the same page, we only parse it once.
+
     Example usage:
         >>> url = 'http://www.gutenberg.org/files/11/11-h/11-h.htm'
         >>> url, status_code, mime_type, content = fetch.Factory()(url)
-        >>> title, words, hash = tokenize_html(content)
+        >>> title, words, hash, truncated = tokenize_html(content)
         >>> title
         u"\\r\\n    Alice's Adventures in Wonderland,\\r\\n    by Lewis Carroll\\r\\n"
         >>> words[:4]
         [u'alices', u'adventures', u'in', u'wonderland']
         >>> hash
         'ac408a71dc1b903424a03b9d494d3914'
+        >>> tokenize_html('<p>One two three</p>', max_words=2)[1:]
+        ([u'one', u'two'], 'c32e2baf468d123a7fdd5322504054de', True)
+    """
+    try:
+        hash = html.encode('utf-8') if isinstance(html, unicode) else html
+        hash = hashlib.md5(hash).hexdigest()
+    except (AttributeError, TypeError), e:
+        title, words, hash, truncated = None, None, None, False
+    else:
+        key = 'tokens_%s_%s_%s_%s' % (hash, extractor, max_words, charset)
+        tokens = _get_tokens(key)
+        if tokens is None:
+            tokens = _tokenize_html(html, extractor, max_words, charset)
+            if tokens is not None:
+                _set_tokens(key, tokens)
+        if tokens is None:
+            title, words, hash, truncated = None, None, None, False
+        else:
+            title, words, truncated = tokens
+            words = words.split(u' ') if words else []
+    return title, words, hash, truncated
+
+
+def _tokenize_html(html, extractor, max_words, charset):
+    """Parse an HTML document into a title, words, and whether we dropped any.
+
+    Return the words as one space separated string (so that they're compact
+    to cache), or return None if we couldn't parse the document.
     """
+    truncated = False
     try:
-        convert_entities = BeautifulSoup.ALL_ENTITIES
-        soup = BeautifulSoup(html, convertEntities=convert_entities)
+        markup = _decode(html, charset)
+        if markup is None:
+            raise TypeError("couldn't decode HTML")
+        title, text = _EXTRACTORS[extractor](markup)
     except (SGMLParseError, TypeError), e:
-        title, words, hash = None, None, None
+        tokens = None
     else:
-        soup = _remove_garbage(soup)
-        title = _extract_title(soup)
-        words = _extract_words_from_soup(soup)
-        hash = hashlib.md5(html).hexdigest()
-    return title, words, hash
+        if title is None:
+            _log.warning("couldn't extract title (not HTML, invalid markup, " +
+                         "or no title specified?)")
+        if max_words is None:
+            words = extract_words_from_string(text)
+        else:
+            words = list(itertools.islice(iter_words(text), max_words + 1))
+            if len(words) > max_words:
+                words, truncated = words[:max_words], True
+        tokens = title, u' '.join(words), truncated
+    return tokens
+
+
+def _get_tokens(key):
+    """Return a page's cached title, words, and truncation (or None)."""
+    tokens = _tokens_cache.get(key)
+    if tokens is None and memcache is not None:
+        tokens = memcache.get(key)
+        if tokens is not None:
+            _tokens_cache[key] = tokens
+    if tokens is not None:
+        _log.debug('remembered tokens %s' % key)
+    return tokens
+
+
+def _set_tokens(key, tokens):
+    """Cache a page's title, words, and truncation."""
+    _tokens_cache[key] = tokens
+    if memcache is not None:
+        try:
+            success = memcache.set(key, tokens, time=TOKENIZE_CACHE_SECS)
+        except (MemoryError, ValueError):
+            # The page's words are too big for memcache.
+            success = False
+        if not success:
+            _log.debug("couldn't memcache tokens %s" % key)
 
 
-def _remove_garbage(soup, uninteresting_tags=FETCH_BAD_TAGS):
-    """Given soup, strip out garbage that wouldn't help us auto-tag."""
+def _decode(html, charset=None):
+    """Given HTML, decode it into unicode.  Return None if we can't.
 
-    def remove_tags(soup, tag_names):
-        """Given soup, strip out all of the tags with the specified names."""
-        for tag_name in tag_names:
-            [tag.extract() for tag in soup.findAll(tag_name)]
-        return soup
+    First, try the encoding that the HTML's byte order mark, the HTTP
+    Content-Type header (charset), or the HTML's <meta> tag declares, in that
+    order.  Usually, one of those is right, and decodes the HTML on the first
+    try.  Only if none of them work do we fall back on UnicodeDammit, which
+    guesses the encoding (trying encoding after encoding) the same way that
+    BeautifulSoup does.
 
-    soup = remove_tags(soup, uninteresting_tags)
-    comments = soup.findAll(text=lambda text:isinstance(text, Comment))
-    [comment.extract() for comment in comments]
-    return soup
+    Example usage:
+        >>> _decode('\xef\xbb\xbfcaf\xc3\xa9'), _decode('caf\xe9', 'latin-1')
+        (u'caf\\xe9', u'caf\\xe9')
+        >>> _decode('<meta charset="utf-8">caf\xc3\xa9', 'ascii')
+        u'<meta charset="utf-8">caf\\xe9'
+    """
+    if isinstance(html, unicode):
+        return html
+    if not isinstance(html, str):
+        raise TypeError('expected HTML as a string, got %r' % type(html))
+    encodings = [(encoding, len(bom)) for bom, encoding in _BOMS
+                 if html.startswith(bom)][:1]
+    match = _META_CHARSET.search(html, 0, _META_CHARSET_BYTES)
+    meta_charset = match.group(1) if match else None
+    if meta_charset and meta_charset.lower().startswith(('utf-16', 'utf-32')):
+        # We just read the <meta> tag as ASCII, so the HTML can't really be
+        # UTF-16 or UTF-32.  (Browsers assume UTF-8, so we do too.)
+        meta_charset = 'utf-8'
+    for encoding in (charset, meta_charset):
+        if encoding:
+            encoding = encoding.strip().lower()
+            encoding = UnicodeDammit.CHARSET_ALIASES.get(encoding, encoding)
+            encodings.append((encoding, 0))
+    for encoding, start in encodings:
+        try:
+            return html[start:].decode(encoding)
+        except (LookupError, UnicodeError):
+            pass
+    _log.debug("couldn't decode HTML as %s, guessing encoding" %
+               ', '.join([encoding for encoding, start in encodings]))
+    return UnicodeDammit(html, smartQuotesTo=None, isHTML=True).unicode
 
 
-def _extract_title(soup):
-    """Given soup, return its title if specified."""
-    _log.debug('extracting title')
-    try:
-        title = unicode(soup.findAll('title')[0].contents[0])
-    except IndexError:
-        _log.warning("couldn't extract title (not HTML, invalid markup, or " +
-                     "no title specified?)")
-    else:
-        _log.debug('extracted title')
-        return title
+def _extract_with_soup(markup):
+    """Given markup, soupify it, then return its title and interesting text."""
+    convert_entities = BeautifulSoup.ALL_ENTITIES
+    soup = BeautifulSoup(markup, convertEntities=convert_entities)
+    return _walk_soup(soup)
+
+
+_EXTRACTORS = {'fast': extract.extract, 'soup': _extract_with_soup}
+
 
+def _walk_soup(soup, interesting_tags=FETCH_GOOD_TAGS,
+               uninteresting_tags=FETCH_BAD_TAGS):
+    """Given soup, return its title (if specified) and its interesting text.
 
-def _extract_words_from_soup(soup, interesting_tags=FETCH_GOOD_TAGS):
-    """Given soup, return a list of all of its words."""
-    tags = soup.findAll(interesting_tags)
-    html = [str(tag) for tag in tags]
-    html = ' '.join(html)
-    if html:
-        soup = BeautifulSoup(html)
-    words = soup.findAll(text=True)
-    words = ' '.join(words)
-    return extract_words_from_string(words)
+    We walk the tree once, depth first, and never modify it.  We skip the
+    uninteresting tags' subtrees, comments, and declarations.  The interesting
+    text is the text under the interesting tags, each piece once, even if the
+    interesting tags are nested.  If the soup has no interesting tags at all,
+    then all of its text is interesting.
+
+    Example usage:
+        >>> html = '<html><head><title>Hi</title><style>p {}</style></head>'
+        >>> html += '<body><p>One <b>two</b></p><!-- three --><ul><li>four'
+        >>> html += '</li></ul><blockquote><p>five</p></blockquote></body>'
+        >>> title, text = _walk_soup(BeautifulSoup(html))
+        >>> title, text.split()
+        (u'Hi', [u'Hi', u'One', u'two', u'five'])
+        >>> _walk_soup(BeautifulSoup('<div>One <script>two</script></div>'))
+        (None, u'One ')
+    """
+    title, interesting, everything = None, [], []
+    found_interesting_tag = False
+    stack = [(iter(soup.contents), False)]
+    while stack:
+        children, inside_interesting_tag = stack[-1]
+        try:
+            child = children.next()
+        except StopIteration:
+            stack.pop()
+            continue
+        if isinstance(child, NavigableString):
+            if not isinstance(child, (Comment, Declaration,
+                                      ProcessingInstruction)):
+                everything.append(child)
+                if inside_interesting_tag:
+                    interesting.append(child)
+        elif child.name not in uninteresting_tags:
+            if child.name == 'title' and title is None and child.contents:
+                title = unicode(child.contents[0])
+            if child.name in interesting_tags:
+                found_interesting_tag = True
+                inside_interesting_tag = True
+            stack.append((iter(child.contents), inside_interesting_tag))
+    text = interesting if found_interesting_tag else everything
+    return title, u' '.join(text)
 
 
 def extract_words_from_string(words):
     """Given a string, return a list of all of its words."""
+    return list(iter_words(words))
+
+
+def iter_words(s):
+    """Given a string, lazily yield its words.
 
-    def remove_html_entities(s):
-        """Remove a string's HTML entities."""
-        return re.sub(r'&#?[A-Za-z0-9]+?;', '', s)
-
-    def nonbreaking_char(c):
-        """If the specified character shouldn't break a word, return True."""
-        nonbreaking_chars = ('\'', u'\u2019',)
-        return c.isalnum() or c in nonbreaking_chars
-
-    def remove_extra_spaces(s):
-        """Remove a string's extra spaces."""
-        def remove_dupe_spaces(s1):
-            """Consolidate all space-only sub-strings into single spaces."""
-            s2 = s1.replace('  ', ' ')
-            return s2 if s2 == s1 else remove_dupe_spaces(s2)
-        return remove_dupe_spaces(s.strip())
-
-    words = remove_html_entities(words)
-    words = [(c.lower() if c.isalnum() else '' if nonbreaking_char(c) else ' ')
-             for c in words]
-    words = ''.join(words)
-    words = remove_extra_spaces(words)
-    words = words.split()
-    words = [word for word in words if not word.isdigit()]
-    return words
+    A word is a run of letters and digits, lower cased.  Apostrophes and HTML
+    entities don't break words - they just disappear - and runs of only digits
+    aren't words.  We find the runs with one regular expression, so we never
+    build more than one word at a time, even for a multi-megabyte page.
+
+    Example usage:
+        >>> list(iter_words("Don't  panic &mdash; it's 42, Ar&shy;thur!"))
+        ['dont', 'panic', 'its', 'arthur']
+    """
+    unicode_string = isinstance(s, unicode)
+    pattern = _UNICODE_WORD if unicode_string else _WORD
+    for match in pattern.finditer(s):
+        word = match.group()
+        if '&' in word:
+            word = _ENTITY.sub('', word)
+        if unicode_string:
+            word = word.translate(_UNICODE_APOSTROPHES)
+        else:
+            word = word.replace("'", '')
+        word = word.lower()
+        if word and not word.isdigit():
+            yield word
 
 
 def read_stop_words(filename=STOP_WORDS):
-    """Read the stop words - words that are too common to be useful as tags."""
+    """Read the stop words - words that are too common to be useful as tags.
+
+    Return a frozenset of the stop words and the file's hash.  Indexing and
+    every search (even every live search keystroke) need the stop words, so
+    we read the file once per process, and only read it again if it's been
+    modified since.
+    """
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        mtime = None
+    cached = _stop_words_cache.get(filename)
+    if mtime is not None and cached is not None and cached[0] == mtime:
+        return cached[1], cached[2]
     _log.debug('reading stop words %s' % filename)
-    stop_words, hash = [], None
+    stop_words, hash = frozenset(), None
     try:
         with open(filename) as file_obj:
-            for word in file_obj:
-                stop_words.append(word.strip())
-            file_obj.seek(0)
-            hash = hashlib.md5(file_obj.read()).hexdigest()
+            contents = file_obj.read()
     except IOError:
         _log.critical("couldn't read stop words %s (IOError)" % filename)
-    _log.debug('read stop words %s' % filename)
+    else:
+        stop_words = frozenset([word.strip() for word in
+                                contents.splitlines()])
+        hash = hashlib.md5(contents).hexdigest()
+        if mtime is not None:
+            _stop_words_cache[filename] = (mtime, stop_words, hash)
+        _log.debug('read stop words %s' % filename)
     return stop_words, hash
 
 
 def auto_tag(words, stop_words, min_count=FETCH_MIN_COUNT):
-    """Given lists of words and stop words, return a list of tags."""
+    """Given lists of words and stop words, return a list of tags.
+
+    Example usage:
+        >>> words = ['cat', 'dogs', 'the', 'cat', 'mice', 'cat', 'dogs', 'cat']
+        >>> tags = auto_tag(words, frozenset(['the']), min_count=0.5)
+        >>> [(tag['stem'], tag['word'], tag['count']) for tag in tags]
+        [('cat', 'cat', 1.0), ('dog', 'dogs', 0.5)]
+    """
     _log.debug('auto tagging')
 
-    # First, go through the word list, convert the words to stems, and make the
-    # stems into tags.
-    stemmer, tags, max_count = PorterStemmer(), {}, 0
+    # First, count each word's occurrences in one pass over the word list.
+    word_counts = collections.defaultdict(int)
+    for word in words:
+        word_counts[word] += 1
+
+    # Next, go through the distinct words, convert the words to stems, and make
+    # the stems into tags.  (When several words share a stem, the tag keeps the
+    # first word that we come across, so go through the words in set order, as
+    # we always have.)
+    tags, max_count = {}, 0
     for word in [word for word in set(words) if not word in stop_words]:
         tag = {'stem': stemmer.stem(word), 'word': word}
-        tag['count'] = float(words.count(word))
+        tag['count'] = float(word_counts[word])
         try:
             tags[tag['stem']]['count'] += tag['count']
         except KeyError:
@@ -205,7 +520,7 @@ def auto_tag(words, stop_words, min_count=FETCH_MIN_COUNT):
         if max_count < tags[tag['stem']]['count']:
             max_count = tags[tag['stem']]['count']
 
-    # Next, normalize the tags' counts such that they're all between 0 and 1.
+    # Then, normalize the tags' counts such that they're all between 0 and 1.
     # Also, strip out and throw away the insignificant tags.
     tmp, tags = tags.values(), []
     for tag in tmp:
@@ -0,0 +1,605 @@
+#------------------------------------------------------------------------------#
+#   benchmark.py                                                               #
+#                                                                              #
+#   Copyright (c) 2009-2010, Code A La Mode, original authors.                 #
+#                                                                              #
+#       This file is part of imi-imi.                                          #
+#                                                                              #
+#       imi-imi is free software; you can redistribute it and/or modify        #
+#       it under the terms of the GNU General Public License as published by   #
+#       the Free Software Foundation, either version 3 of the License, or      #
+#       (at your option) any later version.                                    #
+#                                                                              #
+#       imi-imi is distributed in the hope that it will be useful,             #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#       GNU General Public License for more details.                           #
+#                                                                              #
+#       You should have received a copy of the GNU General Public License      #
+#       along with imi-imi.  If not, see <http://www.gnu.org/licenses/>.       #
+#------------------------------------------------------------------------------#
+"""Time imi-imi's hot spots against the implementations that they replaced.
+
+Each benchmark runs the old way of doing something and the new way on the same
+made-up data, and prints how long each took per run.  Some benchmarks need the
+Google App Engine SDK (though not a datastore) in order to build model objects.
+"""
+
+
+import BaseHTTPServer
+import bisect
+import glob
+import hashlib
+import math
+import operator
+import optparse
+import os
+import random
+import re
+import SocketServer
+import sys
+import threading
+import timeit
+
+
+def main():
+    """Run the requested benchmarks (or all of them) and print the timings."""
+    parser = _config_parser()
+    names, number, base_dir = _parse_args(parser)
+    _import_modules(base_dir)
+    os.environ.setdefault('APPLICATION_ID', 'imi-imi')
+    for name in names:
+        before, after = _BENCHMARKS[name](number)
+        speedup = before / after if after else float('inf')
+        print '%-16s before: %10.3f ms    after: %10.3f ms    (%.1fx)' % (
+            name, before * 1000, after * 1000, speedup)
+
+
+def _config_parser():
+    """Configure the command-line argument parser."""
+    usage = '%prog [--number=100] '
+    usage += '[--base_dir=/usr/local/google_appengine] [benchmark ...]'
+    parser = optparse.OptionParser(description=__doc__, usage=usage)
+    parser.add_option('--number', dest='number', type='int', default=100,
+                      help='number of times to run each benchmark')
+    parser.add_option('--base_dir', dest='base_dir', default=_base_dir(),
+                      help='directory where Google App Engine SDK installed')
+    return parser
+
+
+def _base_dir():
+    """Return the default base (top-level) directory containing the GAE SDK."""
+    if sys.platform == 'win32':
+        base_dir = os.path.join('C:\\', 'Program Files', 'Google',
+                                'google_appengine')
+    else:
+        base_dir = os.path.join('/', 'usr', 'local', 'google_appengine')
+    return base_dir
+
+
+def _parse_args(parser):
+    """Parse the command-line arguments.
+
+    If the user asked for a benchmark that doesn't exist, then print usage
+    information and exit.
+    """
+    opts, args = parser.parse_args(sys.argv[1:])
+    names = args if args else sorted(_BENCHMARKS)
+    for name in names:
+        if not name in _BENCHMARKS:
+            parser.error('unknown benchmark %s (choose from: %s)' %
+                         (name, ', '.join(sorted(_BENCHMARKS))))
+    return names, opts.number, opts.base_dir
+
+
+def _import_modules(base_dir):
+    """Add the Google App Engine SDK directories to the Python path."""
+    google_app_engine_dirs = (
+        base_dir,
+        os.path.join(base_dir, 'lib', 'django'),
+        os.path.join(base_dir, 'lib', 'webob'),
+        os.path.join(base_dir, 'lib', 'yaml', 'lib'),
+    )
+    for dir in google_app_engine_dirs:
+        if os.path.isdir(dir) and not dir in sys.path:
+            sys.path.append(dir)
+
+
+def _time(function, number):
+    """Return how long, in seconds, a single call to function takes."""
+    return timeit.Timer(function).timeit(number=number) / number
+
+
+def _benchmark_tag_counts(number, num_matches=200, num_tags=60):
+    """Score a query's matches, then style a page's tags.
+
+    Before, we found each count by scanning a bookmark's stems or words list
+    (and counted the matched stems by intersecting sets).  After, we score by
+    scanning the stems list for just the query's few stems, and style a page's
+    tags by looking each count up in a dictionary built once per bookmark.
+    (Before, we also scored each bookmark once per comparison while sorting,
+    rather than once, but that's not what we're measuring here.)
+    """
+    from config import SEARCH_PER_PAGE
+    import filters
+    import models
+    import search
+
+    stems = ['stem%d' % index for index in range(num_tags)]
+    words = ['word%d' % index for index in range(num_tags)]
+    bookmarks = []
+    for index in range(num_matches):
+        counts = [((index + tag) % 8 + 1) / 8.0 for tag in range(num_tags)]
+        bookmarks.append(models.Bookmark(stems=stems, words=words,
+                                         counts=counts))
+    query_stems, page = stems[-3:], bookmarks[:SEARCH_PER_PAGE]
+    handler = search.RequestHandler()
+
+    def before():
+        for bookmark in bookmarks:
+            matched = len(set(query_stems) & set(bookmark.stems))
+            relevance = 0
+            for stem in query_stems:
+                try:
+                    index = bookmark.stems.index(stem)
+                except ValueError:
+                    count = 0
+                else:
+                    count = bookmark.counts[index]
+                relevance += count
+        for bookmark in page:
+            for word in bookmark.words:
+                try:
+                    index = bookmark.words.index(word)
+                except ValueError:
+                    count = 0
+                else:
+                    count = bookmark.counts[index]
+                value = str(int(math.ceil(8 * count) - 1))
+                style = 'size' + value + ' ' + 'color' + value
+
+    def after():
+        for bookmark in bookmarks:
+            # Pretend that we just loaded the bookmark from the datastore.
+            bookmark.__dict__.pop('_tag_counts_caches', None)
+            handler._score(query_stems, bookmark)
+        for bookmark in page:
+            for word in bookmark.words:
+                filters.style_tag(bookmark, word)
+
+    return _time(before, number), _time(after, number)
+
+
+def _benchmark_stop_words(number):
+    """Convert a live search query's words into stems.
+
+    Before, we re-read (and re-hashed) the stop words file for every query,
+    and looked each word up in a list.  After, we look each word up in a
+    frozenset cached per process.
+    """
+    import packages
+    from nltk.stem.porter import PorterStemmer
+    from config import STOP_WORDS
+    import search
+
+    query_words = ['how', 'to', 'make', 'the', 'best', 'pizza', 'in', 'town']
+    handler = search.RequestHandler()
+
+    def before():
+        stemmer, stop_words = PorterStemmer(), []
+        file_obj = open(STOP_WORDS)
+        try:
+            for word in file_obj:
+                stop_words.append(word.strip())
+            file_obj.seek(0)
+            hash = hashlib.md5(file_obj.read()).hexdigest()
+        finally:
+            file_obj.close()
+        words = [w for w in query_words if not w in stop_words]
+        stems = list(set([stemmer.stem(w) for w in set(words)]))
+
+    def after():
+        handler._query_words_to_stems(query_words)
+
+    return _time(before, number), _time(after, number)
+
+
+def _benchmark_stemmer(number):
+    """Stem every distinct word on a large page.
+
+    Before, we ran each word through a fresh Porter stemmer.  After, we look
+    each word up in the shared stemmer's cache, which earlier pages warmed up.
+    """
+    import packages
+    from nltk.stem.porter import PorterStemmer
+    import stemmer
+
+    prefixes = ('', 're', 'un', 'over', 'pre')
+    roots = ('connect', 'relate', 'condition', 'digitize', 'operate',
+             'decide', 'hope', 'form', 'sense', 'electric', 'conduct',
+             'adjust', 'depend', 'control', 'respect', 'state')
+    suffixes = ('', 's', 'ing', 'ed', 'ation', 'ness', 'ful', 'ive', 'ly')
+    words = [prefix + root + suffix for prefix in prefixes for root in roots
+             for suffix in suffixes]
+    for word in words:
+        stemmer.stem(word)
+
+    def before():
+        porter_stemmer = PorterStemmer()
+        for word in words:
+            porter_stemmer.stem(word)
+
+    def after():
+        for word in words:
+            stemmer.stem(word)
+
+    return _time(before, number), _time(after, number)
+
+
+def _benchmark_porter(number):
+    """Stem our whole vocabulary, without caching.
+
+    Before, with the Porter stemmer that we vendor from NLTK.  After, with
+    fast_porter.py's.  Our vocabulary is every word in our stop words, our
+    templates, our license, and our (and our vendored packages') source code.
+    First, make sure that both stemmers agree on every word.
+    """
+    import packages
+    from nltk.stem.porter import PorterStemmer
+    import fast_porter
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.join(base_dir, 'COPYING')]
+    for pattern in (('corpus', '*.txt'), ('templates', '*', '*'), ('*.py',),
+                    ('packages', '*', '*.py'), ('packages', '*', '*', '*.py')):
+        paths.extend(glob.glob(os.path.join(base_dir, *pattern)))
+    words = set()
+    for path in paths:
+        file_obj = open(path)
+        try:
+            words.update(re.findall(r"[A-Za-z']+", file_obj.read()))
+        finally:
+            file_obj.close()
+    words = sorted(words) + [word.lower() for word in sorted(words)]
+    porter_stemmer, fast_stemmer = PorterStemmer(), fast_porter.PorterStemmer()
+    for word in words:
+        if porter_stemmer.stem(word) != fast_stemmer.stem(word):
+            raise ValueError('stemmers disagree on %r: %r != %r' %
+                             (word, porter_stemmer.stem(word),
+                              fast_stemmer.stem(word)))
+
+    def before():
+        for word in words:
+            porter_stemmer.stem(word)
+
+    def after():
+        for word in words:
+            fast_stemmer.stem(word)
+
+    return _time(before, number), _time(after, number)
+
+
+def _benchmark_auto_tag(number, num_words=50000, vocabulary_size=5000):
+    """Auto-tag a large page (the size of a novel).
+
+    Before, we counted each distinct word's occurrences with list.count, a
+    pass over the whole page per distinct word.  After, we count them all in
+    one pass.  The page's words follow Zipf's law, like real pages' words.
+    First, make sure that both produce the same tags.
+    """
+    import auto_tag
+    import stemmer
+
+    vocabulary = ['%s%s' % (letters, index) for index, letters in
+                  enumerate(['word', 'page', 'tag', 'stem', 'novel'] *
+                            (vocabulary_size / 5))]
+    weights = [1.0 / rank for rank in range(1, len(vocabulary) + 1)]
+    total, words = sum(weights), []
+    for word, weight in zip(vocabulary, weights):
+        words.extend([word] * int(round(weight / total * num_words)))
+    stop_words = auto_tag.read_stop_words()[0]
+
+    def before():
+        tags, max_count = {}, 0
+        for word in [word for word in set(words) if not word in stop_words]:
+            tag = {'stem': stemmer.stem(word), 'word': word}
+            tag['count'] = float(words.count(word))
+            try:
+                tags[tag['stem']]['count'] += tag['count']
+            except KeyError:
+                tags[tag['stem']] = tag
+            if max_count < tags[tag['stem']]['count']:
+                max_count = tags[tag['stem']]['count']
+        tmp, tags = tags.values(), []
+        for tag in tmp:
+            tag['count'] /= max_count
+            if tag['count'] >= auto_tag.FETCH_MIN_COUNT:
+                tags.append(tag)
+        return sorted(tags, key=operator.itemgetter('word'))
+
+    def after():
+        return auto_tag.auto_tag(words, stop_words)
+
+    if before() != after():
+        raise ValueError('auto_tag no longer produces the same tags')
+    return _time(before, number), _time(after, number)
+
+
+def _benchmark_tokenize_html(number, num_paragraphs=200):
+    """Tokenize a typical page: navigation, scripts, styles, and paragraphs.
+
+    Before, we stripped out the garbage with a findAll per uninteresting tag
+    (and one for comments), serialized the interesting tags back into HTML,
+    and parsed that HTML again.  After, we walk the tree once.  First, make
+    sure that both produce the same title and words.
+    """
+    import auto_tag
+    from beautifulsoup.BeautifulSoup import BeautifulSoup, Comment
+
+    html = _typical_page(num_paragraphs)
+
+    def before():
+        soup = BeautifulSoup(html, convertEntities=BeautifulSoup.ALL_ENTITIES)
+        for tag_name in auto_tag.FETCH_BAD_TAGS:
+            [tag.extract() for tag in soup.findAll(tag_name)]
+        comments = soup.findAll(text=lambda text: isinstance(text, Comment))
+        [comment.extract() for comment in comments]
+        title = unicode(soup.findAll('title')[0].contents[0])
+        tags = soup.findAll(auto_tag.FETCH_GOOD_TAGS)
+        soup = BeautifulSoup(' '.join([str(tag) for tag in tags]))
+        words = ' '.join(soup.findAll(text=True))
+        words = auto_tag.extract_words_from_string(words)
+        return title, u' '.join(words), False
+
+    def after():
+        return auto_tag._tokenize_html(html, 'soup', None, None)
+
+    if before() != after():
+        raise ValueError('tokenize_html no longer produces the same words')
+    return _time(before, number), _time(after, number)
+
+
+def _benchmark_extractor(number, num_paragraphs=200):
+    """Tokenize a typical page with each of tokenize_html's extractors.
+
+    Before, we built a BeautifulSoup tree and walked it.  After, we scan the
+    page for events, keeping only a stack of open tags' names (see
+    extract.py).  First, make sure that both produce the same title and words.
+    """
+    import auto_tag
+
+    html = _typical_page(num_paragraphs)
+
+    def before():
+        return auto_tag._tokenize_html(html, 'soup', None, None)
+
+    def after():
+        return auto_tag._tokenize_html(html, 'fast', None, None)
+
+    if before() != after():
+        raise ValueError("extractors don't produce the same words")
+    return _time(before, number), _time(after, number)
+
+
+def _benchmark_decode(number, num_paragraphs=200):
+    """Decode a typical page, which the Content-Type header says is cp1252.
+
+    Before, UnicodeDammit guessed the page's encoding:  it searched the whole
+    page for a <meta> tag, then tried UTF-8 (which failed, near the end of the
+    page), then Windows-1252.  After, we try the Content-Type header's charset
+    first.  First, make sure that both produce the same unicode.
+    """
+    import auto_tag
+    from beautifulsoup.BeautifulSoup import UnicodeDammit
+
+    html = _typical_page(num_paragraphs).replace('</body>',
+                                                 '\x93Caf\xe9\x94</body>')
+
+    def before():
+        return UnicodeDammit(html, smartQuotesTo=None, isHTML=True).unicode
+
+    def after():
+        return auto_tag._decode(html, charset='windows-1252')
+
+    if before() != after():
+        raise ValueError("decoders don't produce the same unicode")
+    return _time(before, number), _time(after, number)
+
+
+def _benchmark_tokens_cache(number, num_paragraphs=200):
+    """Tokenize a typical page that we've already tokenized.
+
+    Before, we parsed the page every time.  After, we hash it, and look up its
+    title and words in a local cache.  First, make sure that both produce the
+    same title and words.
+    """
+    import auto_tag
+
+    html = _typical_page(num_paragraphs)
+
+    def before():
+        title, words, truncated = auto_tag._tokenize_html(html, 'fast', None,
+                                                          None)
+        return title, words.split(), hashlib.md5(html).hexdigest(), truncated
+
+    def after():
+        return auto_tag.tokenize_html(html)
+
+    if before() != after():
+        raise ValueError('tokenize_html no longer produces the same words')
+    return _time(before, number), _time(after, number)
+
+
+def _benchmark_fetch_pool(number, num_paragraphs=20):
+    """Fetch a typical page from a local web server over and over.
+
+    Before, urllib2 opened a new connection for every fetch.  After, we keep
+    the connection alive between fetches (see fetch._PooledFetch).  The local
+    server stands in for a remote one, so this measures only our overhead and
+    the connection setup, not the network.  First, make sure that both fetch
+    the same thing.
+    """
+    import fetch
+
+    server, url = _serve_locally(_typical_page(num_paragraphs))
+
+    def before():
+        return fetch._PythonFetch().fetch(url)
+
+    def after():
+        return fetch._PooledFetch().fetch(url)
+
+    try:
+        if before() != after():
+            raise ValueError("fetch backends don't fetch the same thing")
+        return _time(before, number), _time(after, number)
+    finally:
+        server.shutdown()
+
+
+def _serve_locally(html):
+    """Serve a page over HTTP/1.1 (with keep-alive) from a local web server.
+
+    Return the server (call its shutdown method when you're done) and the
+    page's URL.
+    """
+    class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Like a real web server, send the whole response at once.  (Sent one
+        # header at a time, a kept alive response waits on delayed ACKs.)
+        wbufsize = -1
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(html)))
+            self.end_headers()
+            self.wfile.write(html)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), RequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server, 'http://127.0.0.1:%s/' % server.server_address[1]
+
+
+def _benchmark_normalize(number, num_urls=300000, num_distinct=30000):
+    """Normalize a stream of typical URLs, some much more popular than others.
+
+    Before, we parsed every URL from scratch, and compiled our escape sequence
+    regular expression every time.  After, we precompile the regular
+    expression, and look up the most recently used URLs in a cache.  Each run
+    normalizes the next num_urls / number URLs in the stream, so that all of
+    the runs together normalize the whole stream once.  First, make sure that
+    both produce the same normalized URLs.
+    """
+    import fetch
+
+    class Before(fetch.Factory):
+        def normalize(self, url):
+            return self._normalize(url)
+
+        def _normalize_escape_sequences(self, url):
+            esc_seq_reg_exp = r'%[0-9A-Fa-f]{2,2}'
+            url = re.sub(esc_seq_reg_exp, lambda m: m.group().upper(), url)
+            return url
+
+    urls, size = _typical_urls(num_urls, num_distinct), max(num_urls / number,
+                                                            1)
+    before_fetcher, after_fetcher = Before(), fetch.Factory()
+    if ([before_fetcher.normalize(url) for url in urls] !=
+        [after_fetcher.normalize(url) for url in urls]):
+        raise ValueError("normalizers don't produce the same URLs")
+    fetch._normalized.clear()
+
+    def runs(normalize):
+        index = [0]
+        def run():
+            start = index[0]
+            index[0] = (start + size) % num_urls
+            return [normalize(url) for url in urls[start:start + size]]
+        return run
+
+    before, after = runs(before_fetcher.normalize), \
+                    runs(after_fetcher.normalize)
+    return _time(before, number), _time(after, number)
+
+
+def _typical_urls(num_urls, num_distinct):
+    """Make up a stream of typical URLs, as people would save and fetch them.
+
+    A few hosts and pages are very popular, and most are not (their popularity
+    follows Zipf's law).  The URLs come in the forms that people paste:  some
+    have uppercase hosts, default ports, directory indexes, dot segments,
+    empty and unsorted query parameters, and lowercase escape sequences.
+    """
+    generator = random.Random(0)
+    distinct = []
+    for index in range(num_distinct):
+        host = 'www.site%s.com' % int(generator.paretovariate(1.0))
+        path = '/'.join(['section%s' % generator.randint(0, 9)
+                         for depth in range(generator.randint(0, 3))])
+        url = generator.choice(['', 'http://', 'HTTP://', 'https://'])
+        url += generator.choice([host, host.upper()])
+        url += generator.choice(['', '', ':80'])
+        url += '/' + path
+        url += generator.choice(['', '/', '/index.html', '/../a/./b.html',
+                                 '/post-%s.html' % index,
+                                 '/caf%%c3%%a9-%s' % index])
+        if generator.random() < 0.3:
+            url += '?id=%s&sort=new&ref=&utm_source=feed' % index
+        distinct.append(url)
+    weights = [1.0 / (rank + 1) for rank in range(num_distinct)]
+    total, cumulative = sum(weights), []
+    for weight in weights:
+        cumulative.append((cumulative[-1] if cumulative else 0) +
+                          weight / total)
+    urls = []
+    for index in range(num_urls):
+        rank = bisect.bisect_left(cumulative, generator.random())
+        urls.append(distinct[min(rank, num_distinct - 1)])
+    return urls
+
+
+def _typical_page(num_paragraphs):
+    """Make up a typical page: navigation, scripts, styles, and paragraphs."""
+    html = ['<!DOCTYPE html><html><head><title>A Typical Page</title>',
+            '<style>body { margin: 0; }</style>',
+            '<script>var tracker = new Tracker();</script></head><body>',
+            '<ul>%s</ul>' % ''.join(['<li><a href="/%s">Link %s</a></li>' %
+                                     (index, index) for index in range(50)]),
+            '<h1>The &amp; Heading</h1>']
+    for index in range(num_paragraphs):
+        html.append('<div class="post"><!-- post %s --><h2>Post %s</h2>' %
+                    (index, index))
+        html.append('<p>Lorem <b>ipsum</b> dolor sit amet, <a href="#">' +
+                    'consectetur</a> adipiscing elit &mdash; sed do eiusmod ' +
+                    'tempor incididunt ut labore et dolore magna aliqua.</p>')
+        html.append('<script>render(%s);</script></div>' % index)
+    html.append('</body></html>')
+    return ''.join(html)
+
+
+_BENCHMARKS = {
+    'auto_tag': _benchmark_auto_tag,
+    'decode': _benchmark_decode,
+    'extractor': _benchmark_extractor,
+    'fetch_pool': _benchmark_fetch_pool,
+    'normalize': _benchmark_normalize,
+    'porter': _benchmark_porter,
+    'stemmer': _benchmark_stemmer,
+    'stop_words': _benchmark_stop_words,
+    'tag_counts': _benchmark_tag_counts,
+    'tokenize_html': _benchmark_tokenize_html,
+    'tokens_cache': _benchmark_tokens_cache,
+}
+
+
+if __name__ == '__main__':
+    main()
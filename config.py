@@ -96,6 +96,14 @@ SEARCH_CACHE_SECS = 60 if DEBUG else 3600
 
 # Options related to bookmark index logic:
 FETCH_GOOD_STATUS_CODES = (200,)
+FETCH_MAX_BYTES = 1024 * 1024   # Read (and so tag) at most 1 MB of a page,
+FETCH_MAX_WORDS = 100000        # and tag at most its first 100,000 words.
+FETCH_MAX_PARALLEL = 10         # Fetch at most 10 pages at once (fetch_many),
+FETCH_MAX_PER_HOST = 2          # and at most 2 of them from any one host.
+FETCH_BACKEND = 'pooled'        # 'pooled' (keep-alive) or 'urllib2'.
+FETCH_POOL_MAX_IDLE = 2         # Keep at most 2 idle connections per host,
+FETCH_POOL_IDLE_SECS = 30       # for at most 30 seconds each.
+FETCH_NORMALIZE_CACHE_SIZE = 10000  # Number of normalized URLs we remember.
 FETCH_DOCUMENT_INDEXES = ('/default.asp', '/index.htm', '/index.html',)
 FETCH_BAD_TAGS = ('script', 'noscript', 'style',)
 FETCH_GOOD_TAGS = (
@@ -104,6 +112,21 @@ FETCH_GOOD_TAGS = (
     'lh', 'dt', 'dd',
 )
 FETCH_MIN_COUNT = 0.125
+FETCH_EXTRACTOR = 'fast'        # 'fast' (extract.py) or 'soup' (BeautifulSoup).
+KEYCHAIN_NUM_SHARDS = 8
+# Whether or not keychain shards also keep their postings ordered by impact
+# (each bookmark's count for the stem), so that search can stop early.
+KEYCHAIN_IMPACTS = True
+REINDEX_BATCH_SIZE = 50
+REINDEX_STOP_WORDS_BATCH_SIZE = 10
+KEYCHAIN_COMPACT_BATCH_SIZE = 200   # Postings to merge per compaction run.
+INGEST_ASYNC = True             # Fetch and tag new bookmarks in the background,
+INGEST_QUEUE = 'ingest'         # in this task queue (see queue.yaml),
+INGEST_URL = '/admin/ingest'    # by POSTing them to this worker.
+STEMMER_CACHE_SIZE = 10000      # Number of words whose stems we remember.
+TOKENIZE_CACHE_CHARS = 1024 * 1024  # Characters of pages' words we remember,
+TOKENIZE_CACHE_SECS = 24 * 60 * 60  # and for how long (in memcache).
+STEMMER_ALGORITHM = 'fast'      # 'fast' (fast_porter.py) or 'porter' (NLTK).
 
 
 HTTP_CODE_TO_TITLE = {
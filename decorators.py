@@ -83,7 +83,7 @@ def create_account(method):
     return wrap
 
 
-def memcache_results(cache_secs=DEFAULT_CACHE_SECS):
+def memcache_results(cache_secs=DEFAULT_CACHE_SECS, version=None):
     """Decorate a method with the memcache pattern.
 
     Technically, the memcache_results function isn't a decorator.  It's a
@@ -98,11 +98,18 @@ def memcache_results(cache_secs=DEFAULT_CACHE_SECS):
     computed and cached, then we simply return them.  Otherwise, we call the
     method to compute the results, cache the results (so that future calls will
     hit the cache), then return the results.
+
+    If we change what a method returns, then results cached by the old code
+    are no longer what the callers expect.  So bump the method's version,
+    which we work into the memcache key, and the old results go unused (until
+    they expire).
     """
     def wrap1(method):
         @functools.wraps(method)
         def wrap2(self, *args, **kwds):
             key = _compute_memcache_key(self, method, *args, **kwds)
+            if version is not None:
+                key += ' version: %s' % version
             _log.debug('trying to retrieve cached results for %s' % key)
             results = memcache.get(key)
             if results is not None:
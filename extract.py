@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+#------------------------------------------------------------------------------#
+#   extract.py                                                                 #
+#                                                                              #
+#   Copyright (c) 2009-2010, Code A La Mode, original authors.                 #
+#                                                                              #
+#       This file is part of imi-imi.                                          #
+#                                                                              #
+#       imi-imi is free software; you can redistribute it and/or modify        #
+#       it under the terms of the GNU General Public License as published by   #
+#       the Free Software Foundation, either version 3 of the License, or      #
+#       (at your option) any later version.                                    #
+#                                                                              #
+#       imi-imi is distributed in the hope that it will be useful,             #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#       GNU General Public License for more details.                           #
+#                                                                              #
+#       You should have received a copy of the GNU General Public License      #
+#       along with imi-imi.  If not, see <http://www.gnu.org/licenses/>.       #
+#------------------------------------------------------------------------------#
+"""A fast, forgiving extractor of the text that we auto-tag HTML with.
+
+To auto-tag a page, we only need its title and the text under its interesting
+tags (see FETCH_GOOD_TAGS).  BeautifulSoup builds a whole tree of objects for
+the page - a dozen method calls and an object or two per tag, entity, and run
+of text - which is slow and memory hungry on big pages.  Instead, this module
+scans the page with one regular expression, which breaks it into events (start
+tags, end tags, text, and comments and the like), and keeps only a stack of the
+open tags' names.
+
+Like BeautifulSoup, this module never gives up on broken markup:  a stray <
+is just text, a comment that's never closed runs to the end of the page, and
+an end tag that doesn't match any open tag is ignored.  It closes unclosed tags
+by BeautifulSoup's own nesting rules, and converts entities the way
+BeautifulSoup does with ALL_ENTITIES.  It produces the same title and
+text as walking the soup (see auto_tag.py) on almost all real pages (see
+parity.py, which checks a corpus of saved pages).
+
+Example usage:
+    >>> html = u'<html><head><title>Hi</title><style>p {}</style></head>'
+    >>> html += u'<body><p>One <b>two</b></p><!-- three --><ul><li>four'
+    >>> html += u'</li></ul><blockquote><p>five &amp; six</p></blockquote>'
+    >>> title, text = extract(html)
+    >>> title, text.split()
+    (u'Hi', [u'Hi', u'One', u'two', u'five', u'&', u'six'])
+    >>> extract(u'<div>One <script>if (a<b) two();</script>')
+    (None, u'One ')
+"""
+
+
+from htmlentitydefs import name2codepoint
+import re
+import sgmllib
+
+import packages
+from beautifulsoup.BeautifulSoup import BeautifulSoup
+
+from config import FETCH_BAD_TAGS, FETCH_GOOD_TAGS
+
+
+# Each match is one event:  a comment, a CDATA section, a declaration or
+# processing instruction, an end tag, a start tag, a tag that's never ended
+# (which, like BeautifulSoup, drops the rest of the page), a run of text, or a
+# stray < (which is just text).  Like sgmllib, a tag ends at the next > or
+# before the next <.
+_EVENT = re.compile(r'''
+    (?P<comment><!--.*?(?:-->|\Z))
+  | <!\[CDATA\[(?P<cdata>.*?)(?:\]\]>|\Z)
+  | (?P<declaration><[!?][^>]*>?)
+  | </(?P<end>[A-Za-z][-.:\w]*)[^<>]*(?:>|(?=<))
+  | <(?P<start>[A-Za-z][-.:\w]*)(?P<attributes>[^<>]*)(?:>|(?=<))
+  | (?P<unended></?[A-Za-z][^<>]*\Z)
+  | (?P<text>[^<]+|<)
+''', re.DOTALL | re.VERBOSE)
+_ENTITY = re.compile(r'&(?:#([0-9]+)|([A-Za-z][-.A-Za-z0-9]*));?')
+
+# BeautifulSoup's rules for which tags are never closed, which tags' contents
+# aren't markup, and which open tags a start tag implicitly closes:
+_SELF_CLOSING_TAGS = BeautifulSoup.SELF_CLOSING_TAGS
+_QUOTE_TAGS = BeautifulSoup.QUOTE_TAGS
+_NESTABLE_TAGS = BeautifulSoup.NESTABLE_TAGS
+_RESET_NESTING_TAGS = BeautifulSoup.RESET_NESTING_TAGS
+_XML_ENTITIES = {'apos': u"'", 'quot': u'"', 'amp': u'&', 'lt': u'<',
+                 'gt': u'>'}
+
+
+def extract(html, interesting_tags=FETCH_GOOD_TAGS,
+            uninteresting_tags=FETCH_BAD_TAGS):
+    """Given HTML (as unicode), return its title and its interesting text.
+
+    The interesting text is the text under the interesting tags (but not under
+    the uninteresting tags), each piece once.  If the HTML has no interesting
+    tags at all, then all of its text (outside of the uninteresting tags) is
+    interesting.
+
+    Example usage:
+        >>> html = u'<noscript><p>Enable JavaScript.</p></noscript>'
+        >>> extract(html + u'<div>Cheap bicycles for sale</div>')
+        (None, u'Cheap bicycles for sale')
+        >>> html = u'<textarea>One <!--two--></b> <!--three--> <![CDATA[four]]>'
+        >>> extract(html)[1].split()
+        [u'One', u'<!--two-->', u'</b>', u'four']
+        >>> extract(u'<p>One <b two')
+        (None, u'One ')
+    """
+    stack = _TagStack(interesting_tags, uninteresting_tags)
+    title, in_title, interesting, everything = None, False, [], []
+    quote, literal = None, False
+    position, length = 0, len(html)
+    while position < length:
+        if literal:
+            # Like sgmllib, until the next end tag (of any name), the quote
+            # tag's contents are just text (see _QUOTE_TAGS):
+            end = html.find(u'</', position)
+            end = length if end == -1 else end
+            if position < end and not stack.num_uninteresting:
+                everything.append(html[position:end])
+                if stack.num_interesting:
+                    interesting.append(html[position:end])
+            position, literal = end, False
+            continue
+        match = _EVENT.match(html, position)
+        position = match.end()
+        kind = match.lastgroup
+        if in_title and title is not None and kind != 'text':
+            # The title is the first run of text in the <title> tag.
+            in_title = False
+        if quote is not None and (kind == 'attributes' or
+                                  kind == 'end' and
+                                  match.group('end').lower() != quote):
+            # Inside a quote tag, other tags aren't real tags - they're text.
+            # (But comments are still comments, and entities are entities.)
+            if not stack.num_uninteresting:
+                text = _quoted_tag(html, match)
+                everything.append(text)
+                if stack.num_interesting:
+                    interesting.append(text)
+        elif kind == 'text' and not stack.num_uninteresting:
+            text = _convert_entities(match.group('text'))
+            everything.append(text)
+            if stack.num_interesting:
+                interesting.append(text)
+            if in_title:
+                title = text if title is None else title + text
+        elif kind == 'cdata' and not stack.num_uninteresting:
+            everything.append(match.group('cdata'))
+            if stack.num_interesting:
+                interesting.append(match.group('cdata'))
+        elif kind == 'attributes':
+            name = match.group('start').lower()
+            if name in _SELF_CLOSING_TAGS:
+                continue
+            stack.push(name)
+            if name == 'title' and title is None:
+                in_title = not stack.num_uninteresting
+            if name in _QUOTE_TAGS:
+                quote, literal = name, True
+        elif kind == 'end':
+            stack.pop(match.group('end').lower())
+            quote, in_title = None, in_title and 'title' in stack
+    text = interesting if stack.found_interesting_tag else everything
+    return title, u' '.join(text)
+
+
+class _TagStack(object):
+    """The names of the open tags, and how many of them are (un)interesting."""
+
+    def __init__(self, interesting_tags, uninteresting_tags):
+        """Initialize an empty stack of open tags."""
+        self._names = []
+        self._interesting_tags = frozenset(interesting_tags)
+        self._uninteresting_tags = frozenset(uninteresting_tags)
+        self.num_interesting = self.num_uninteresting = 0
+        self.found_interesting_tag = False
+
+    def push(self, name):
+        """Open a tag, after closing the open tags that it implicitly closes.
+
+        Like BeautifulSoup, a tag that can't nest inside itself closes the
+        innermost open tag of the same name (and the tags inside it).  A tag
+        that can nest closes the tags inside its innermost open reset trigger
+        (for example, <li> closes the tags inside the innermost <ul> or <ol>).
+        And a block tag that can't nest closes the tags inside the innermost
+        open block tag.
+
+        Example usage:
+            >>> stack = _TagStack(('p',), ('script',))
+            >>> for name in ('div', 'p', 'b', 'p'):
+            ...     stack.push(name)
+            >>> stack._names, stack.num_interesting
+            (['div', 'p'], 1)
+        """
+        triggers = _NESTABLE_TAGS.get(name)
+        resets_nesting = triggers is None and name in _RESET_NESTING_TAGS
+        for index in xrange(len(self._names) - 1, -1, -1):
+            open_name = self._names[index]
+            if triggers is None and open_name == name:
+                self._truncate(index)
+                break
+            if (triggers is not None and open_name in triggers or
+                resets_nesting and open_name in _RESET_NESTING_TAGS):
+                self._truncate(index + 1)
+                break
+        self._names.append(name)
+        if name in self._interesting_tags:
+            self.num_interesting += 1
+            # The soup walk never looks under the uninteresting tags, so it
+            # never finds the interesting tags there.
+            if not self.num_uninteresting:
+                self.found_interesting_tag = True
+        if name in self._uninteresting_tags:
+            self.num_uninteresting += 1
+
+    def __contains__(self, name):
+        """Return whether a tag with the given name is open."""
+        return name in self._names
+
+    def pop(self, name):
+        """Close the innermost open tag with the given name, and the tags in it.
+
+        If no open tag has the given name, then do nothing.
+        """
+        for index in xrange(len(self._names) - 1, -1, -1):
+            if self._names[index] == name:
+                self._truncate(index)
+                break
+
+    def _truncate(self, length):
+        """Close the open tags after the first length of them."""
+        while len(self._names) > length:
+            name = self._names.pop()
+            if name in self._interesting_tags:
+                self.num_interesting -= 1
+            if name in self._uninteresting_tags:
+                self.num_uninteresting -= 1
+
+
+def _quoted_tag(html, match):
+    """Return the text that BeautifulSoup makes of a tag in a quote tag.
+
+    Like sgmllib, read a start tag's attributes past the tag's end, if they're
+    quoted (the rest of the tag is text after this, too), and give an attribute
+    without a value its name as its value.
+
+    Example usage:
+        >>> html = u'<b a="1>2" c>'
+        >>> _quoted_tag(html, _EVENT.match(html))
+        u'<b a="1>2" c="c">'
+    """
+    if match.lastgroup != 'attributes':
+        return match.group()
+    attributes, end = [], match.start('attributes')
+    attribute = sgmllib.attrfind.match(html, end)
+    while attribute is not None and attribute.end() > end:
+        name, rest, value = attribute.group(1, 2, 3)
+        if not rest:
+            value = name
+        elif value[:1] == value[-1:] and value[:1] in u'\'"':
+            value = value[1:-1]
+        attributes.append(u' %s="%s"' % (name.lower(), value))
+        end = attribute.end()
+        attribute = sgmllib.attrfind.match(html, end)
+    return u'<%s%s>' % (match.group('start'), u''.join(attributes))
+
+
+def _convert_entities(text):
+    """Convert HTML and character entities to the characters they stand for.
+
+    Like BeautifulSoup, leave an unrecognized entity's name, but escape its
+    ampersand - usually, it's really a misplaced ampersand, like in AT&T.
+
+    Example usage:
+        >>> _convert_entities(u'caf&eacute; &#38; AT&T &bogus;')
+        u'caf\\xe9 & AT&amp;T &amp;bogus'
+    """
+    if not u'&' in text:
+        return text
+    return _ENTITY.sub(_convert_entity, text)
+
+
+def _convert_entity(match):
+    """Convert one HTML or character entity to the character it stands for."""
+    number, name = match.groups()
+    try:
+        if number is not None:
+            return unichr(int(number))
+        if name in name2codepoint:
+            return unichr(name2codepoint[name])
+    except (OverflowError, ValueError):
+        return match.group()
+    return _XML_ENTITIES.get(name, u'&amp;' + name)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
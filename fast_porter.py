@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+#------------------------------------------------------------------------------#
+#   fast_porter.py                                                             #
+#                                                                              #
+#   Copyright (c) 2009-2010, Code A La Mode, original authors.                 #
+#                                                                              #
+#       This file is part of imi-imi.                                          #
+#                                                                              #
+#       imi-imi is free software; you can redistribute it and/or modify        #
+#       it under the terms of the GNU General Public License as published by   #
+#       the Free Software Foundation, either version 3 of the License, or      #
+#       (at your option) any later version.                                    #
+#                                                                              #
+#       imi-imi is distributed in the hope that it will be useful,             #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#       GNU General Public License for more details.                           #
+#                                                                              #
+#       You should have received a copy of the GNU General Public License      #
+#       along with imi-imi.  If not, see <http://www.gnu.org/licenses/>.       #
+#------------------------------------------------------------------------------#
+"""A faster implementation of the Porter stemming algorithm.
+
+The Porter stemmer that we vendor (packages/nltk/stem/porter.py) keeps its
+word in a buffer attribute, and works on it through dozens of tiny method calls
+per word:  it re-slices the buffer to test every candidate suffix, and rescans
+the word for consonants and vowels (recursively, for y) every time it measures
+the word.
+
+This implementation produces exactly the same stems (quirks included - see
+benchmark.py's porter benchmark, which checks), but:
+
+    - it tests suffixes with str.endswith against the end of the stem, rather
+      than by slicing,
+    - it finds the candidate suffixes for each step in precomputed tables,
+      keyed by the letter that the vendored stemmer switches on, and
+    - it classifies each letter as a consonant or a vowel, and counts the
+      word's vowel-consonant sequences, once per change to the word, so that
+      measuring the word is a lookup.
+
+Example usage:
+    >>> stemmer = PorterStemmer()
+    >>> [stemmer.stem(word) for word in ('caresses', 'ponies', 'Relational',
+    ...                                  'generalization', 'skies', 'hopping')]
+    ['caress', 'poni', 'Relat', 'gener', 'sky', 'hop']
+"""
+
+
+_VOWELS = frozenset('aeiou')
+
+# The irregular forms that the vendored stemmer maps straight to their stems:
+_IRREGULAR_FORMS = {
+    'sky': 'sky', 'skies': 'sky', 'dying': 'die', 'lying': 'lie',
+    'tying': 'tie', 'news': 'news', 'innings': 'inning', 'inning': 'inning',
+    'outings': 'outing', 'outing': 'outing', 'cannings': 'canning',
+    'canning': 'canning', 'howe': 'howe', 'proceed': 'proceed',
+    'exceed': 'exceed', 'succeed': 'succeed',
+}
+
+# Steps 2 and 3 map suffixes to replacements (if the rest of the word has a
+# vowel-consonant sequence).  Step 4 removes suffixes (if the rest of the word
+# has two).  Each step tries its suffixes in order, and stops at the first one
+# that the word ends with (whether or not it then replaces it).  Step 2 and 4
+# look the suffixes up by the second to last letter, step 3 by the last.
+_STEP_2 = {
+    'a': (('ational', 'ate'), ('tional', 'tion')),
+    'c': (('enci', 'ence'), ('anci', 'ance')),
+    'e': (('izer', 'ize'),),
+    'l': (('bli', 'ble'), ('alli', 'al'), ('fulli', 'ful'), ('entli', 'ent'),
+          ('eli', 'e'), ('ousli', 'ous')),
+    'o': (('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate')),
+    's': (('alism', 'al'), ('iveness', 'ive'), ('fulness', 'ful'),
+          ('ousness', 'ous')),
+    't': (('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble')),
+    'g': (('logi', 'og'),),
+}
+_STEP_3 = {
+    'e': (('icate', 'ic'), ('ative', ''), ('alize', 'al')),
+    'i': (('iciti', 'ic'),),
+    'l': (('ical', 'ic'), ('ful', '')),
+    's': (('ness', ''),),
+}
+_STEP_4 = {
+    'a': ('al',), 'c': ('ance', 'ence'), 'e': ('er',), 'i': ('ic',),
+    'l': ('able', 'ible'), 'n': ('ant', 'ement', 'ment', 'ent'),
+    'o': ('ion', 'ou'), 's': ('ism',), 't': ('ate', 'iti'), 'u': ('ous',),
+    'v': ('ive',), 'z': ('ize',),
+}
+
+
+class PorterStemmer(object):
+    """A drop-in replacement for the vendored Porter stemmer's stem method."""
+
+    def stem(self, word):
+        """Return a word's stem, in the same case as the word."""
+        lower = word.lower()
+        stem = _stem(lower, len(word) - 1)
+        if word == lower:
+            return word[:0] + stem
+        result = ''
+        for index in xrange(len(stem)):
+            if lower[index] == stem[index]:
+                result += word[index]
+            else:
+                result += stem[index]
+        return result
+
+    def __repr__(self):
+        """ """
+        return '<PorterStemmer>'
+
+
+def _measure(b):
+    """Classify a word's letters, and count its vowel-consonant sequences.
+
+    Return a list of whether each letter is a consonant, a list of the number
+    of vowel-consonant sequences up to and including each letter, and the
+    index of the first vowel.
+
+    Example usage (y is a consonant after a vowel):
+        >>> _measure('toys')
+        ([True, False, True, True], [0, 0, 1, 1], 1)
+    """
+    cons, counts, num, first_vowel = [], [], 0, len(b)
+    previous = True
+    for index, letter in enumerate(b):
+        if letter in _VOWELS:
+            consonant = False
+        elif letter == 'y':
+            consonant = index == 0 or not previous
+        else:
+            consonant = True
+        if consonant and not previous:
+            num += 1
+        if not consonant and first_vowel > index:
+            first_vowel = index
+        cons.append(consonant)
+        counts.append(num)
+        previous = consonant
+    return cons, counts, first_vowel
+
+
+def _cvc(b, cons, index):
+    """Return whether b[index - 2:index + 1] is consonant, vowel, consonant.
+
+    (And the last consonant isn't w, x, or y.  Or index is 1, and b starts with
+    a vowel and a consonant.)
+    """
+    if index == 0:
+        return False
+    if index == 1:
+        return not cons[0] and cons[1]
+    if not cons[index] or cons[index - 1] or not cons[index - 2]:
+        return False
+    return b[index] not in 'wxy'
+
+
+def _stem(b, k):
+    """Return the stem of the lower case word b[:k + 1]."""
+    if b[:k + 1] in _IRREGULAR_FORMS:
+        return _IRREGULAR_FORMS[b[:k + 1]]
+    if k <= 1:
+        return b
+    cons, counts, first_vowel = _measure(b)
+    j = 0
+
+    # Step 1ab:  get rid of plurals and -ed or -ing.
+    if b[k] == 's':
+        if b.endswith('sses', 0, k + 1):
+            j, k = k - 4, k - 2
+        elif b.endswith('ies', 0, k + 1):
+            j = k - 3
+            k -= 1 if j == 0 else 2
+        elif b[k - 1] != 's':
+            k -= 1
+    if b.endswith('ied', 0, k + 1):
+        j = k - 3
+        k -= 1 if j == 0 else 2
+    elif b.endswith('eed', 0, k + 1):
+        j = k - 3
+        if j >= 0 and counts[j] > 0:
+            k -= 1
+    else:
+        if b.endswith('ed', 0, k + 1):
+            j, ending = k - 2, True
+        elif b.endswith('ing', 0, k + 1):
+            j, ending = k - 3, True
+        else:
+            ending = False
+        if ending and first_vowel <= j:
+            k = j
+            for suffix, replacement in (('at', 'ate'), ('bl', 'ble'),
+                                        ('iz', 'ize')):
+                if b.endswith(suffix, 0, k + 1):
+                    j = k - 2
+                    b = b[:j + 1] + replacement + b[j + 4:]
+                    k = j + 3
+                    cons, counts, first_vowel = _measure(b)
+                    break
+            else:
+                if k >= 1 and b[k] == b[k - 1] and cons[k]:
+                    k -= 1
+                    if b[k] in 'lsz':
+                        k += 1
+                elif j >= 0 and counts[j] == 1 and _cvc(b, cons, k):
+                    b = b[:j + 1] + 'e' + b[j + 2:]
+                    k = j + 1
+                    cons, counts, first_vowel = _measure(b)
+
+    # Step 1c:  turn terminal y to i after a consonant.
+    if b[k] == 'y' and k - 1 > 0 and cons[k - 1]:
+        j = k - 1
+        b = b[:k] + 'i' + b[k + 1:]
+        cons, counts, first_vowel = _measure(b)
+
+    # Step 2:  map double suffixes to single ones.
+    recurse = True
+    while recurse:
+        recurse = False
+        for suffix, replacement in _STEP_2.get(b[k - 1], ()):
+            if not b.endswith(suffix, 0, k + 1):
+                continue
+            j = k - len(suffix)
+            if suffix == 'alli':
+                # Replace -alli with -al, then try step 2 again.
+                if j >= 0 and counts[j] > 0:
+                    b = b[:j + 1] + 'al' + b[j + 3:]
+                    k = j + 2
+                    cons, counts, first_vowel = _measure(b)
+                    recurse = True
+                break
+            if suffix == 'logi':
+                # Keep the l with the stem.
+                j += 1
+            if j >= 0 and counts[j] > 0:
+                b, k = _setto(b, j, replacement)
+                cons, counts, first_vowel = _measure(b)
+            break
+
+    # Step 3:  deal with -ic-, -full, -ness, etc.
+    for suffix, replacement in _STEP_3.get(b[k], ()):
+        if b.endswith(suffix, 0, k + 1):
+            j = k - len(suffix)
+            if j >= 0 and counts[j] > 0:
+                b, k = _setto(b, j, replacement)
+                cons, counts, first_vowel = _measure(b)
+            break
+
+    # Step 4:  take off -ant, -ence, etc.
+    for suffix in _STEP_4.get(b[k - 1], ()):
+        if b.endswith(suffix, 0, k + 1):
+            j = k - len(suffix)
+            if suffix == 'ion' and b[j] != 's' and b[j] != 't':
+                continue
+            if j >= 0 and counts[j] > 1:
+                k = j
+            break
+
+    # Step 5:  remove a final -e, and change -ll to -l, if the word is long.
+    j = k
+    if b[k] == 'e':
+        num = counts[j] if j >= 0 else 0
+        if num > 1 or (num == 1 and not _cvc(b, cons, k - 1)):
+            k -= 1
+    if b[k] == 'l' and k >= 1 and b[k] == b[k - 1] and cons[k]:
+        if j >= 0 and counts[j] > 1:
+            k -= 1
+    return b[:k + 1]
+
+
+def _setto(b, j, replacement):
+    """Write replacement over b from j + 1.  Return b and the new end."""
+    b = b[:j + 1] + replacement + b[j + len(replacement) + 1:]
+    return b, j + len(replacement)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
@@ -22,21 +22,26 @@
 #------------------------------------------------------------------------------#
 """Utilities for fetching content from the web.
 
-Warning:  Everything in this module is terribly, horribly thread unsafe and
-carcinogenic.
+Warning:  A fetch object remembers metadata about the last URL that it fetched
+(see _CommonFetch), so don't share one between threads.  To fetch many URLs at
+once, use fetch_many, which gives each URL its own fetch object.
 
 Originally, I'd used urllib2, but this package was too fragile on tenuous
 internet connections.  So I switched to urlfetch for more robust HTML fetching.
 If we can't import urlfetch, then we're not running on Google App Engine, so we
 fall back to urllib2.
 
+Off Google App Engine, urllib2 opens a new connection for every fetch.  So by
+default (see FETCH_BACKEND), we use httplib instead, and keep connections alive
+between fetches (see _PooledFetch).
+
 Since the following is a doctest, we know that we must be running this script
 in someone's development environment, i.e. not on Google App Engine.  Make sure
 that this script has properly detected that:
 
     >>> _on_app_engine
     False
-    >>> Factory is _AppEngineFetch, Factory is _PythonFetch
+    >>> Factory is _AppEngineFetch, Factory is _PooledFetch
     (False, True)
     >>> isinstance(Factory(), _AppEngineFetch), isinstance(Factory(), _PythonFetch)
     (False, True)
@@ -49,10 +54,17 @@ different URLs are equivalent:
 """
 
 
+import atexit
 import cgi
+import collections
+import httplib
 import logging
+import Queue
 import re
 import socket
+import sys
+import threading
+import time
 import urllib
 import urllib2
 import urlparse
@@ -65,6 +77,9 @@ try:
     from google.appengine.api.urlfetch import InvalidURLError
     from google.appengine.api.urlfetch import DownloadError
     from google.appengine.api.urlfetch import ResponseTooLargeError
+    from google.appengine.api.urlfetch import create_rpc
+    from google.appengine.api.urlfetch import make_fetch_call
+    from google.appengine.api.apiproxy_stub_map import UserRPC
 except ImportError:
     # Oops.  We can't use Google App Engine's urlfetch API.  We mustn't be
     # running on Google App Engine.  That's cool - fall back to Python's
@@ -75,13 +90,43 @@ else:
     _on_app_engine = True
 
 from config import FETCH_GOOD_STATUS_CODES, FETCH_DOCUMENT_INDEXES
+from config import FETCH_MAX_BYTES, FETCH_MAX_PARALLEL, FETCH_MAX_PER_HOST
+from config import FETCH_BACKEND, FETCH_POOL_MAX_IDLE, FETCH_POOL_IDLE_SECS
+from config import FETCH_NORMALIZE_CACHE_SIZE
+import lru
 
 
 _log = logging.getLogger(__name__)
+_MAX_REDIRECTS = 10         # Like urllib2, follow at most 10 redirects.
+_REDIRECT_STATUS_CODES = (301, 302, 303, 307)
+_MAX_REDIRECT_BYTES = 64 * 1024  # Read at most 64 KB of a redirect's body.
+# httplib can buffer reading a response's headers only from Python 2.7 on:
+_BUFFERING = sys.version_info >= (2, 7)
+_ESCAPE_SEQUENCE = re.compile(r'%[0-9A-Fa-f]{2,2}')
+
+# We normalize the same URLs over and over (every time that someone saves a
+# bookmark, and twice per fetch), so remember the most recently used URLs'
+# normal forms.  fetch_many's threads share the cache, so lock it.
+_normalized = lru.LRUCache(FETCH_NORMALIZE_CACHE_SIZE)
+_normalized_lock = threading.Lock()
 
 
 class _CommonFetch(object):
-    """ """
+    """Common URL fetch class.
+
+    After each fetch, the fetch object's truncated attribute says whether we
+    cut the content short (at max_bytes), and its charset attribute is the
+    content's encoding according to the Content-Type header (if specified).
+    Its etag and last_modified attributes are the response's validators (if
+    specified), and its not_modified attribute says whether the server told us
+    that the content hasn't changed since we last fetched it.
+    """
+
+    truncated = False
+    charset = None
+    etag = None
+    last_modified = None
+    not_modified = False
 
     def __call__(self, *args, **kwds):
         """Retrieve content from the web.  Make sure the status code is OK.
@@ -97,9 +142,21 @@ class _CommonFetch(object):
         return self.fetch(*args, **kwds)
 
     def fetch(self, url, headers={}, payload={}, deadline=10,
-              status_codes=FETCH_GOOD_STATUS_CODES):
+              status_codes=FETCH_GOOD_STATUS_CODES, max_bytes=FETCH_MAX_BYTES,
+              etag=None, last_modified=None):
         """Retrieve content from the web.  Make sure the status code is OK.
 
+        Read at most max_bytes of the content (or all of it, if max_bytes is
+        None), so that a huge page can't exhaust our memory.  (Except on Google
+        App Engine, where urlfetch downloads the whole response, up to its own
+        limit, before we can cut it down.  There, max_bytes only limits how
+        much of the content we keep.)
+
+        If etag or last_modified (the validators from when we last fetched the
+        URL) is specified, then ask the server for the content only if it's
+        changed since.  If it hasn't (if the status code is 304), then the
+        content is None, and not_modified is True.
+
         Example usage:
             >>> url = 'http://www.gutenberg.org/files/11/11-h/11-h.htm'
             >>> url, status_code, mime_type, content = Factory().fetch(url)
@@ -108,32 +165,115 @@ class _CommonFetch(object):
             >>> status_code, mime_type, len(content)
             (200, 'text/html', 179982)
         """
-        url, payload = self.normalize(url), urllib.urlencode(payload)
-        status_code, mime_type, content = None, '', None
+        url, headers = self._begin(url, headers, etag, last_modified)
+        response = None
+        if url:
+            response = self._call(url, self._fetch, url,
+                                  payload=urllib.urlencode(payload),
+                                  headers=headers, deadline=deadline)
+        return self._end(url, response, status_codes, max_bytes, etag,
+                         last_modified)
+
+    def fetch_many(self, urls, headers={}, deadline=10,
+                   status_codes=FETCH_GOOD_STATUS_CODES,
+                   max_bytes=FETCH_MAX_BYTES, max_parallel=FETCH_MAX_PARALLEL,
+                   max_per_host=FETCH_MAX_PER_HOST):
+        """Retrieve many URLs' content at once.  Generate results as they come.
+
+        Fetch at most max_parallel URLs at a time, and at most max_per_host of
+        them from any one host.  For each URL, generate the URL as specified,
+        the fetch object that fetched it (with its truncated, charset, etc.
+        attributes), and what fetch would have returned for it, in the order
+        that the fetches complete.  Each fetch gives up after deadline seconds.
+
+        Example usage:
+            >>> urls = ['http://www.gutenberg.org/files/11/11-h/11-h.htm',
+            ...         'http://www.gutenberg.org/files/12/12-h/12-h.htm']
+            >>> results = Factory().fetch_many(urls)
+            >>> sorted([(url, result[1]) for url, fetcher, result in results])
+            [('http://www.gutenberg.org/files/11/11-h/11-h.htm', 200), ('http://www.gutenberg.org/files/12/12-h/12-h.htm', 200)]
+        """
+        pool = self._pool(headers, deadline, status_codes, max_bytes,
+                          min(max_parallel, len(urls)))
+        try:
+            for result in _schedule(urls, self._host, pool.start, pool.wait,
+                                    max_parallel, max_per_host):
+                yield result
+        finally:
+            pool.close()
+
+    def _begin(self, url, headers={}, etag=None, last_modified=None):
+        """Get ready to fetch a URL.  Return the normalized URL and headers.
+
+        If etag or last_modified is specified, then ask for the content only if
+        it's changed since (see fetch).
+        """
+        url = self.normalize(url)
+        self.truncated, self.charset = False, None
+        self.etag, self.last_modified, self.not_modified = None, None, False
+        headers = dict(headers)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
         if not url:
             _log.warning("couldn't fetch %s (couldn't normalize URL)" % url)
         else:
             _log.debug('fetching %s' % url)
-            try:
-                response = self._fetch(url, payload=payload, headers=headers,
-                                       deadline=deadline)
-            except self._exceptions, e:
-                # Oops.  Either the URL was invalid, or there was a problem
-                # retrieving the data.
-                _log.warning("couldn't fetch %s (%s)" % (url, type(e)))
-            else:
-                url, status_code, mime_type, content = self._grok(response, url)
-                if status_code not in status_codes:
-                    # Oops.  We retrieved some data, but the server returned an
-                    # unacceptable status code.
-                    _log.warning('fetched %s, but status code %s' %
-                                 (url, status_code))
-                    status_code, mime_type, content = None, '', None
-                _log.debug('fetched %s' % url)
-            if ';' in mime_type:
-                mime_type = mime_type.split(';', 1)[0]
+        return url, headers
+
+    def _call(self, url, method, *args, **kwds):
+        """Call a method that fetches a URL.  Return its response (or None)."""
+        try:
+            return method(*args, **kwds)
+        except self._exceptions, e:
+            # Oops.  Either the URL was invalid, or there was a problem
+            # retrieving the data.
+            _log.warning("couldn't fetch %s (%s)" % (url, type(e)))
+            return None
+
+    def _end(self, url, response, status_codes=FETCH_GOOD_STATUS_CODES,
+             max_bytes=FETCH_MAX_BYTES, etag=None, last_modified=None):
+        """Parse a URL's response (or None, if we couldn't fetch it)."""
+        status_code, mime_type, content = None, '', None
+        if response is not None:
+            url, status_code, mime_type, content, self.truncated = \
+                self._grok(response, url, max_bytes)
+            mime_type = mime_type or ''
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+            if status_code == 304 and (etag, last_modified) != (None, None):
+                # The content hasn't changed since we last fetched it, so
+                # neither have its validators (unless the server says so).
+                _log.debug("fetched %s, but it hasn't changed" % url)
+                content, self.not_modified = None, True
+                self.etag = self.etag or etag
+                self.last_modified = self.last_modified or last_modified
+            elif status_code not in status_codes:
+                # Oops.  We retrieved some data, but the server returned an
+                # unacceptable status code.
+                _log.warning('fetched %s, but status code %s' %
+                             (url, status_code))
+                status_code, mime_type, content = None, '', None
+                self.truncated = False
+            elif self.truncated:
+                _log.warning('fetched %s, but truncated it to %s bytes' %
+                             (url, max_bytes))
+            _log.debug('fetched %s' % url)
+        if ';' in mime_type:
+            self.charset = cgi.parse_header(mime_type)[1].get('charset')
+            mime_type = mime_type.split(';', 1)[0]
         return url, status_code, mime_type, content
 
+    def _host(self, url):
+        """Return the host that a URL points to (for fetch_many's limits).
+
+        Example usage:
+            >>> Factory()._host('HTTP://GOOGLE.COM:80/search')
+            'google.com'
+        """
+        return urlparse.urlsplit(self.normalize(url) or '')[1]
+
     def normalize(self, url):
         """Normalize a URL.
         
@@ -144,6 +284,22 @@ class _CommonFetch(object):
             >>> Factory().normalize('google.com')
             'http://google.com/'
         """
+        _normalized_lock.acquire()
+        try:
+            normalized = _normalized.get(url)
+        finally:
+            _normalized_lock.release()
+        if normalized is None:
+            normalized = self._normalize(url)
+            _normalized_lock.acquire()
+            try:
+                _normalized[url] = normalized
+            finally:
+                _normalized_lock.release()
+        return normalized
+
+    def _normalize(self, url):
+        """Normalize a URL (without looking in the cache)."""
         _log.debug('normalizing %s' % url)
         url = self._normalize_scheme(url)
 
@@ -286,8 +442,8 @@ class _CommonFetch(object):
             >>> Factory().normalize('google.com/a%Cc%bB%b2.html')
             'http://google.com/a%CC%BB%B2.html'
         """
-        esc_seq_reg_exp = r'%[0-9A-Fa-f]{2,2}'
-        url = re.sub(esc_seq_reg_exp, lambda m: m.group().upper(), url)
+        if '%' in url:
+            url = _ESCAPE_SEQUENCE.sub(_upper, url)
         return url
 
 
@@ -304,7 +460,16 @@ class _BaseFetch(_CommonFetch):
         """Pure virtual method to fetch a URL and return the response."""
         raise NotImplementedError
 
-    def _grok(self, response, url):
+    def _pool(self, headers, deadline, status_codes, max_bytes, max_parallel):
+        """Pure virtual method to return a pool to fetch many URLs at once.
+
+        The pool's start method starts fetching a URL, its wait method waits
+        for any URL to finish and returns the URL, its fetch object, and its
+        results, and its close method cleans up.  (See fetch_many.)
+        """
+        raise NotImplementedError
+
+    def _grok(self, response, url, max_bytes=FETCH_MAX_BYTES):
         """Pure virt method to parse a response status, MIME type, & content."""
         raise NotImplementedError
 
@@ -325,34 +490,501 @@ class _AppEngineFetch(_BaseFetch):
                          deadline=deadline)
         return response
 
-    def _grok(self, response, url):
-        """Parse a response's URL, status code, MIME type, and content."""
+    def _pool(self, headers, deadline, status_codes, max_bytes, max_parallel):
+        """Return a pool to fetch many URLs at once with asynchronous RPCs."""
+        return _RPCPool(self.__class__, headers, deadline, status_codes,
+                        max_bytes)
+
+    def _grok(self, response, url, max_bytes=FETCH_MAX_BYTES):
+        """Parse a response's URL, status code, MIME type, and content.
+
+        Also return whether the content was truncated - either by urlfetch
+        (which truncates huge responses) or to max_bytes.
+
+        urlfetch can't stream a response, so by now, it's already read all of
+        the content (up to urlfetch's own limit) into memory.  Truncating it to
+        max_bytes still keeps us from holding onto (and tagging) more than
+        that, but it doesn't save the memory that urlfetch used to read it.
+        """
         url = self.normalize(response.headers.get('location', url))
         status_code = response.status_code
         mime_type = response.headers.get('content-type')
-        content = response.content
-        return url, status_code, mime_type, content
+        content, truncated = _truncate(response.content, max_bytes)
+        truncated = truncated or response.content_was_truncated
+        return url, status_code, mime_type, content, truncated
 
 
 class _PythonFetch(_BaseFetch):
     """Python concrete URL fetch class."""
 
-    _exceptions = (urllib2.URLError,)
+    # With a deadline, a slow server raises a socket.timeout (a socket.error):
+    _exceptions = (urllib2.URLError, socket.error)
 
     def _fetch(self, url, payload='', headers={}, deadline=10):
-        """Fetch a URL and return the response."""
-        socket.setdefaulttimeout(deadline)
-        request = urllib2.Request(url, payload, headers)
-        response = urllib2.urlopen(request)
+        """Fetch a URL and return the response.
+
+        urllib2 raises an HTTPError for a 304 (not modified) status code, but
+        the error doubles as the response.
+        """
+        request = urllib2.Request(url, payload or None, headers)
+        try:
+            response = urllib2.urlopen(request, timeout=deadline)
+        except urllib2.HTTPError, e:
+            if e.code != 304:
+                raise
+            response = e
         return response
 
-    def _grok(self, response, url):
-        """Parse a response's URL, status code, MIME type, and content."""
+    def _grok(self, response, url, max_bytes=FETCH_MAX_BYTES):
+        """Parse a response's URL, status code, MIME type, and content.
+
+        Also return whether the content was truncated to max_bytes.  We read
+        one byte past max_bytes (and no further) to find out.
+        """
         url = self.normalize(response.geturl())
         status_code = response.code
         mime_type = response.headers.get('Content-Type')
-        content = response.read()
-        return url, status_code, mime_type, content
+        if max_bytes is None:
+            content = response.read()
+        else:
+            content = response.read(max_bytes + 1)
+        content, truncated = _truncate(content, max_bytes)
+        return url, status_code, mime_type, content, truncated
+
+    def _pool(self, headers, deadline, status_codes, max_bytes, max_parallel):
+        """Return a pool to fetch many URLs at once with a pool of threads."""
+        return _ThreadPool(self.__class__, headers, deadline, status_codes,
+                           max_bytes, max_parallel)
+
+
+class _ConnectionPool(object):
+    """Pool of idle keep-alive connections, per scheme and host.
+
+    Check a connection out with get, and once you've read the whole response,
+    check it back in with put.  Connections that sit idle for longer than
+    idle_secs get closed, and so do connections beyond max_idle per host.
+
+    Example usage:
+        >>> now = [0]
+        >>> pool = _ConnectionPool(max_idle=1, idle_secs=30,
+        ...                        clock=lambda: now[0])
+        >>> connection, reused = pool.get('http', 'google.com', 10)
+        >>> reused
+        False
+        >>> pool.put('http', 'google.com', connection)
+        >>> pool.get('http', 'google.com', 10) == (connection, True)
+        True
+        >>> pool.put('http', 'google.com', connection)
+        >>> now[0] = 31
+        >>> pool.get('http', 'google.com', 10)[1]
+        False
+        >>> sorted(pool.stats().items())
+        [('closed', 1), ('created', 2), ('idle', 0), ('reused', 1)]
+    """
+
+    def __init__(self, max_idle=FETCH_POOL_MAX_IDLE,
+                 idle_secs=FETCH_POOL_IDLE_SECS, clock=time.time):
+        """Start out with no connections."""
+        self._max_idle, self._idle_secs = max_idle, idle_secs
+        self._clock = clock
+        self._idle, self._lock = {}, threading.Lock()
+        self._stats = {'created': 0, 'reused': 0, 'closed': 0}
+
+    def get(self, scheme, host, timeout, fresh=False):
+        """Check out a connection to a host.  Return it and whether it's old.
+
+        Reuse the most recently used idle connection, unless fresh is True.
+        """
+        self._lock.acquire()
+        try:
+            self._evict()
+            idle = self._idle.get((scheme, host))
+            if idle and not fresh:
+                connection = idle.pop()[0]
+                self._stats['reused'] += 1
+            else:
+                connection = None
+                self._stats['created'] += 1
+        finally:
+            self._lock.release()
+        if connection is None:
+            Class = httplib.HTTPSConnection if scheme == 'https' else \
+                    httplib.HTTPConnection
+            return Class(host, timeout=timeout), False
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+
+    def put(self, scheme, host, connection):
+        """Check a connection back in, so that we can reuse it."""
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((scheme, host), [])
+            idle.append((connection, self._clock()))
+            while len(idle) > self._max_idle:
+                self._close(idle.pop(0)[0])
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def discard(self, connection):
+        """Close a checked out connection that we can't reuse."""
+        self._lock.acquire()
+        try:
+            self._close(connection)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return how many connections we've created, reused, and closed.
+
+        Also return how many are idle right now.
+        """
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['idle'] = sum([len(idle) for idle in self._idle.values()])
+        finally:
+            self._lock.release()
+        return stats
+
+    def _evict(self):
+        """Close the connections that have been idle for too long."""
+        oldest = self._clock() - self._idle_secs
+        for key, idle in self._idle.items():
+            while idle and idle[0][1] < oldest:
+                self._close(idle.pop(0)[0])
+            if not idle:
+                del self._idle[key]
+
+    def _close(self, connection):
+        """Close a connection."""
+        connection.close()
+        self._stats['closed'] += 1
+
+
+class _PooledFetch(_PythonFetch):
+    """Python concrete URL fetch class that keeps connections alive.
+
+    urllib2 opens a new connection (and for HTTPS, negotiates a new TLS
+    session) for every fetch.  Instead, talk HTTP/1.1 with httplib, and keep
+    each connection alive in a pool (shared by every instance and thread) for
+    the next fetch from the same host.  Follow redirects like urllib2 does.
+
+    Like _PythonFetch (which passes urllib2.urlopen a timeout), this needs
+    Python 2.6 or later, for httplib's connection timeouts.
+    """
+
+    _exceptions = (httplib.HTTPException, socket.error)
+    _connections = _ConnectionPool()
+
+    def _fetch(self, url, payload='', headers={}, deadline=10):
+        """Fetch a URL and return the response.
+
+        We read (at most _MAX_REDIRECT_BYTES of) each redirect's body, so that
+        we can reuse its connection.  If the body is any bigger than that, then
+        we close the connection instead.
+        """
+        method, headers = 'POST' if payload else 'GET', dict(headers)
+        headers.setdefault('User-Agent', 'Python-urllib/%s' %
+                           urllib2.__version__)
+        for redirect in range(_MAX_REDIRECTS + 1):
+            response = self._request(method, url, payload, headers, deadline)
+            location = response.headers.get('Location')
+            if response.code not in _REDIRECT_STATUS_CODES or not location:
+                return response
+            response.read(_MAX_REDIRECT_BYTES)
+            url = urlparse.urljoin(url, location)
+            if response.code != 307:
+                method, payload = 'GET', ''
+        raise httplib.HTTPException('too many redirects: %s' % url)
+
+    def _request(self, method, url, payload, headers, deadline):
+        """Make one request over a pooled connection.  Return the response.
+
+        If a reused connection fails, then the server probably closed it while
+        it was idle, so try once more over a fresh connection.
+        """
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        path = urlparse.urlunsplit(('', '', path or '/', query, ''))
+        fresh = False
+        while True:
+            connection, reused = self._connections.get(scheme, host, deadline,
+                                                       fresh=fresh)
+            try:
+                connection.request(method, path, payload or None, headers)
+                if _BUFFERING:
+                    # Otherwise, httplib reads the headers a byte at a time.
+                    # (We never pipeline requests, so there's nothing to
+                    # over-read.)
+                    response = connection.getresponse(buffering=True)
+                else:
+                    response = connection.getresponse()
+            except self._exceptions:
+                self._connections.discard(connection)
+                if not reused:
+                    raise
+                fresh = True
+            else:
+                return _PooledResponse(url, response, scheme, host,
+                                       connection, self._connections)
+
+
+class _PooledResponse(object):
+    """Response over a pooled connection, that looks like urllib2's.
+
+    Once we've read the whole response, we check the connection back in to
+    the pool.  (If we read only part of it, then we have to close the
+    connection instead.)
+    """
+
+    def __init__(self, url, response, scheme, host, connection, connections):
+        """Wrap an httplib response."""
+        self._url, self._response = url, response
+        self.code, self.headers = response.status, response.msg
+        self._scheme, self._host = scheme, host
+        self._connection, self._connections = connection, connections
+
+    def geturl(self):
+        """Return the URL that we fetched (after redirects)."""
+        return self._url
+
+    def read(self, amt=None):
+        """Read (at most amt bytes of) the content."""
+        try:
+            return self._response.read(amt)
+        finally:
+            self._release()
+
+    def _release(self):
+        """Check the connection back in (or close it) once we're done."""
+        if self._connection is not None:
+            if self._response.isclosed() and not self._response.will_close:
+                self._connections.put(self._scheme, self._host,
+                                      self._connection)
+            else:
+                self._connections.discard(self._connection)
+            self._connection = None
+
+
+def normalize_stats():
+    """Return the normalized URL cache's hit and miss counts and size."""
+    return {'hits': _normalized.hits, 'misses': _normalized.misses,
+            'size': len(_normalized)}
+
+
+def pool_stats():
+    """Return statistics about _PooledFetch's connections (see stats)."""
+    return _PooledFetch._connections.stats()
+
+
+class _RPCPool(object):
+    """Fetch many URLs at once with Google App Engine's asynchronous RPCs."""
+
+    def __init__(self, Class, headers, deadline, status_codes, max_bytes):
+        """Remember how to fetch each URL."""
+        self._Class, self._headers, self._deadline = Class, headers, deadline
+        self._status_codes, self._max_bytes = status_codes, max_bytes
+        self._started = []
+
+    def start(self, url):
+        """Start an RPC to fetch a URL."""
+        fetcher, rpc = self._Class(), None
+        normalized_url, headers = fetcher._begin(url, self._headers)
+        if normalized_url:
+            rpc = fetcher._call(normalized_url, self._rpc, normalized_url,
+                                headers)
+        self._started.append((url, fetcher, normalized_url, rpc))
+
+    def _rpc(self, url, headers):
+        """Create an RPC, and make it fetch a URL."""
+        rpc = create_rpc(deadline=self._deadline)
+        make_fetch_call(rpc, url, headers=headers, allow_truncated=True,
+                        follow_redirects=True)
+        return rpc
+
+    def wait(self):
+        """Wait for any RPC to finish.  Return its URL, fetcher, & results."""
+        rpcs = [started[3] for started in self._started]
+        if None in rpcs:
+            # We couldn't even start fetching this URL.
+            index = rpcs.index(None)
+        else:
+            index = rpcs.index(UserRPC.wait_any(rpcs))
+        url, fetcher, normalized_url, rpc = self._started.pop(index)
+        response = None
+        if rpc is not None:
+            response = fetcher._call(normalized_url, rpc.get_result)
+        return url, fetcher, fetcher._end(normalized_url, response,
+                                          self._status_codes, self._max_bytes)
+
+    def close(self):
+        """Forget about any RPCs that we're abandoning."""
+        self._started = []
+
+
+class _ThreadPool(object):
+    """Fetch many URLs at once with a pool of threads.
+
+    The threads are daemons, so that a pool that nobody closes can't keep us
+    from exiting.  But a daemon thread that's still running while the
+    interpreter shuts down dies noisily, so at exit, we stop every pool and
+    wait for its threads (see _stop_thread_pools).
+    """
+
+    _open = set()       # The pools that nobody has closed yet,
+    _working = set()    # and the threads that haven't stopped yet.
+
+    def __init__(self, Class, headers, deadline, status_codes, max_bytes,
+                 num_threads):
+        """Start the threads."""
+        self._Class, self._headers, self._deadline = Class, headers, deadline
+        self._status_codes, self._max_bytes = status_codes, max_bytes
+        self._urls, self._results, self._threads = Queue.Queue(), \
+            Queue.Queue(), []
+        for index in range(num_threads):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            self._working.add(thread)
+            thread.start()
+            self._threads.append(thread)
+        self._open.add(self)
+
+    def start(self, url):
+        """Hand a URL to the next free thread to fetch."""
+        self._urls.put(url)
+
+    def _work(self):
+        """Fetch URLs until told to stop (by None)."""
+        url = self._urls.get()
+        while url is not None:
+            fetcher, results, exc_info = self._Class(), None, None
+            try:
+                results = fetcher.fetch(url, headers=self._headers,
+                                        deadline=self._deadline,
+                                        status_codes=self._status_codes,
+                                        max_bytes=self._max_bytes)
+            except:
+                # Don't let the thread die - re-raise in the caller's thread.
+                exc_info = sys.exc_info()
+            self._results.put((url, fetcher, results, exc_info))
+            url = self._urls.get()
+        self._working.discard(threading.currentThread())
+
+    def wait(self):
+        """Wait for any thread to finish.  Return its URL, fetcher, results."""
+        url, fetcher, results, exc_info = self._results.get()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return url, fetcher, results
+
+    def close(self):
+        """Tell the threads to stop once they finish what they're fetching."""
+        if self in self._open:
+            self._open.discard(self)
+            for thread in self._threads:
+                self._urls.put(None)
+
+
+def _stop_thread_pools():
+    """Stop every pool of threads, and wait for the threads to finish.
+
+    A thread in the middle of a fetch finishes within the fetch's deadline.
+    """
+    for pool in list(_ThreadPool._open):
+        pool.close()
+    for thread in list(_ThreadPool._working):
+        thread.join()
+
+
+atexit.register(_stop_thread_pools)
+
+
+def _schedule(urls, host, start, wait, max_parallel=FETCH_MAX_PARALLEL,
+              max_per_host=FETCH_MAX_PER_HOST):
+    """Start fetching URLs within limits.  Generate results as they finish.
+
+    Keep at most max_parallel URLs in flight, and at most max_per_host of them
+    per host (according to host).  Otherwise, start the URLs in order.  start
+    starts fetching a URL, and wait waits for any URL to finish and returns
+    its results (the first of which must be the URL).
+
+    Example usage:
+        >>> in_flight, log = [], []
+        >>> def start(url):
+        ...     in_flight.append(url)
+        ...     log.append('start ' + url)
+        >>> def wait():
+        ...     log.append('done ' + in_flight[0])
+        ...     return (in_flight.pop(0),)
+        >>> urls = ['a/1', 'a/2', 'a/3', 'b/1', 'c/1']
+        >>> results = _schedule(urls, lambda url: url.split('/')[0], start,
+        ...                     wait, max_parallel=3, max_per_host=2)
+        >>> [url for url, in results]
+        ['a/1', 'a/2', 'b/1', 'a/3', 'c/1']
+        >>> log
+        ['start a/1', 'start a/2', 'start b/1', 'done a/1', 'start a/3', 'done a/2', 'start c/1', 'done b/1', 'done a/3', 'done c/1']
+    """
+    waiting, hosts, num_in_flight = {}, [], 0
+    for url in urls:
+        url_host = host(url)
+        if url_host not in waiting:
+            waiting[url_host] = collections.deque()
+            hosts.append(url_host)
+        waiting[url_host].append(url)
+    hosts_in_flight = dict([(url_host, 0) for url_host in hosts])
+    while hosts or num_in_flight:
+        # Start as many URLs as our limits allow, favoring the hosts whose URLs
+        # came first.
+        for url_host in hosts[:]:
+            while (waiting[url_host] and num_in_flight < max_parallel and
+                   hosts_in_flight[url_host] < max_per_host):
+                start(waiting[url_host].popleft())
+                num_in_flight += 1
+                hosts_in_flight[url_host] += 1
+            if not waiting[url_host]:
+                hosts.remove(url_host)
+        results = wait()
+        num_in_flight -= 1
+        hosts_in_flight[host(results[0])] -= 1
+        yield results
+
+
+def _upper(match):
+    """Uppercase a regular expression match."""
+    return match.group().upper()
+
+
+def _truncate(content, max_bytes):
+    """Cut content down to at most max_bytes.  Return it and whether we cut it.
+
+    Don't leave part of a UTF-8 character dangling off of the end, or the
+    whole page would fail to decode as UTF-8.  (If the page isn't UTF-8, then
+    we lose at most three more bytes.)
+
+    Example usage:
+        >>> _truncate('caf\xc3\xa9', 4)
+        ('caf', True)
+        >>> _truncate('caf\xc3\xa9!', 5)
+        ('caf\\xc3\\xa9', True)
+        >>> _truncate('caf\xc3\xa9', 5)
+        ('caf\\xc3\\xa9', False)
+    """
+    if max_bytes is None or len(content) <= max_bytes:
+        return content, False
+    content = content[:max_bytes]
+    for index in range(1, min(4, len(content)) + 1):
+        byte = ord(content[-index])
+        if byte & 0xC0 != 0x80:
+            # This is an ASCII character or a multi-byte character's first
+            # byte.  If it's the latter, then is the character complete?
+            length = 1 if byte < 0xC0 else 2 if byte < 0xE0 else \
+                     3 if byte < 0xF0 else 4
+            if index < length:
+                content = content[:-index]
+            break
+    return content, True
 
 
 class _MetaClass(type):
@@ -360,12 +992,12 @@ class _MetaClass(type):
 
     Since the following is a doctest, we know that we must be running this
     script in someone's development environment, i.e. not on Google App Engine.
-    Make sure that this meta-class, when instantiated, returns the straight
+    Make sure that this meta-class, when instantiated, returns the (pooled)
     Python concrete URL fetch class:
 
         >>> class_dict = {'__module__': '__main__', '__metaclass__': _MetaClass, '__doc__': ' '}
         >>> Class = _MetaClass('Factory', type.__bases__, class_dict)
-        >>> Class is _AppEngineFetch, Class is _PythonFetch
+        >>> Class is _AppEngineFetch, Class is _PooledFetch
         (False, True)
         >>> instance = _MetaClass('Factory', type.__bases__, class_dict)()
         >>> isinstance(instance, _AppEngineFetch), isinstance(instance, _PythonFetch)
@@ -376,6 +1008,8 @@ class _MetaClass(type):
         """ """
         if _on_app_engine:
             Class = _AppEngineFetch
+        elif FETCH_BACKEND == 'pooled':
+            Class = _PooledFetch
         else:
             Class = _PythonFetch
         return Class
@@ -134,12 +134,7 @@ def beautify_datetime(dt1):
 def style_tag(bookmark, word, size_prefix='size', color_prefix='color',
               scale=8):
     """For a bookmark & a word, compute the style (size & color) for the tag."""
-    try:
-        index = bookmark.words.index(word)
-    except ValueError:
-        count = 0
-    else:
-        count = bookmark.counts[index]
+    count = bookmark.word_counts().get(word, 0)
     value = str(int(math.ceil(scale * count) - 1))
     return size_prefix + value + ' ' + color_prefix + value
 
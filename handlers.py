@@ -130,6 +130,7 @@ class Users(base.RequestHandler):
         reference_to_delete = models.Reference.get_by_key_name(key, parent=bookmark) if key else None
         email_to_follow = self.request.get('email_to_follow')
         email_to_unfollow = self.request.get('email_to_unfollow')
+        url_to_poll = self.request.get('url_to_poll')
         method, args, return_value = None, None, None
 
         if url_to_create or reference_to_update or reference_to_delete:
@@ -138,6 +139,8 @@ class Users(base.RequestHandler):
         elif email_to_follow or email_to_unfollow:
             method = self._crud_following
             args = [email_to_follow, email_to_unfollow]
+        elif url_to_poll:
+            method, args = self._poll_pending_bookmark, [url_to_poll]
         else:
             _log.error('/users got POST request but no bookmark to create, '
                        'update, or delete and no user to follow or unfollow')
@@ -157,7 +160,8 @@ class Users(base.RequestHandler):
                 reference = self._create_bookmark(url_to_create)
             elif reference_to_update.user == current_user:
                 reference = self._update_bookmark(reference_to_update)
-                reference.updated = datetime.datetime.now()
+                if reference is not None:
+                    reference.updated = datetime.datetime.now()
             else:
                 reference = None
                 _log.error("couldn't update reference (insufficient privileges")
@@ -170,6 +174,21 @@ class Users(base.RequestHandler):
             else:
                 _log.error("couldn't delete reference (insufficient privileges")
 
+    def _poll_pending_bookmark(self, url_to_poll):
+        """Serve a pending bookmark once it's ingested, or nothing until then.
+
+        The browser polls this while it shows a pending bookmark, then swaps in
+        the bookmark's new snippet.
+        """
+        snippet = True
+        current_user = target_user = users.get_current_user()
+        reference = self._poll_bookmark(url_to_poll)
+        if reference is not None:
+            path = os.path.join(TEMPLATES, 'bookmarks', 'references.html')
+            references = [reference]
+            self.response.out.write(template.render(path, locals(),
+                                                    debug=DEBUG))
+
     def _crud_following(self, email_to_follow, email_to_unfollow):
         """Create or delete a following."""
         path = os.path.join(TEMPLATES, 'bookmarks', 'follower.html')
@@ -295,6 +314,44 @@ class LiveSearch(base.RequestHandler):
         return html
 
 
+class ReindexStopWords(base.RequestHandler):
+    """Request handler to re-tag bookmarks when the stop words change.
+
+    Cron requests this page every few minutes (see cron.yaml).  Each request
+    re-tags one batch of the affected bookmarks, if there are any.
+    """
+
+    def get(self):
+        """ """
+        done = self._reindex_stop_words()
+        self.response.out.write('done' if done else 'more')
+
+
+class CompactKeychains(base.RequestHandler):
+    """Request handler to merge pending postings into keychain shards.
+
+    Cron requests this page every minute (see cron.yaml).  Each request merges
+    one batch of the postings that indexing and unindexing appended.
+    """
+
+    def get(self):
+        """ """
+        done = self._compact_keychains()
+        self.response.out.write('done' if done else 'more')
+
+
+class IngestBookmark(base.RequestHandler):
+    """Request handler to fetch, tag, and index a pending bookmark.
+
+    The task queue POSTs each newly saved bookmark's URL to this page (see
+    ingest.py).
+    """
+
+    def post(self):
+        """ """
+        self._ingest_bookmark(self.request.get('url'))
+
+
 class Search(base.RequestHandler):
     """Request handler to serve search results pages."""
 
@@ -21,19 +21,31 @@
 """Bookmark saving and indexing logic."""
 
 
+import copy
 import logging
 
 from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.ext import webapp
 
+from config import MAINTENANCE, KEYCHAIN_IMPACTS, KEYCHAIN_NUM_SHARDS
+from config import KEYCHAIN_COMPACT_BATCH_SIZE
+from config import INGEST_ASYNC
+from config import REINDEX_BATCH_SIZE, REINDEX_STOP_WORDS_BATCH_SIZE
 import auto_tag
 import decorators
 import fetch
+import ingest
 import models
+import postings
+import stemmer
 
 
 _log = logging.getLogger(__name__)
+_MAX_BATCH = 500    # The most entities that one datastore call may touch.
+# The bookmark attributes that re-tagging a bookmark sets (see _retag_bookmark):
+_TAG_ATTRS = ('stems', 'words', 'counts', 'html_hash', 'stop_words_hash',
+              'truncated', 'etag', 'last_modified')
 
 
 class RequestHandler(webapp.RequestHandler):
@@ -51,6 +63,14 @@ class RequestHandler(webapp.RequestHandler):
             reference.bookmark = bookmark
             if exists['bookmark']:
                 reference = self._save_bookmark(reference)
+                if reference is None:
+                    # The bookmark was a pending placeholder, and we moved it
+                    # elsewhere in the meantime (see _move_references).  Now,
+                    # its URL is an alias of where we moved it to.
+                    return self._create_bookmark(url)
+            elif bookmark.pending:
+                reference = self._save_bookmark(reference)
+                ingest.Factory().add(args[0])
             else:
                 args = list(args) + [reference]
                 reference = self._common(*args)
@@ -58,12 +78,21 @@ class RequestHandler(webapp.RequestHandler):
         return reference
 
     def _update_bookmark(self, reference):
-        """Update the reference corresponding to the specified reference key."""
-        email, url = users.get_current_user().email(), reference.bookmark.url
+        """Update the reference corresponding to the specified reference key.
+
+        Re-fetch the bookmark conditionally (see auto_tag.tokenize_url).  If it
+        hasn't changed since we last fetched it, then we get back its old hash,
+        so we don't re-tag or re-index it.
+        """
+        email, bookmark = users.get_current_user().email(), reference.bookmark
+        url = bookmark.url
         _log.info('%s updating reference %s' % (email, url))
-        url, mime_type, title, words, html_hash = auto_tag.tokenize_url(url)
+        url, mime_type, title, words, html_hash, truncated, validators = \
+            auto_tag.tokenize_url(url, validators=(bookmark.etag,
+                                                   bookmark.last_modified),
+                                  html_hash=bookmark.html_hash or None)
         reference = self._common(url, mime_type, title, words, html_hash,
-                                 reference)
+                                 truncated, validators, reference)
         _log.info('%s updated reference %s' % (email, url))
         return reference
 
@@ -74,6 +103,9 @@ class RequestHandler(webapp.RequestHandler):
         unindex = self._unsave_bookmark(reference)
         if unindex:
             self._unindex_bookmark(reference.bookmark)
+            if reference.bookmark.doc_id is not None:
+                key_name = models.Document.key_name(reference.bookmark.doc_id)
+                db.delete(_keys(models.Document, [key_name]))
         _log.info('%s deleted reference %s' % (email, url))
 
     def _get_bookmark(self, url):
@@ -82,18 +114,30 @@ class RequestHandler(webapp.RequestHandler):
         url = fetch.Factory().normalize(url)
         exists = {'bookmark': True, 'reference': True,}
         _log.debug('%s getting/creating bookmark/reference %s' % (email, url))
-        bookmark_key = models.Bookmark.key_name(url)
-        bookmark = models.Bookmark.get_by_key_name(bookmark_key)
-        if bookmark is None:
+        url, bookmark = self._lookup_bookmark(url)
+        if bookmark is None and INGEST_ASYNC:
+            # Don't fetch the bookmark now.  Save a pending placeholder for it,
+            # and fetch it in the background (see _ingest_bookmark).
+            args = [url, '', None, None, None, False, (None, None)]
+            bookmark_key = models.Bookmark.key_name(url)
+            bookmark = models.Bookmark(key_name=bookmark_key, url=url,
+                                       pending=True)
+            exists['bookmark'] = False
+        elif bookmark is None:
             args = auto_tag.tokenize_url(url)
             bookmark_key = models.Bookmark.key_name(args[0])
             bookmark = models.Bookmark.get_by_key_name(bookmark_key)
             if bookmark is None:
                 bookmark = models.Bookmark(key_name=bookmark_key)
                 exists['bookmark'] = False
+            if args[0] != url:
+                # The URL redirected elsewhere (or declared a canonical URL).
+                # Next time, find its bookmark without fetching it.
+                db.put(_alias(url, args[0]))
         else:
             args = [bookmark.url, bookmark.mime_type, bookmark.title,
-                bookmark.words, bookmark.html_hash,]
+                bookmark.words, bookmark.html_hash, bookmark.truncated,
+                (bookmark.etag, bookmark.last_modified),]
         reference_key = models.Reference.key_name(email, args[0])
         reference = models.Reference.get_by_key_name(reference_key,
                                                      parent=bookmark)
@@ -104,7 +148,157 @@ class RequestHandler(webapp.RequestHandler):
         _log.debug('%s got/created bookmark/reference %s' % (email, args[0]))
         return email, args, bookmark, reference, exists
 
-    def _common(self, url, mime_type, title, words, html_hash, reference):
+    def _lookup_bookmark(self, url):
+        """Return a URL's bookmark, or the bookmark that the URL is an alias of.
+
+        Look up both the URL's bookmark and its alias (see models.Alias) in one
+        datastore call, so that once we've fetched a URL, bookmarking it again
+        never fetches it again.  Return the bookmark's URL and the bookmark (or
+        the URL and None if there's no bookmark yet).
+        """
+        keys = _keys(models.Bookmark, [models.Bookmark.key_name(url)])
+        keys += _keys(models.Alias, [models.Alias.key_name(url)])
+        bookmark, alias = db.get(keys)
+        if bookmark is None and alias is not None:
+            bookmark_key = models.Bookmark.key_name(alias.url)
+            bookmark = models.Bookmark.get_by_key_name(bookmark_key)
+            if bookmark is not None:
+                _log.debug('%s is an alias of bookmark %s' % (url, alias.url))
+                url = alias.url
+        return url, bookmark
+
+    def _ingest_bookmark(self, url):
+        """Fetch, tag, and index a pending bookmark (see ingest.py).
+
+        Everyone who saved the bookmark while it was pending has a reference to
+        its placeholder.  If the URL redirects elsewhere, then move those
+        references to the bookmark for where it redirects (see
+        _move_references).  Return the bookmark, or None if it's no longer
+        pending (someone updated or deleted it in the meantime).
+        """
+        bookmark_key = models.Bookmark.key_name(url)
+        bookmark = models.Bookmark.get_by_key_name(bookmark_key)
+        if bookmark is None or not bookmark.pending:
+            _log.info('not ingesting bookmark %s (no longer pending)' % url)
+            return None
+        _log.info('ingesting bookmark %s' % url)
+        args = auto_tag.tokenize_url(url)
+        reference_keys = [models.Reference.key_name(user.email(), url)
+                          for user in bookmark.users]
+        references = models.Reference.get_by_key_name(reference_keys,
+                                                      parent=bookmark)
+        references = [r for r in references if r is not None]
+        if not references:
+            _log.error('not ingesting bookmark %s (no references)' % url)
+            return None
+        if args[0] != url:
+            references = self._move_references(bookmark, references, args[0])
+        else:
+            for reference in references:
+                reference.bookmark = bookmark
+        reference = self._common(*(list(args) + [references[0]]))
+        if reference is None:
+            _log.warning("couldn't ingest bookmark %s (moved or deleted)" % url)
+            return None
+        _log.info('ingested bookmark %s' % args[0])
+        return reference.bookmark
+
+    def _move_references(self, placeholder, references, url):
+        """Move a placeholder's references to the bookmark for another URL.
+
+        Create the bookmark if it doesn't exist yet, and delete the placeholder.
+        Remember that the placeholder's URL is an alias of the bookmark, so that
+        the browsers waiting on it can find it (see _poll_bookmark), and so that
+        bookmarking the URL again doesn't fetch it again.  Return the moved
+        references.
+
+        People can keep saving the placeholder while we move it, so we only
+        delete it once we've moved everyone's references (see
+        _delete_placeholder).  After that, saving the placeholder saves the
+        bookmark instead (see _create_bookmark).
+        """
+        _log.debug('moving references from bookmark %s to %s' %
+                   (placeholder.url, url))
+        db.put(_alias(placeholder.url, url))
+        moved = []
+        while references:
+            moved.extend(self._copy_references(references, url))
+            references = self._delete_placeholder(placeholder.key(),
+                                                  [r.user for r in moved])
+        return moved
+
+    @decorators.run_in_transaction
+    def _copy_references(self, references, url):
+        """Copy references to the bookmark for a URL, and return the copies.
+
+        Create the bookmark if it doesn't exist yet.
+        """
+        bookmark_key = models.Bookmark.key_name(url)
+        bookmark = models.Bookmark.get_by_key_name(bookmark_key)
+        if bookmark is None:
+            bookmark = models.Bookmark(key_name=bookmark_key, url=url)
+        reference_keys = [models.Reference.key_name(r.user.email(), url)
+                          for r in references]
+        moved = models.Reference.get_by_key_name(reference_keys,
+                                                 parent=bookmark)
+        for index, (reference_key, reference) in enumerate(zip(reference_keys,
+                                                               references)):
+            if reference.user not in bookmark.users:
+                bookmark.users.append(reference.user)
+            if moved[index] is None:
+                moved[index] = models.Reference(parent=bookmark,
+                                                key_name=reference_key,
+                                                user=reference.user,
+                                                created=reference.created)
+            moved[index].bookmark = bookmark
+        bookmark.popularity = len(bookmark.users)
+        db.put([bookmark] + moved)
+        return moved
+
+    @decorators.run_in_transaction
+    def _delete_placeholder(self, placeholder_key, moved_users):
+        """Delete a placeholder whose references we've moved, and them.
+
+        Re-read the placeholder first.  If anyone else has saved it since we
+        read it, then don't delete it yet:  return their references, to move
+        them too.  If it's gone, or no longer pending (someone updated it in
+        the meantime), then leave it be.
+        """
+        placeholder = db.get(placeholder_key)
+        if placeholder is None or not placeholder.pending:
+            return []
+        reference_keys = [models.Reference.key_name(user.email(),
+                                                    placeholder.url)
+                          for user in placeholder.users
+                          if user not in moved_users]
+        references = models.Reference.get_by_key_name(reference_keys,
+                                                      parent=placeholder)
+        references = [r for r in references if r is not None]
+        if references:
+            return references
+        reference_keys = [models.Reference.key_name(user.email(),
+                                                    placeholder.url)
+                          for user in placeholder.users]
+        references = models.Reference.get_by_key_name(reference_keys,
+                                                      parent=placeholder)
+        db.delete([r for r in references if r is not None] + [placeholder])
+        return []
+
+    def _poll_bookmark(self, url):
+        """Return the current user's reference for a bookmark once ingested.
+
+        Return None while the bookmark is still pending (or if it's gone).
+        """
+        email = users.get_current_user().email()
+        # Maybe we ingested the bookmark, and it redirected elsewhere.
+        url, bookmark = self._lookup_bookmark(fetch.Factory().normalize(url))
+        if bookmark is None or bookmark.pending:
+            return None
+        reference_key = models.Reference.key_name(email, url)
+        return models.Reference.get_by_key_name(reference_key, parent=bookmark)
+
+    def _common(self, url, mime_type, title, words, html_hash, truncated,
+                validators, reference):
         """Perform the operations common to creating / updating references."""
         reindex = reference.bookmark.html_hash != html_hash
         if reindex:
@@ -116,42 +310,66 @@ class RequestHandler(webapp.RequestHandler):
         else:
             _log.debug("not re-tagging and re-indexing bookmark %s "
                        "(HTML hasn't changed since last)" % url)
-            tags = []
+            tags, stop_words_hash = [], None
         reference = self._populate_bookmark(url, mime_type, title, tags,
-                                            html_hash, reference)
-        if reindex:
+                                            html_hash, reference,
+                                            stop_words_hash=stop_words_hash,
+                                            truncated=truncated,
+                                            validators=validators)
+        if reindex and reference is not None:
             self._index_bookmark(reference.bookmark)
             _log.debug('re-tagged and re-indexed bookmark %s' % url)
         return reference
 
     def _populate_bookmark(self, url, mime_type, title, tags, html_hash,
-                           reference):
+                           reference, stop_words_hash=None, truncated=False,
+                           validators=(None, None)):
         """Update all of a referenced bookmark's attributes."""
-        current_user, bookmark = users.get_current_user(), reference.bookmark
-        _log.debug('%s populating bookmark %s' % (current_user.email(), url))
+        email, bookmark = _email(), reference.bookmark
+        _log.debug('%s populating bookmark %s' % (email, url))
         if bookmark.html_hash != html_hash:
             bookmark.url, bookmark.mime_type = url, mime_type
             bookmark.title = title
-            bookmark.stems, bookmark.words, bookmark.counts = [], [], []
-            for tag in tags:
-                bookmark.stems.append(tag['stem'])
-                bookmark.words.append(tag['word'])
-                bookmark.counts.append(tag['count'])
+            _set_tags(bookmark, tags)
             bookmark.html_hash = html_hash
-        reference = self._save_bookmark(reference)
-        _log.debug('%s populated bookmark %s' % (current_user.email(), url))
+            bookmark.stop_words_hash = stop_words_hash
+            bookmark.truncated = truncated
+        bookmark.etag, bookmark.last_modified = validators
+        bookmark.pending = False
+        if bookmark.doc_id is None:
+            bookmark.doc_id = models.Document.allocate_doc_ids(1)[0]
+        reference = self._save_bookmark(reference, populated=True)
+        _log.debug('%s populated bookmark %s' % (email, url))
         return reference
 
     @decorators.run_in_transaction
-    def _save_bookmark(self, reference):
-        """Update only a referenced bookmark's user list and popularity."""
+    def _save_bookmark(self, reference, populated=False):
+        """Update only a referenced bookmark's user list and popularity.
+
+        Re-read the bookmark in the transaction, so that we never overwrite
+        anyone else's concurrent save (or a background ingest) with our stale
+        copy:  keep the stored user list, and unless we've just populated the
+        bookmark, save the stored bookmark rather than ours.  If the bookmark
+        was deleted since we read it, then save nothing and return None.
+
+        With no current user (when ingesting a bookmark in the background), the
+        user list stays as is.
+        """
         current_user, bookmark = users.get_current_user(), reference.bookmark
-        url, to_put = bookmark.url, [bookmark, reference]
-        _log.debug('%s saving bookmark %s' % (current_user.email(), url))
-        if current_user not in bookmark.users:
+        stored = db.get(bookmark.key())
+        if stored is None and bookmark.is_saved():
+            _log.warning("couldn't save bookmark %s (deleted)" % bookmark.url)
+            return None
+        if stored is not None and populated:
+            bookmark.users = stored.users
+        elif stored is not None:
+            bookmark = reference.bookmark = stored
+        url, to_put, email = bookmark.url, [bookmark, reference], _email()
+        _log.debug('%s saving bookmark %s' % (email, url))
+        if current_user is not None and current_user not in bookmark.users:
             bookmark.users.append(current_user)
         bookmark.popularity = len(bookmark.users)
-        _log.debug('%s saved bookmark %s' % (current_user.email(), url))
+        _log.debug('%s saved bookmark %s' % (email, url))
         db.put(to_put)
         return reference
 
@@ -169,50 +387,863 @@ class RequestHandler(webapp.RequestHandler):
         db.delete(to_delete)
         return not bookmark.popularity
 
-    def _index_bookmark(self, bookmark):
+    def _index_bookmark(self, bookmark, datastore=None):
         """Index a bookmark so that it appears in search results.
 
         For each stem in the bookmark, make sure a corresponding keychain
-        exists.  If it doesn't exist, create it.  Then add the bookmark's key to
-        that keychain.
+        exists.  If it doesn't exist, create it.  Then append a posting that
+        adds the bookmark's document ID to the one keychain shard responsible
+        for that bookmark (see models.KeychainPosting).  We never read or
+        rewrite the shard itself, so concurrent requests indexing other
+        bookmarks into the same shard can't lose each other's postings.
+
+        No matter how many stems the bookmark has, this costs three datastore
+        round trips:  one batch get for the keychains, one batch put, and one
+        more batch get to make sure that nobody deleted the keychains in the
+        meantime.  (Plus one more if the bookmark doesn't have a document ID
+        yet, and a transaction for each keychain that predates sharding.)
+        Return the number of round trips.  Against a stand-in datastore, a
+        bookmark with one stem costs as many as a bookmark with sixty, and so
+        does unindexing them:
+
+            >>> class Store(dict):
+            ...     def get(self, keys):
+            ...         return [dict.get(self, key) for key in keys]
+            ...     def put(self, entities):
+            ...         self.update([(e.key(), e) for e in entities])
+            >>> def round_trips(num_stems):
+            ...     stems = ['stem%d' % stem for stem in range(num_stems)]
+            ...     url = 'http://example.com/%d' % num_stems
+            ...     bookmark = models.Bookmark(url=url, stems=stems,
+            ...         key_name=models.Bookmark.key_name(url), words=stems,
+            ...         counts=[1.0] * num_stems, doc_id=num_stems)
+            ...     store, handler = Store(), RequestHandler()
+            ...     index = _Datastore(get=store.get, put=store.put)
+            ...     unindex = _Datastore(get=store.get, put=store.put)
+            ...     return (handler._index_bookmark(bookmark, index),
+            ...             handler._unindex_bookmark(bookmark, unindex))
+            >>> round_trips(1), round_trips(60)
+            ((3, 3), (3, 3))
         """
-        email, url = users.get_current_user().email(), bookmark.url
+        email, url = _email(), bookmark.url
         _log.debug('%s indexing bookmark %s' % (email, url))
+        if datastore is None:
+            datastore = _Datastore()
         bookmark_key, to_put = bookmark.key(), []
-        for stem, word in zip(bookmark.stems, bookmark.words):
-            keychain_key = models.Keychain.key_name(stem)
-            keychain = models.Keychain.get_or_insert(keychain_key)
-            keychain.stem, keychain.word = stem, word
-            if not bookmark_key in keychain.keys:
-                keychain.keys.append(bookmark_key)
-            keychain.popularity = len(keychain.keys)
-            to_put.append(keychain)
-        _log.debug('%s indexed bookmark %s' % (email, url))
-        db.put(to_put)
+        if bookmark.doc_id is None:
+            bookmark.doc_id = datastore.allocate_doc_ids(1)[0]
+            to_put.append(bookmark)
+        document_key = models.Document.key_name(bookmark.doc_id)
+        to_put.append(models.Document(key_name=document_key,
+                                      bookmark=bookmark))
+        keychains = self._get_keychains(datastore, bookmark.stems)
+        for index, (stem, word, count) in enumerate(zip(bookmark.stems,
+                                                        bookmark.words,
+                                                        bookmark.counts)):
+            keychain = keychains[index]
+            if keychain is None:
+                # Racing another request to create this keychain is harmless:
+                # we'd both write the same header.
+                keychain_key = models.Keychain.key_name(stem)
+                keychain = models.Keychain(key_name=keychain_key, stem=stem,
+                    word=word, num_shards=KEYCHAIN_NUM_SHARDS)
+                keychains[index] = keychain
+                to_put.append(keychain)
+            elif keychain.num_shards is None:
+                keychain = datastore.transact(self._pin_keychain, stem)
+                keychains[index] = keychain
+            shard_key = keychain.shard_key_name(bookmark_key)
+            to_put.append(_posting(stem, shard_key, bookmark.doc_id, count))
+        datastore.put(to_put)
+        # If compacting emptied one of our keychains meanwhile, then it may
+        # have deleted the keychain (see _update_keychains).  If so, then put
+        # the keychain back.
+        stored = self._get_keychains(datastore, bookmark.stems)
+        deleted = [k for k, s in zip(keychains, stored) if s is None]
+        for keychain in deleted:
+            keychain.keys = []
+        datastore.put(deleted)
+        _log.debug('%s indexed bookmark %s (%s datastore round trips)' %
+                   (email, url, datastore.rpcs))
+        return datastore.rpcs
 
-    def _unindex_bookmark(self, bookmark):
+    @decorators.run_in_transaction
+    def _pin_keychain(self, stem):
+        """Pin the number of shards of a keychain that predates sharding.
+
+        That way, its bookmarks always hash to the same shards.  Return the
+        keychain.
+        """
+        keychain = models.Keychain.get_by_key_name(models.Keychain.key_name(
+            stem))
+        if keychain.num_shards is None:
+            keychain.num_shards = KEYCHAIN_NUM_SHARDS
+            db.put(keychain)
+        return keychain
+
+    def _unindex_bookmark(self, bookmark, datastore=None):
         """Unindex a bookmark so that it no longer appears in search results.
 
-        For each stem in the bookmark, remove the bookmark's key from the
-        keychain corresponding to the stem.  Then if the keychain no longer
-        contains any keys at all, delete the keychain itself.
+        For each stem in the bookmark, append a posting that removes the
+        bookmark from the keychain shard responsible for it (see
+        _index_bookmark), and remove the bookmark from the keychain itself, if
+        the keychain predates sharding.  Once we've merged the postings (see
+        _compact_keychains), we delete any shards and keychains that no longer
+        contain any bookmarks at all.
+
+        Like indexing, this costs three datastore round trips no matter how
+        many stems:  one batch get for the keychains, one for their shards and
+        postings, and one batch put.  (Plus a transaction for each keychain or
+        shard that still holds the bookmark's key from before we sharded or
+        compressed it.)  Return the number of round trips (see
+        _index_bookmark).
         """
-        email, url = users.get_current_user().email(), bookmark.url
+        email, url = _email(), bookmark.url
         _log.debug('%s unindexing bookmark %s' % (email, url))
-        bookmark_key, to_put, to_delete = bookmark.key(), [], []
-        for stem in bookmark.stems:
-            keychain_key = models.Keychain.key_name(stem)
-            keychain = models.Keychain.get_by_key_name(keychain_key)
+        if datastore is None:
+            datastore = _Datastore()
+        bookmark_key, doc_id, to_put = bookmark.key(), bookmark.doc_id, []
+        keychains = self._get_keychains(datastore, bookmark.stems)
+        sharded = [k for k in keychains if k is not None and k.num_shards]
+        shard_keys = [k.shard_key_name(bookmark_key) for k in sharded]
+        keys = _keys(models.KeychainShard, shard_keys)
+        if doc_id is not None:
+            posting_key = models.KeychainPosting.key_name(doc_id)
+            keys += [db.Key.from_path(models.KeychainPosting.kind(),
+                                      posting_key, parent=shard)
+                     for shard in keys]
+        entities = datastore.get(keys)
+        shards = dict(zip(shard_keys, entities[:len(shard_keys)]))
+        pending = dict(zip(shard_keys, entities[len(shard_keys):]))
+        for stem, keychain in zip(bookmark.stems, keychains):
+            if keychain is None:
+                continue
+            found = False
+            if bookmark_key in keychain.keys:
+                datastore.transact(self._remove_from_keychain, stem,
+                                   [bookmark_key])
+                found = True
+            if keychain.num_shards:
+                shard_key = keychain.shard_key_name(bookmark_key)
+                shard, posting = shards[shard_key], pending.get(shard_key)
+                if shard is not None and bookmark_key in shard.keys:
+                    datastore.transact(self._remove_from_shard, shard_key,
+                                       bookmark)
+                    found = True
+                if doc_id is not None:
+                    if shard is not None and postings.contains(
+                        postings.decode(shard.doc_ids), doc_id):
+                        found = True
+                    if posting is not None and not posting.removed:
+                        found = True
+                    to_put.append(_posting(stem, shard_key, doc_id,
+                                           removed=True))
+            if not found:
+                keychain_key = models.Keychain.key_name(stem)
+                msg = "bookmark %s has stem %s, "
+                msg += "but keychain %s doesn't have bookmark %s"
+                msg = msg % (bookmark_key, stem, keychain_key, bookmark_key)
+                _log.critical(msg)
+        datastore.put(to_put)
+        _log.debug('%s unindexed bookmark %s (%s datastore round trips)' %
+                   (email, url, datastore.rpcs))
+        return datastore.rpcs
+
+    @decorators.run_in_transaction
+    def _remove_from_keychain(self, stem, bookmark_keys):
+        """Remove bookmark keys from a keychain that predates sharding.
+
+        If the keychain has no shards and no more bookmark keys, then delete
+        it.
+        """
+        keychain_key = models.Keychain.key_name(stem)
+        keychain = models.Keychain.get_by_key_name(keychain_key)
+        if keychain is None:
+            return
+        bookmark_keys = set(bookmark_keys)
+        keys = [key for key in keychain.keys if key not in bookmark_keys]
+        if keys == keychain.keys:
+            return
+        keychain.keys = keys
+        keychain.popularity = max(keychain.popularity - len(bookmark_keys), 0)
+        if keys or keychain.num_shards:
+            db.put(keychain)
+        else:
+            db.delete(keychain)
+
+    @decorators.run_in_transaction
+    def _remove_from_shard(self, shard_key, bookmark):
+        """Remove a bookmark from a shard that predates compression.
+
+        If the shard no longer contains any bookmarks, then delete it.
+        """
+        shard = models.KeychainShard.get_by_key_name(shard_key)
+        if shard is None or not self._unindex_from_shard(bookmark, shard):
+            return
+        if shard.popularity:
+            db.put(shard)
+        else:
+            db.delete(shard)
+
+    def _unindex_from_shard(self, bookmark, shard):
+        """Remove a bookmark from a shard.  Return whether it was there."""
+        found, doc_ids = False, postings.decode(shard.doc_ids)
+        if bookmark.doc_id is not None and postings.remove(doc_ids,
+                                                           bookmark.doc_id):
+            shard.doc_ids = postings.encode(doc_ids)
+            found = True
+        if shard.impacts and bookmark.doc_id is not None:
+            impacts = postings.decode_impacts(shard.impacts)
+            shard.impacts = postings.encode_impacts(
+                [p for p in impacts if p[1] != bookmark.doc_id])
+        if bookmark.key() in shard.keys:
+            shard.keys.remove(bookmark.key())
+            found = True
+        shard.popularity = len(doc_ids) + len(shard.keys)
+        return found
+
+    def _migrate_keychain(self, stem):
+        """Migrate a keychain's bookmark keys into compressed document IDs.
+
+        Keychains written before we sharded them hold bookmark keys in the
+        keychain itself, and shards written before we compressed them hold
+        bookmark keys in the shard.  Move all of those bookmarks into the
+        compressed document ID lists of the shards responsible for them,
+        allocating document IDs for any bookmarks that don't have them yet.
+
+        We update each shard in its own transaction (see _migrate_shard), and
+        only then remove the bookmark keys from the keychain, so that the
+        bookmarks never drop out of search results.
+
+        Return the number of bookmarks migrated.
+        """
+        datastore = _Datastore()
+        keychain = self._get_keychains(datastore, [stem])[0]
+        if keychain is None:
+            return 0
+        _log.debug('migrating keychain %s' % stem)
+        if keychain.num_shards is None:
+            keychain = datastore.transact(self._pin_keychain, stem)
+        shard_keys = keychain.shard_key_names()
+        shards = datastore.get(_keys(models.KeychainShard, shard_keys))
+        bookmark_keys = list(keychain.keys)
+        for shard in shards:
+            if shard is not None:
+                bookmark_keys.extend(shard.keys)
+        bookmarks = [b for b in datastore.get(bookmark_keys) if b is not None]
+        unnumbered = [b for b in bookmarks if b.doc_id is None]
+        doc_ids = datastore.allocate_doc_ids(len(unnumbered))
+        to_put = []
+        for bookmark, doc_id in zip(unnumbered, doc_ids):
+            bookmark.doc_id = doc_id
+            document_key = models.Document.key_name(doc_id)
+            to_put.extend([bookmark, models.Document(key_name=document_key,
+                                                     bookmark=bookmark)])
+        datastore.put(to_put)
+        shards_to_doc_ids = {}
+        for bookmark in bookmarks:
+            shard_key = keychain.shard_key_name(bookmark.key())
+            shards_to_doc_ids.setdefault(shard_key, []).append(bookmark.doc_id)
+        for shard_key, shard in zip(shard_keys, shards):
+            if shard_key in shards_to_doc_ids or shard and shard.keys:
+                datastore.transact(self._migrate_shard, shard_key, stem,
+                                   shards_to_doc_ids.get(shard_key, []),
+                                   bookmark_keys)
+        if keychain.keys:
+            datastore.transact(self._remove_from_keychain, stem, keychain.keys)
+        _log.debug('migrated keychain %s (%s bookmarks)' % (stem,
+                                                             len(bookmarks)))
+        return len(bookmarks)
+
+    @decorators.run_in_transaction
+    def _migrate_shard(self, shard_key, stem, doc_ids, bookmark_keys):
+        """Add document IDs to a keychain shard, and remove bookmark keys.
+
+        If the shard no longer contains any bookmarks, then delete it.
+        """
+        shard = models.KeychainShard.get_by_key_name(shard_key)
+        if shard is None:
+            shard = models.KeychainShard(key_name=shard_key, stem=stem)
+        shard_doc_ids = postings.decode(shard.doc_ids)
+        for doc_id in doc_ids:
+            postings.add(shard_doc_ids, doc_id)
+        shard.doc_ids = postings.encode(shard_doc_ids)
+        bookmark_keys = set(bookmark_keys)
+        shard.keys = [key for key in shard.keys if key not in bookmark_keys]
+        shard.popularity = len(shard_doc_ids) + len(shard.keys)
+        if shard.popularity:
+            db.put(shard)
+        elif shard.is_saved():
+            db.delete(shard)
+
+    def _compact_keychains(self, batch_size=KEYCHAIN_COMPACT_BATCH_SIZE):
+        """Merge a batch of pending postings into their keychain shards.
+
+        Indexing and unindexing bookmarks only append postings (see
+        _index_bookmark), so this runs in the background (see
+        handlers.CompactKeychains).  We merge each shard's postings in a
+        transaction (see _compact_shard), then bring the popularity of the
+        shards' keychains up to date, and delete the keychains that no longer
+        contain any bookmarks (see _update_keychains).  Return whether there's
+        nothing left to compact.
+        """
+        keys = models.KeychainPosting.all(keys_only=True).fetch(batch_size)
+        shards_to_keys = {}
+        for key in keys:
+            shards_to_keys.setdefault(key.parent().name(), []).append(key)
+        stems = set()
+        for shard_key in sorted(shards_to_keys):
+            stem = self._compact_shard(shard_key, shards_to_keys[shard_key])
+            if stem is not None:
+                stems.add(stem)
+        self._update_keychains(sorted(stems))
+        _log.info('compacted %s postings into %s shards' %
+                  (len(keys), len(shards_to_keys)))
+        return len(keys) < batch_size
+
+    @decorators.run_in_transaction
+    def _compact_shard(self, shard_key, posting_keys):
+        """Merge pending postings into a keychain shard, and delete them.
+
+        The postings live in the shard's entity group, so if anyone appends a
+        posting to the shard while we're at it, then we retry.  If the shard
+        no longer contains any bookmarks, then delete it.  Return the shard's
+        stem (or None, if somebody else merged the postings already).
+        """
+        pending = [p for p in db.get(posting_keys) if p is not None]
+        if not pending:
+            return None
+        stem = pending[0].stem
+        shard = models.KeychainShard.get_by_key_name(shard_key)
+        if shard is None:
+            shard = models.KeychainShard(key_name=shard_key, stem=stem)
+        doc_ids, changed = postings.decode(shard.doc_ids), set()
+        for posting in pending:
+            changed.add(posting.doc_id)
+            if posting.removed:
+                postings.remove(doc_ids, posting.doc_id)
+            else:
+                postings.add(doc_ids, posting.doc_id)
+        shard.doc_ids = postings.encode(doc_ids)
+        if shard.impacts or KEYCHAIN_IMPACTS:
+            impacts = [p for p in postings.decode_impacts(shard.impacts)
+                       if p[1] not in changed]
+            if KEYCHAIN_IMPACTS:
+                impacts.extend([(postings.quantize(p.count), p.doc_id)
+                                for p in pending if not p.removed])
+            shard.impacts = postings.encode_impacts(impacts)
+        shard.popularity = len(doc_ids) + len(shard.keys)
+        if shard.popularity:
+            db.put(shard)
+        elif shard.is_saved():
+            db.delete(shard)
+        db.delete(pending)
+        return stem
+
+    def _update_keychains(self, stems):
+        """Update keychains' popularity, and delete the empty keychains.
+
+        Another request may be indexing a bookmark into an empty keychain at
+        the same time.  So once we've deleted the keychains, we look for their
+        shards and postings again, and if the other request has added either
+        since, then we put the keychain back.  (The other request checks
+        whether we've deleted its keychains too - see _index_bookmark.)
+        """
+        datastore = _Datastore()
+        keychains = self._get_keychains(datastore, stems)
+        keychains = [k for k in keychains if k is not None]
+        deleted = []
+        for keychain, shards in self._get_shards(datastore, keychains):
+            popularity = sum([s.popularity for s in shards if s is not None])
+            if datastore.transact(self._update_keychain, keychain.stem,
+                                  popularity, _pending(keychain.stem)):
+                deleted.append(keychain)
+        refilled = []
+        for keychain, shards in self._get_shards(datastore, deleted):
+            if shards != [None] * len(shards) or _pending(keychain.stem):
+                refilled.append(keychain)
+        datastore.put(refilled)
+
+    def _get_shards(self, datastore, keychains):
+        """Batch get the keychains' shards.  Return (keychain, shards) pairs."""
+        shard_keys = []
+        for keychain in keychains:
+            shard_keys.extend(keychain.shard_key_names())
+        shards = datastore.get(_keys(models.KeychainShard, shard_keys))
+        pairs = []
+        for keychain in keychains:
+            num_shards = len(keychain.shard_key_names())
+            pairs.append((keychain, shards[:num_shards]))
+            shards = shards[num_shards:]
+        return pairs
+
+    @decorators.run_in_transaction
+    def _update_keychain(self, stem, popularity, pending):
+        """Set a keychain's popularity to its shards' popularity.
+
+        Count any bookmark keys that the keychain still holds too.  If the
+        keychain holds no bookmarks at all, and no postings are pending for
+        it, then delete it.  Return whether we deleted it.
+        """
+        keychain_key = models.Keychain.key_name(stem)
+        keychain = models.Keychain.get_by_key_name(keychain_key)
+        if keychain is None:
+            return False
+        popularity += len(keychain.keys)
+        if not popularity and not pending:
+            db.delete(keychain)
+            return True
+        if keychain.popularity != popularity:
+            keychain.popularity = popularity
+            db.put(keychain)
+        return False
+
+    def _reindex_stop_words(self, batch_size=REINDEX_STOP_WORDS_BATCH_SIZE):
+        """Re-tag only the bookmarks that changes to the stop words affect.
+
+        We remember each list of stop words that we've tagged with, and each
+        bookmark remembers the hash of the list that it was tagged with.  When
+        words are added to the stop words, a bookmark's tags can only change
+        if it has the stem of an added word.  So we look up those stems'
+        keychains to find the affected bookmarks, then re-tag and re-index
+        only those bookmarks.  But a bookmark that contains a removed stop
+        word has no stem for it, so we can't find it this way.  If any words
+        were removed, then we re-tag every bookmark instead.
+
+        This runs in the background (see handlers.ReindexStopWords), one batch
+        of bookmarks per call, with a checkpoint between batches.  Once we've
+        re-tagged every affected bookmark, we forget every other list of stop
+        words and the checkpoint, so the stop words are up to date exactly
+        when they're the only list that we remember.  Return whether there's
+        nothing left to re-tag.
+        """
+        stop_words, stop_words_hash = auto_tag.read_stop_words()
+        if stop_words_hash is None:
+            return True
+        current_key = db.Key.from_path(models.StopWords.kind(),
+            models.StopWords.key_name(stop_words_hash))
+        stop_words_keys = models.StopWords.all(keys_only=True).fetch(_MAX_BATCH)
+        old_keys = [key for key in stop_words_keys if key != current_key]
+        key_name = models.Checkpoint.key_name(current_key.name())
+        checkpoint = models.Checkpoint.get_by_key_name(key_name)
+        if checkpoint is not None and checkpoint.phase == 'done':
+            # Left over from before we forgot finished checkpoints.
+            checkpoint = None
+        if checkpoint is None:
+            if stop_words_keys == [current_key]:
+                return True
+            # The stop words changed, maybe back to a list that we re-tagged
+            # for before, or while we were re-tagging for another list.  Start
+            # over:  this run re-tags every bookmark that any other list could
+            # have affected, so forget the other lists' unfinished runs.
+            db.delete(_keys(models.Checkpoint, [models.Checkpoint.key_name(
+                key.name()) for key in old_keys]))
+            doc_ids = self._find_stop_words_changes(stop_words,
+                                                    stop_words_hash)
+            if doc_ids is None:
+                checkpoint = models.Checkpoint(key_name=key_name, phase='all')
+                _log.info('stop words removed - re-tagging every bookmark')
+            else:
+                checkpoint = models.Checkpoint(key_name=key_name,
+                    phase='retag', doc_ids=postings.encode(doc_ids))
+                _log.info('stop words changed - %s bookmarks to re-tag' %
+                          len(doc_ids))
+            checkpoint.put()
+        if checkpoint.phase == 'all':
+            query = models.Bookmark.all()
+            if checkpoint.cursor is not None:
+                query.with_cursor(checkpoint.cursor)
+            batch = query.fetch(batch_size)
+            checkpoint.cursor = query.cursor()
+            done, left = len(batch) < batch_size, 'more'
+            # Pending bookmarks get tagged with these stop words once they're
+            # ingested.
+            bookmarks = [b for b in batch if not b.pending]
+        else:
+            doc_ids = postings.decode(checkpoint.doc_ids)
+            batch, doc_ids = doc_ids[:batch_size], doc_ids[batch_size:]
+            checkpoint.doc_ids = postings.encode(doc_ids)
+            done, left = not doc_ids, len(doc_ids)
+            document_keys = [models.Document.key_name(doc_id)
+                             for doc_id in batch]
+            documents = db.get(_keys(models.Document, document_keys))
+            bookmark_keys = [
+                models.Document.bookmark.get_value_for_datastore(d)
+                for d in documents if d is not None]
+            bookmarks = [b for b in db.get(bookmark_keys) if b is not None]
+        # Skip the bookmarks that we re-tagged already (before crashing in the
+        # middle of this batch).
+        bookmarks = [b for b in bookmarks
+                     if b.stop_words_hash != stop_words_hash]
+        tokens = _tokenize_bookmarks(bookmarks)
+        for bookmark in bookmarks:
+            if _retag_bookmark(bookmark, stop_words, stop_words_hash,
+                               tokens[bookmark.url]):
+                retagged = self._save_tags(bookmark)
+                if retagged is not None:
+                    old, stored = retagged
+                    self._unindex_bookmark(old)
+                    self._index_bookmark(stored)
+        checkpoint.num_bookmarks += len(batch)
+        if not done:
+            checkpoint.put()
+        else:
+            # Every bookmark that any older stop words could have affected is
+            # now up to date, so we only have to compare against these stop
+            # words from now on.
+            db.delete(old_keys + [checkpoint])
+            left = 0
+        _log.info('re-tagged %s bookmarks for stop words (%s left)' %
+                  (checkpoint.num_bookmarks, left))
+        return done
+
+    @decorators.run_in_transaction
+    def _save_tags(self, bookmark):
+        """Save only a re-tagged bookmark's tags.
+
+        Re-read the bookmark in the transaction, and copy our copy's tags onto
+        the stored bookmark, so that we never overwrite anyone else's
+        concurrent save with our stale copy (see _save_bookmark).  A
+        background re-tag isn't an update, so keep the bookmark's updated
+        time.  Return the stored bookmark as it was before and as it is now,
+        or None if it was deleted or re-tagged since we read it.
+        """
+        stored = db.get(bookmark.key())
+        if stored is None or stored.stop_words_hash == bookmark.stop_words_hash:
+            return None
+        old = copy.copy(stored)
+        for attr in _TAG_ATTRS:
+            setattr(stored, attr, getattr(bookmark, attr))
+        stored.keep_updated = True
+        db.put(stored)
+        return old, stored
+
+    def _find_stop_words_changes(self, stop_words, stop_words_hash):
+        """Remember the stop words.  Return the bookmarks that they affect.
+
+        Compare the stop words against every older list of stop words, and
+        return the sorted document IDs of every bookmark with a stem of a word
+        that was added.  If any older list has a word that was removed, then
+        we can't tell which bookmarks it affects, so return None.
+        """
+        changed_words, removed = set(), False
+        for old in models.StopWords.all().fetch(_MAX_BATCH):
+            if old.key().name() != models.StopWords.key_name(stop_words_hash):
+                changed_words |= set(old.words) ^ set(stop_words)
+                removed = removed or bool(set(old.words) - set(stop_words))
+        key_name = models.StopWords.key_name(stop_words_hash)
+        models.StopWords(key_name=key_name, words=sorted(stop_words)).put()
+        if removed:
+            return None
+        stems = list(set([stemmer.stem(word) for word in changed_words]))
+        for keychain in self._get_keychains(_Datastore(), stems):
             if keychain is not None:
-                try:
-                    keychain.keys.remove(bookmark_key)
-                except ValueError:
-                    msg = "bookmark %s has stem %s, "
-                    msg += "but keychain %s doesn't have bookmark %s"
-                    msg = msg % (bookmark_key, stem, keychain_key, bookmark_key)
-                    _log.critical(msg)
-                keychain.popularity = len(keychain.keys)
-                (to_put if keychain.keys else to_delete).append(keychain)
-        _log.debug('%s unindexed bookmark %s' % (email, url))
-        db.put(to_put)
-        db.delete(to_delete)
+                # We find bookmarks by document ID, so first, give any
+                # bookmarks in keychains that predate document IDs their IDs.
+                self._migrate_keychain(keychain.stem)
+        datastore, shard_keys = _Datastore(), []
+        for keychain in self._get_keychains(datastore, stems):
+            if keychain is not None:
+                shard_keys.extend(keychain.shard_key_names())
+        doc_ids = set()
+        for shard in datastore.get(_keys(models.KeychainShard, shard_keys)):
+            if shard is not None:
+                doc_ids.update(postings.decode(shard.doc_ids))
+        for stem in stems:
+            # Include the bookmarks that we've yet to merge into the shards.
+            for posting in models.KeychainPosting.pending(stem):
+                if not posting.removed:
+                    doc_ids.add(posting.doc_id)
+        return sorted(doc_ids)
+
+    def _get_keychains(self, datastore, stems):
+        """Batch get the keychains (or None) corresponding to the stems."""
+        keychain_keys = [models.Keychain.key_name(stem) for stem in stems]
+        return datastore.get(_keys(models.Keychain, keychain_keys))
+
+
+class _Datastore(object):
+    """Batch datastore operations that count their round trips.
+
+    Empty batches don't touch the datastore, so they don't count.  Batches
+    bigger than the datastore allows in one call take more than one:
+
+        >>> datastore = _Datastore(get=lambda keys: [None] * len(keys),
+        ...                        put=lambda entities: None,
+        ...                        delete=lambda entities: None, max_batch=2)
+        >>> datastore.get(['key_1', 'key_2', 'key_3'])
+        [None, None, None]
+        >>> datastore.get([])
+        []
+        >>> datastore.put([])
+        >>> datastore.delete(['entity'])
+        >>> datastore.rpcs
+        3
+
+    A transaction takes three:  a get, a put (or delete), and the commit.
+    Queries (like looking for pending postings) don't count.
+    """
+
+    def __init__(self, get=None, put=None, delete=None, max_batch=_MAX_BATCH):
+        """Initialize a counter, optionally over stand-in datastore calls."""
+        self._get, self._put = get or db.get, put or db.put
+        self._delete, self.rpcs = delete or db.delete, 0
+        self._max_batch = max_batch
+
+    def get(self, keys):
+        """Batch get the entities (or None) corresponding to the keys."""
+        entities = []
+        for batch in self._batches(keys):
+            entities.extend(self._get(batch))
+        return entities
+
+    def put(self, entities):
+        """Batch put the entities."""
+        for batch in self._batches(entities):
+            self._put(batch)
+
+    def delete(self, entities):
+        """Batch delete the entities."""
+        for batch in self._batches(entities):
+            self._delete(batch)
+
+    def transact(self, method, *args):
+        """Call a transactional method (see decorators.run_in_transaction)."""
+        self.rpcs += 3
+        return method(*args)
+
+    def _batches(self, items):
+        """Split items into batches that the datastore allows in one call."""
+        for index in range(0, len(items), self._max_batch):
+            self.rpcs += 1
+            yield items[index:index + self._max_batch]
+
+    def allocate_doc_ids(self, num):
+        """Reserve and return a list of num new, unique document IDs."""
+        if not num:
+            return []
+        self.rpcs += 1
+        return models.Document.allocate_doc_ids(num)
+
+
+def reindex(name='reindex', batch_size=REINDEX_BATCH_SIZE, retag=False,
+            restart=False):
+    """Rebuild all of the keychains from scratch.  Return the bookmark count.
+
+    Whenever the stop words or the stemmer change, every keychain may be
+    stale.  So from shell.py (or run shell.py --reindex):
+
+        import index
+        index.reindex(retag=True)
+
+    First, delete every keychain, keychain shard, and pending posting.  Then
+    stream all of the bookmarks in batches.  For each batch, build the batch's
+    inverted index in memory, then merge it into the keychain shards in a few
+    batched datastore calls (see _reindex_batch).  If retag is True, then also
+    re-fetch and re-tag each bookmark first.
+
+    Search results are incomplete until we're done.  After each batch, we save
+    our progress as a checkpoint named name.  If we crash, then calling us
+    again resumes from the checkpoint, redoing at most the batch that we
+    crashed in (merging a batch is idempotent).  Once we're done, calling us
+    again does nothing unless restart is True.
+
+    Unlike indexing a single bookmark, merging a batch doesn't update the
+    shards in transactions, so don't let anyone save bookmarks while we're at
+    it.
+    """
+    if retag and not MAINTENANCE:
+        _log.warning('re-tagging bookmarks outside of maintenance mode '
+                     '(bookmarks will look like they were just updated)')
+    key_name = models.Checkpoint.key_name(name)
+    checkpoint = models.Checkpoint.get_by_key_name(key_name)
+    if checkpoint is None or restart:
+        checkpoint = models.Checkpoint(key_name=key_name, phase='clear')
+        checkpoint.put()
+    _log.info('reindexing from phase %s (%s bookmarks reindexed)' %
+              (checkpoint.phase, checkpoint.num_bookmarks))
+    if checkpoint.phase == 'clear':
+        for model in (models.Keychain, models.KeychainShard,
+                      models.KeychainPosting):
+            keys = model.all(keys_only=True).fetch(_MAX_BATCH)
+            while keys:
+                db.delete(keys)
+                keys = model.all(keys_only=True).fetch(_MAX_BATCH)
+        checkpoint.phase = 'index'
+        checkpoint.put()
+        _log.info('reindexing - deleted keychains')
+    if checkpoint.phase == 'index':
+        stop_words, stop_words_hash = None, None
+        if retag:
+            stop_words, stop_words_hash = auto_tag.read_stop_words()
+        while True:
+            query = models.Bookmark.all()
+            if checkpoint.cursor is not None:
+                query.with_cursor(checkpoint.cursor)
+            bookmarks = query.fetch(batch_size)
+            if not bookmarks:
+                break
+            rpcs = _reindex_batch(bookmarks, stop_words, stop_words_hash)
+            checkpoint.cursor = query.cursor()
+            checkpoint.num_bookmarks += len(bookmarks)
+            checkpoint.put()
+            _log.info('reindexing - %s bookmarks reindexed (%s datastore round '
+                      'trips for the last batch)' %
+                      (checkpoint.num_bookmarks, rpcs))
+        checkpoint.phase = 'done'
+        checkpoint.put()
+    _log.info('reindexed %s bookmarks' % checkpoint.num_bookmarks)
+    return checkpoint.num_bookmarks
+
+
+def _reindex_batch(bookmarks, stop_words=None, stop_words_hash=None):
+    """Merge a batch of bookmarks into the keychains.  Return the round trips.
+
+    If stop_words isn't None, then re-tag the bookmarks first.  Save the
+    bookmarks (and their document IDs) before touching any shard, so that a
+    shard never holds a document ID that we might reassign after a crash.
+    """
+    datastore, to_put = _Datastore(), []
+    if stop_words is not None:
+        tokens = _tokenize_bookmarks(bookmarks)
+        for bookmark in bookmarks:
+            _retag_bookmark(bookmark, stop_words, stop_words_hash,
+                            tokens[bookmark.url])
+        to_put.extend(bookmarks)
+    unnumbered = [b for b in bookmarks if b.doc_id is None]
+    doc_ids = datastore.allocate_doc_ids(len(unnumbered))
+    for bookmark, doc_id in zip(unnumbered, doc_ids):
+        bookmark.doc_id = doc_id
+        if stop_words is None:
+            to_put.append(bookmark)
+    for bookmark in bookmarks:
+        document_key = models.Document.key_name(bookmark.doc_id)
+        to_put.append(models.Document(key_name=document_key,
+                                      bookmark=bookmark))
+    datastore.put(to_put)
+
+    # Build the batch's inverted index in memory:  for each stem, the first
+    # word that we saw for it, and for each shard, its new postings.
+    stems_to_words, stems_to_postings = {}, {}
+    for bookmark in bookmarks:
+        for stem, word, count in zip(bookmark.stems, bookmark.words,
+                                     bookmark.counts):
+            stems_to_words.setdefault(stem, word)
+            stems_to_postings.setdefault(stem, []).append((bookmark, count))
+    stems, stems_to_keychains, changed = sorted(stems_to_words), {}, set()
+    keychain_keys = [models.Keychain.key_name(stem) for stem in stems]
+    keychains = datastore.get(_keys(models.Keychain, keychain_keys))
+    shards_to_postings = {}
+    for stem, keychain_key, keychain in zip(stems, keychain_keys, keychains):
+        if keychain is None:
+            keychain = models.Keychain(key_name=keychain_key, stem=stem,
+                word=stems_to_words[stem], num_shards=KEYCHAIN_NUM_SHARDS)
+            changed.add(stem)
+        elif keychain.num_shards is None:
+            keychain.num_shards = KEYCHAIN_NUM_SHARDS
+            changed.add(stem)
+        stems_to_keychains[stem] = keychain
+        for bookmark, count in stems_to_postings[stem]:
+            shard_key = keychain.shard_key_name(bookmark.key())
+            shard_postings = shards_to_postings.setdefault(shard_key,
+                                                           (stem, []))[1]
+            shard_postings.append((bookmark.doc_id, count))
+
+    # Then merge each shard's new postings into the shard, and count them
+    # towards its keychain's popularity (only once, if we're redoing a batch):
+    shard_keys, to_put = sorted(shards_to_postings), []
+    shards = datastore.get(_keys(models.KeychainShard, shard_keys))
+    for shard_key, shard in zip(shard_keys, shards):
+        stem, shard_postings = shards_to_postings[shard_key]
+        if shard is None:
+            shard = models.KeychainShard(key_name=shard_key, stem=stem)
+        new_doc_ids = set([doc_id for doc_id, count in shard_postings])
+        old_doc_ids = postings.decode(shard.doc_ids)
+        doc_ids = sorted(set(old_doc_ids) | new_doc_ids)
+        if len(doc_ids) > len(old_doc_ids):
+            stems_to_keychains[stem].popularity += (len(doc_ids) -
+                                                    len(old_doc_ids))
+            changed.add(stem)
+        shard.doc_ids = postings.encode(doc_ids)
+        if KEYCHAIN_IMPACTS:
+            impacts = [p for p in postings.decode_impacts(shard.impacts)
+                       if p[1] not in new_doc_ids]
+            impacts.extend([(postings.quantize(count), doc_id)
+                            for doc_id, count in shard_postings])
+            shard.impacts = postings.encode_impacts(impacts)
+        shard.popularity = len(doc_ids) + len(shard.keys)
+        to_put.append(shard)
+    to_put.extend([stems_to_keychains[stem] for stem in sorted(changed)])
+    datastore.put(to_put)
+    return datastore.rpcs
+
+
+def _tokenize_bookmarks(bookmarks):
+    """Re-fetch and tokenize bookmarks at once.  Map their URLs to tokens."""
+    urls = list(set([bookmark.url for bookmark in bookmarks]))
+    return dict(auto_tag.tokenize_urls(urls))
+
+
+def _retag_bookmark(bookmark, stop_words, stop_words_hash, tokens=None):
+    """Re-fetch and re-tag a bookmark.  Return whether we could fetch it.
+
+    If we've re-fetched the bookmark already (see _tokenize_bookmarks), then
+    pass in what we got as tokens.  If we can't fetch or parse the bookmark's
+    content, then keep its old tags.  (We don't re-fetch conditionally:
+    re-tagging needs the page's words, even if the page hasn't changed.)
+    """
+    if tokens is None:
+        tokens = auto_tag.tokenize_url(bookmark.url)
+    url, mime_type, title, words, html_hash, truncated, validators = tokens
+    if html_hash is None:
+        _log.warning("couldn't re-tag bookmark %s (keeping its old tags)" %
+                     bookmark.url)
+        return False
+    _set_tags(bookmark, auto_tag.auto_tag(words, stop_words))
+    bookmark.html_hash = html_hash
+    bookmark.stop_words_hash = stop_words_hash
+    bookmark.truncated = truncated
+    bookmark.etag, bookmark.last_modified = validators
+    return True
+
+
+def _set_tags(bookmark, tags):
+    """Replace a bookmark's stems, words, and counts with a list of tags."""
+    bookmark.stems, bookmark.words, bookmark.counts = [], [], []
+    for tag in tags:
+        bookmark.stems.append(tag['stem'])
+        bookmark.words.append(tag['word'])
+        bookmark.counts.append(tag['count'])
+
+
+def _email():
+    """Return the current user's email address (None in cron or offline)."""
+    current_user = users.get_current_user()
+    return current_user.email() if current_user is not None else None
+
+
+def _alias(url, bookmark_url):
+    """Create an alias from a URL to a bookmark's URL (see models.Alias)."""
+    return models.Alias(key_name=models.Alias.key_name(url), url=bookmark_url)
+
+
+def _posting(stem, shard_key, doc_id, count=None, removed=False):
+    """Create a posting that adds a bookmark to (or removes it from) a shard.
+
+    See models.KeychainPosting.
+    """
+    parent = db.Key.from_path(models.KeychainShard.kind(), shard_key)
+    return models.KeychainPosting(parent=parent, stem=stem, doc_id=doc_id,
+        key_name=models.KeychainPosting.key_name(doc_id), count=count,
+        removed=removed)
+
+
+def _pending(stem):
+    """Return whether any postings are pending for a stem."""
+    query = models.KeychainPosting.pending(stem, keys_only=True)
+    return query.get() is not None
+
+
+def _keys(model, key_names):
+    """Convert a model's key names into datastore keys."""
+    return [db.Key.from_path(model.kind(), key_name) for key_name in key_names]
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+#------------------------------------------------------------------------------#
+#   ingest.py                                                                  #
+#                                                                              #
+#   Copyright (c) 2009-2010, Code A La Mode, original authors.                 #
+#                                                                              #
+#       This file is part of imi-imi.                                          #
+#                                                                              #
+#       imi-imi is free software; you can redistribute it and/or modify        #
+#       it under the terms of the GNU General Public License as published by   #
+#       the Free Software Foundation, either version 3 of the License, or      #
+#       (at your option) any later version.                                    #
+#                                                                              #
+#       imi-imi is distributed in the hope that it will be useful,             #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#       GNU General Public License for more details.                           #
+#                                                                              #
+#       You should have received a copy of the GNU General Public License      #
+#       along with imi-imi.  If not, see <http://www.gnu.org/licenses/>.       #
+#------------------------------------------------------------------------------#
+"""Queue new bookmarks to be fetched, tagged, and indexed in the background.
+
+Fetching a page can take seconds, so saving a bookmark doesn't fetch it.
+Instead, saving a bookmark creates a pending placeholder for it, then adds the
+URL to this queue.  Later, a worker (see handlers.IngestBookmark) fetches,
+tags, and indexes the bookmark (see index.RequestHandler._ingest_bookmark).
+
+If we can import Google App Engine's task queue API, then we queue the URL as
+a task that POSTs it to the worker.  Otherwise, we're not running on Google
+App Engine, so we fall back to an in-process queue that we drain by hand.
+
+Since the following is a doctest, we know that we must be running this script
+in someone's development environment, i.e. not on Google App Engine:
+
+    >>> _on_app_engine
+    False
+    >>> Factory is _AppEngineQueue, Factory is _LocalQueue
+    (False, True)
+
+Off Google App Engine, queued URLs wait until someone drains the queue:
+
+    >>> Factory().add('http://www.gutenberg.org/')
+    >>> Factory().add('http://www.google.com/')
+    >>> len(Factory())
+    2
+    >>> ingested = []
+    >>> Factory().drain(ingested.append)
+    2
+    >>> ingested
+    ['http://www.gutenberg.org/', 'http://www.google.com/']
+    >>> len(Factory())
+    0
+"""
+
+
+import collections
+import logging
+
+try:
+    # Try to use Google App Engine's task queue API.
+    from google.appengine.api import taskqueue
+except ImportError:
+    try:
+        # Older SDKs still keep the task queue API in labs.
+        from google.appengine.api.labs import taskqueue
+    except ImportError:
+        # Oops.  We can't use Google App Engine's task queue API.  We mustn't
+        # be running on Google App Engine.  That's cool - fall back to our own
+        # in-process queue.
+        _on_app_engine = False
+    else:
+        _on_app_engine = True
+else:
+    # Awesome.  We can use Google App Engine's task queue API.
+    _on_app_engine = True
+
+from config import INGEST_QUEUE, INGEST_URL
+
+
+_log = logging.getLogger(__name__)
+
+
+class _AppEngineQueue(object):
+    """Queue bookmarks as Google App Engine tasks."""
+
+    def add(self, url):
+        """Queue a task to POST the bookmark's URL to the worker."""
+        taskqueue.add(url=INGEST_URL, params={'url': url},
+                      queue_name=INGEST_QUEUE)
+        _log.debug('queued bookmark %s for ingestion' % url)
+
+
+class _LocalQueue(object):
+    """Queue bookmarks in this process, until someone drains the queue.
+
+    Every instance shares the same queue, so that the code that adds to the
+    queue and the code that drains it don't have to share an instance.
+    """
+
+    _urls = collections.deque()
+
+    def __len__(self):
+        """Return the number of bookmarks waiting in the queue."""
+        return len(self._urls)
+
+    def add(self, url):
+        """Queue the bookmark's URL."""
+        self._urls.append(url)
+        _log.debug('queued bookmark %s for ingestion' % url)
+
+    def drain(self, ingest):
+        """Call ingest on each queued URL, in order.  Return how many."""
+        num_urls = 0
+        while self._urls:
+            ingest(self._urls.popleft())
+            num_urls += 1
+        return num_urls
+
+
+class _MetaClass(type):
+    """Meta-class to determine which concrete queue class to use."""
+
+    def __new__(Class, name, bases, class_dict):
+        """ """
+        if _on_app_engine:
+            Class = _AppEngineQueue
+        else:
+            Class = _LocalQueue
+        return Class
+
+
+class Factory(object):
+    """Factory class which instantiates the correct concr. class for our env."""
+
+    __metaclass__ = _MetaClass
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+#------------------------------------------------------------------------------#
+#   lru.py                                                                     #
+#                                                                              #
+#   Copyright (c) 2009-2010, Code A La Mode, original authors.                 #
+#                                                                              #
+#       This file is part of imi-imi.                                          #
+#                                                                              #
+#       imi-imi is free software; you can redistribute it and/or modify        #
+#       it under the terms of the GNU General Public License as published by   #
+#       the Free Software Foundation, either version 3 of the License, or      #
+#       (at your option) any later version.                                    #
+#                                                                              #
+#       imi-imi is distributed in the hope that it will be useful,             #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#       GNU General Public License for more details.                           #
+#                                                                              #
+#       You should have received a copy of the GNU General Public License      #
+#       along with imi-imi.  If not, see <http://www.gnu.org/licenses/>.       #
+#------------------------------------------------------------------------------#
+"""A bounded, least recently used cache.
+
+Some of our hot spots (like stemming words) compute the same answers over and
+over for a small, heavily skewed set of inputs.  An LRUCache remembers the
+answers for the most recently used inputs, up to a fixed number of them (or up
+to a fixed total size of them), and counts its hits and misses so that we can
+tell whether it's worth it.
+"""
+
+
+_PREV, _NEXT, _KEY, _VALUE, _SIZE = range(5)
+
+
+class LRUCache(object):
+    """A dictionary-like cache that forgets its least recently used items.
+
+    Example usage:
+        >>> cache = LRUCache(2)
+        >>> cache['a'], cache['b'] = 1, 2
+        >>> cache.get('a')
+        1
+        >>> cache['c'] = 3
+        >>> cache.get('b') is None, 'a' in cache, len(cache)
+        (True, True, 2)
+        >>> cache.hits, cache.misses
+        (1, 1)
+        >>> cache = LRUCache(5, sizeof=len)
+        >>> cache['a'], cache['b'], cache['c'] = 'xx', 'yy', 'zzzzzz'
+        >>> cache['d'] = 'www'
+        >>> sorted(cache._links), cache.total
+        (['b', 'd'], 5)
+    """
+
+    def __init__(self, size, sizeof=None):
+        """Initialize an empty cache that holds at most size items.
+
+        If sizeof is specified, then it measures each value, and the cache
+        holds values that measure at most size in all instead (and never holds
+        a value that measures more than size on its own).
+        """
+        self.size, self.hits, self.misses = size, 0, 0
+        self.total = 0
+        self._sizeof = sizeof
+        self._links = {}
+
+        # The cache's items form a circular, doubly linked list through this
+        # root link, from the most recently used to the least recently used.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, 0]
+
+    def get(self, key, default=None):
+        """Return the cached value for key (or default), and count it."""
+        link = self._links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._unlink(link)
+        self._link(link)
+        return link[_VALUE]
+
+    def __setitem__(self, key, value):
+        """Cache a value for key, forgetting the least recently used if full."""
+        size = 1 if self._sizeof is None else self._sizeof(value)
+        link = self._links.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+            self.total -= link[_SIZE]
+        if size > self.size:
+            return
+        while self.total + size > self.size:
+            oldest = self._root[_PREV]
+            self._unlink(oldest)
+            del self._links[oldest[_KEY]]
+            self.total -= oldest[_SIZE]
+        link = [None, None, key, value, size]
+        self._links[key] = link
+        self.total += size
+        self._link(link)
+
+    def __contains__(self, key):
+        """Return whether key is cached (without counting a hit or a miss)."""
+        return key in self._links
+
+    def __len__(self):
+        """Return the number of cached items."""
+        return len(self._links)
+
+    def clear(self):
+        """Forget every cached item, and reset the hit and miss counters."""
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None, None, 0]
+        self.hits, self.misses, self.total = 0, 0, 0
+
+    def _link(self, link):
+        """Insert a link as the most recently used."""
+        first = self._root[_NEXT]
+        link[_PREV], link[_NEXT] = self._root, first
+        first[_PREV] = self._root[_NEXT] = link
+
+    def _unlink(self, link):
+        """Remove a link from the list."""
+        prev, next = link[_PREV], link[_NEXT]
+        prev[_NEXT], next[_PREV] = next, prev
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
@@ -59,6 +59,9 @@ def main():
         url_mapping = (
             ('/search',             handlers.Search),       # /search
             ('/live_search',        handlers.LiveSearch),   # /live_search
+            ('/admin/reindex_stop_words', handlers.ReindexStopWords),
+            ('/admin/compact_keychains', handlers.CompactKeychains),
+            ('/admin/ingest',       handlers.IngestBookmark),
             ('/users/(.*)/(.*)',    handlers.Users),        # /users/email@addr.com/before
             ('/users/(.*)',         handlers.Users),        # /users/email@addr.com
             ('/users',              handlers.Users),        # /users
@@ -21,11 +21,29 @@
 """Google App Engine datastore models."""
 
 
+import zlib
+
 from google.appengine.api.users import User
 from google.appengine.ext import db
 from google.appengine.ext.db import polymodel
 
 from config import MAINTENANCE
+import postings
+
+
+class _UpdatedProperty(db.DateTimeProperty):
+    """Property for an updated time that background jobs can leave as is.
+
+    If a model instance's keep_updated attribute is true, then putting it
+    doesn't auto set its updated time.
+    """
+
+    def get_value_for_datastore(self, model_instance):
+        """Return the updated time to store for a model instance."""
+        if getattr(model_instance, 'keep_updated', False):
+            return db.Property.get_value_for_datastore(self, model_instance)
+        return super(_UpdatedProperty, self).get_value_for_datastore(
+            model_instance)
 
 
 class _BaseModel(polymodel.PolyModel):
@@ -47,7 +65,7 @@ class _BaseModel(polymodel.PolyModel):
     """
     user = db.UserProperty(auto_current_user_add=not MAINTENANCE)
     created = db.DateTimeProperty(auto_now_add=not MAINTENANCE)
-    updated = db.DateTimeProperty(auto_now=not MAINTENANCE)
+    updated = _UpdatedProperty(auto_now=not MAINTENANCE)
     popularity = db.IntegerProperty(default=0)
 
 
@@ -77,12 +95,123 @@ class Bookmark(_BaseModel):
     words = db.ListProperty(str, default=[], indexed=False)
     counts = db.ListProperty(float, default=[], indexed=False)
     html_hash = db.StringProperty(default='', indexed=False)
+    # Whether we tagged only the beginning of a huge page:
+    truncated = db.BooleanProperty(default=False, indexed=False)
+    # The page's ETag and Last-Modified headers, to re-fetch it conditionally:
+    etag = db.StringProperty(default=None, indexed=False)
+    last_modified = db.StringProperty(default=None, indexed=False)
+    # Whether we've yet to fetch and tag the bookmark (see ingest.py):
+    pending = db.BooleanProperty(default=False, indexed=False)
+    stop_words_hash = db.StringProperty(default=None, indexed=False)
+    doc_id = db.IntegerProperty(default=None, indexed=False)
 
     @staticmethod
     def key_name(url):
         """Convert a URL into a bookmark key."""
         return 'bookmark_' + url
 
+    def word_counts(self):
+        """Return a dictionary mapping the bookmark's words to their counts."""
+        return self._tag_counts('words')
+
+    def _tag_counts(self, name):
+        """Return a dictionary mapping the bookmark's stems or words to counts.
+
+        Styling tags looks up one count per word for every bookmark on a page.
+        Scanning the words list for each lookup is quadratic, so instead, we
+        lazily build this dictionary once per time that we load the bookmark.
+        We don't store it in the datastore (or in memcache), and we rebuild it
+        if the bookmark's tag lists change.
+        """
+        tags, counts = getattr(self, name), self.counts
+        caches = self.__dict__.setdefault('_tag_counts_caches', {})
+        cache = caches.get(name)
+        if (cache is None or cache[0] is not tags or cache[1] is not counts or
+            cache[2] != len(tags) or cache[3] != len(counts)):
+            tag_counts = dict(zip(tags, counts))
+            cache = caches[name] = (tags, counts, len(tags), len(counts),
+                                    tag_counts)
+        return cache[4]
+
+    def __getstate__(self):
+        """Don't pickle our cached dictionaries along with the bookmark."""
+        state = self.__dict__.copy()
+        state.pop('_tag_counts_caches', None)
+        return state
+
+
+class Document(_BaseModel):
+    """Model mapping a bookmark's document ID back to the bookmark.
+
+    Keychain shards identify bookmarks by small integer document IDs (see
+    postings.py) rather than by their much larger bookmark keys.  This model
+    resolves a document ID back to a bookmark key.
+    """
+    bookmark = db.ReferenceProperty(Bookmark)
+
+    @staticmethod
+    def key_name(doc_id):
+        """Convert a document ID into a document key."""
+        return 'document_%d' % doc_id
+
+    @staticmethod
+    def allocate_doc_ids(num):
+        """Reserve and return a list of num new, unique document IDs."""
+        model_key = db.Key.from_path(Document.kind(), 1)
+        start, end = db.allocate_ids(model_key, num)
+        return range(start, end + 1)
+
+
+class Alias(_BaseModel):
+    """Model mapping a URL to the URL of the bookmark that it's an alias of.
+
+    Many URLs (short links, old links that redirect, pages that declare a
+    <link rel="canonical">) point to the same bookmark.  Whenever we fetch a
+    URL and end up at another, we remember so here.  That way, the next time
+    that someone bookmarks the same URL, we find its bookmark without fetching
+    the URL again (see index.RequestHandler's _lookup_bookmark).
+    """
+    url = db.LinkProperty(indexed=False)
+
+    @staticmethod
+    def key_name(url):
+        """Convert a URL into an alias key."""
+        return 'alias_' + url
+
+
+class Checkpoint(_BaseModel):
+    """Model recording how far a long-running offline job has gotten.
+
+    An offline job (such as rebuilding the keychains - see index.reindex)
+    works through the datastore in batches, and saves its checkpoint after
+    each batch.  If the job crashes, then it resumes from its checkpoint.
+    """
+    phase = db.StringProperty(default='', indexed=False)
+    cursor = db.TextProperty(default=None)
+    doc_ids = db.BlobProperty(default='')
+    num_bookmarks = db.IntegerProperty(default=0, indexed=False)
+
+    @staticmethod
+    def key_name(name):
+        """Convert a job name into a checkpoint key."""
+        return 'checkpoint_' + name
+
+
+class StopWords(_BaseModel):
+    """Model remembering a list of stop words that we've tagged bookmarks with.
+
+    Each bookmark remembers the hash of the stop words that it was tagged with.
+    When the stop words change, we compare the new list against the old ones
+    to find which bookmarks to re-tag (see index.RequestHandler's
+    _reindex_stop_words).
+    """
+    words = db.ListProperty(str, default=[], indexed=False)
+
+    @staticmethod
+    def key_name(hash):
+        """Convert a stop words hash into a stop words key."""
+        return 'stop_words_' + hash
+
 
 class Reference(_BaseModel):
     """Model describing a reference to a bookmark."""
@@ -99,9 +228,21 @@ class Keychain(_BaseModel):
 
     This model acts as a reverse index describing which bookmarks should match
     a particular search query.
+
+    A keychain is only a small header.  The bookmarks themselves live in the
+    keychain's shards (see KeychainShard), so that indexing a bookmark touches
+    exactly one small shard per stem rather than rewriting one huge list for a
+    popular stem.  For the same reason, indexing a bookmark doesn't touch an
+    existing keychain at all, so a keychain's popularity (the number of
+    bookmarks in its shards) is only as of the last time that we compacted
+    its shards (see KeychainPosting).  Keychains written before we sharded
+    still keep their bookmark keys in the keys property and have no
+    num_shards; we keep reading (and unindexing from) those keys until
+    they're migrated.
     """
     stem = db.StringProperty(indexed=False)
     word = db.StringProperty(indexed=False)
+    num_shards = db.IntegerProperty(default=None, indexed=False)
     keys = db.ListProperty(db.Key, default=[], indexed=False)
 
     @staticmethod
@@ -117,3 +258,77 @@ class Keychain(_BaseModel):
         (rather than querying over the stem property).
         """
         return 'keychain_' + stem
+
+    def shard_key_name(self, bookmark_key):
+        """Return the key of the shard that holds (or should hold) a bookmark.
+
+        The shard is a stable function of the bookmark key, so that we can
+        find the bookmark again to unindex it without reading every shard.
+        """
+        shard = zlib.crc32(str(bookmark_key)) % self.num_shards
+        return KeychainShard.key_name(self.stem, shard)
+
+    def shard_key_names(self):
+        """Return the keys of all of this keychain's shards."""
+        num_shards = self.num_shards or 0
+        return [KeychainShard.key_name(self.stem, shard)
+                for shard in range(num_shards)]
+
+
+class KeychainShard(_BaseModel):
+    """Model describing a slice of the bookmarks that should match a stem.
+
+    Each keychain's bookmarks are spread across its shards.  A shard holds its
+    bookmarks' document IDs, compressed (see postings.py).  Shards written
+    before we compressed them hold bookmark keys instead; we keep reading (and
+    unindexing from) those keys until they're migrated.  A shard's popularity
+    is the number of bookmarks that it holds.  Changes to a shard wait in
+    postings until we merge them into it (see KeychainPosting).
+
+    If KEYCHAIN_IMPACTS is on, a shard also holds the same document IDs
+    ordered by impact.  A shard's impacts are only usable if they cover all of
+    its document IDs (see has_impacts).
+    """
+    stem = db.StringProperty(indexed=False)
+    doc_ids = db.BlobProperty(default='')
+    impacts = db.BlobProperty(default='')
+    keys = db.ListProperty(db.Key, default=[], indexed=False)
+
+    @staticmethod
+    def key_name(stem, shard):
+        """Convert a word stem and a shard number into a keychain shard key."""
+        return 'keychain_%s_%d' % (stem, shard)
+
+    def has_impacts(self):
+        """Return whether the shard's impacts cover all of its bookmarks."""
+        num_impacts = postings.count_impacts(self.impacts)
+        return not self.keys and num_impacts == postings.count(self.doc_ids)
+
+
+class KeychainPosting(_BaseModel):
+    """Model describing a change to a keychain shard that we've yet to merge.
+
+    Indexing a bookmark never reads or rewrites a shard.  Instead, for each
+    stem, it appends a posting that adds the bookmark to the shard responsible
+    for it (or if removed is True, removes the bookmark from the shard).  A
+    posting lives in its shard's entity group and is named after the
+    bookmark's document ID, so concurrent requests can't overwrite each
+    other's changes to a shard, and a later posting for the same bookmark
+    simply replaces an earlier one.  We merge postings into their shards in
+    the background (see index.RequestHandler's _compact_keychains).  Until
+    then, search reads a stem's postings along with its shards.
+    """
+    stem = db.StringProperty()
+    doc_id = db.IntegerProperty(indexed=False)
+    count = db.FloatProperty(default=None, indexed=False)
+    removed = db.BooleanProperty(default=False, indexed=False)
+
+    @staticmethod
+    def key_name(doc_id):
+        """Convert a document ID into a keychain posting key (in a shard)."""
+        return 'posting_%d' % doc_id
+
+    @staticmethod
+    def pending(stem, keys_only=False):
+        """Return a query for a stem's postings that we've yet to merge."""
+        return KeychainPosting.all(keys_only=keys_only).filter('stem =', stem)
@@ -0,0 +1,124 @@
+#------------------------------------------------------------------------------#
+#   parity.py                                                                  #
+#                                                                              #
+#   Copyright (c) 2009-2010, Code A La Mode, original authors.                 #
+#                                                                              #
+#       This file is part of imi-imi.                                          #
+#                                                                              #
+#       imi-imi is free software; you can redistribute it and/or modify        #
+#       it under the terms of the GNU General Public License as published by   #
+#       the Free Software Foundation, either version 3 of the License, or      #
+#       (at your option) any later version.                                    #
+#                                                                              #
+#       imi-imi is distributed in the hope that it will be useful,             #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#       GNU General Public License for more details.                           #
+#                                                                              #
+#       You should have received a copy of the GNU General Public License      #
+#       along with imi-imi.  If not, see <http://www.gnu.org/licenses/>.       #
+#------------------------------------------------------------------------------#
+"""Check that the fast HTML extractor tags pages the same as BeautifulSoup.
+
+Tokenize and auto-tag each saved page with both of auto_tag.tokenize_html's
+extractors ('soup' and 'fast'), print the pages whose titles or tags differ
+(and how), and print how long each extractor took in all.  Exit with status 1
+if any page's tags differ.
+
+By default, check the pages saved in corpus/pages (a few real-world pages, and
+a few broken ones that the extractors used to disagree on).  To save a page:
+    wget -O corpus/pages/python.html http://www.python.org/
+"""
+
+
+import glob
+import optparse
+import os
+import sys
+import time
+
+
+def main():
+    """Compare both extractors' titles and tags on each of the saved pages."""
+    parser = _config_parser()
+    paths, opts = _parse_args(parser)
+    import auto_tag
+    stop_words = auto_tag.read_stop_words()[0]
+    seconds = {'soup': 0.0, 'fast': 0.0}
+    num_different = 0
+    for path in paths:
+        with_soup, seconds['soup'] = _tag(auto_tag, path, 'soup', stop_words,
+                                          seconds['soup'])
+        fast, seconds['fast'] = _tag(auto_tag, path, 'fast', stop_words,
+                                     seconds['fast'])
+        if with_soup[1] != fast[1]:
+            num_different += 1
+            print '%s: tags differ' % path
+            _print_difference(with_soup[1], fast[1])
+        elif with_soup[0] != fast[0] and opts.titles:
+            print '%s: titles differ' % path
+            print '    soup: %r' % with_soup[0]
+            print '    fast: %r' % fast[0]
+    print '%d of %d pages tagged the same' % (len(paths) - num_different,
+                                             len(paths))
+    print 'soup: %.3f s    fast: %.3f s' % (seconds['soup'], seconds['fast'])
+    sys.exit(1 if num_different else 0)
+
+
+def _config_parser():
+    """Configure the command-line argument parser."""
+    usage = '%prog [--titles] [page.html or directory ...]'
+    parser = optparse.OptionParser(description=__doc__, usage=usage)
+    parser.add_option('--titles', dest='titles', action='store_true',
+                      default=False, help='also report differing titles')
+    return parser
+
+
+def _parse_args(parser):
+    """Parse the command-line arguments into a list of saved pages' paths.
+
+    If there aren't any saved pages, then print usage information and exit.
+    """
+    opts, args = parser.parse_args(sys.argv[1:])
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    args = args if args else [os.path.join(base_dir, 'corpus', 'pages')]
+    paths = []
+    for arg in args:
+        if os.path.isdir(arg):
+            paths.extend(sorted(glob.glob(os.path.join(arg, '*'))))
+        else:
+            paths.append(arg)
+    paths = [path for path in paths if os.path.isfile(path)]
+    if not paths:
+        parser.error('no saved pages in %s' % ', '.join(args))
+    return paths, opts
+
+
+def _tag(auto_tag, path, extractor, stop_words, seconds):
+    """Tokenize and auto-tag a saved page with the given extractor.
+
+    Return the page's title and its tags (as sorted (stem, word, count)
+    tuples), and the running total of seconds spent tokenizing.
+    """
+    html = open(path, 'rb').read()
+    start = time.time()
+    title, words, hash, truncated = auto_tag.tokenize_html(
+        html, extractor=extractor)
+    seconds += time.time() - start
+    tags = auto_tag.auto_tag(words or [], stop_words)
+    tags = sorted([(tag['stem'], tag['word'], tag['count']) for tag in tags])
+    return (title, tags), seconds
+
+
+def _print_difference(with_soup, fast):
+    """Print the tags that only one of the extractors came up with."""
+    for name, tags, other_tags in (('soup', with_soup, fast),
+                                   ('fast', fast, with_soup)):
+        only = [tag for tag in tags if not tag in other_tags]
+        if only:
+            print '    only %s: %s' % (name, ', '.join(
+                ['%s (%s, %.3f)' % tag for tag in only]))
+
+
+if __name__ == '__main__':
+    main()
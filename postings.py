@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+#------------------------------------------------------------------------------#
+#   postings.py                                                                #
+#                                                                              #
+#   Copyright (c) 2009-2010, Code A La Mode, original authors.                 #
+#                                                                              #
+#       This file is part of imi-imi.                                          #
+#                                                                              #
+#       imi-imi is free software; you can redistribute it and/or modify        #
+#       it under the terms of the GNU General Public License as published by   #
+#       the Free Software Foundation, either version 3 of the License, or      #
+#       (at your option) any later version.                                    #
+#                                                                              #
+#       imi-imi is distributed in the hope that it will be useful,             #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#       GNU General Public License for more details.                           #
+#                                                                              #
+#       You should have received a copy of the GNU General Public License      #
+#       along with imi-imi.  If not, see <http://www.gnu.org/licenses/>.       #
+#------------------------------------------------------------------------------#
+"""Utilities for compressing keychains' posting lists.
+
+A keychain shard identifies the bookmarks that match its stem by their
+document IDs - small integers, one per bookmark - rather than by their
+bookmark keys.  A key is a serialized protocol buffer that's easily 100 bytes
+long, which makes long posting lists slow to read and liable to blow past the
+datastore's entity size limit.
+
+Instead, we sort the document IDs, replace each with its difference from its
+predecessor, and encode those (usually small) deltas as variable length
+integers - 7 bits per byte, with the high bit set on every byte but a number's
+last:
+
+    >>> encode([3, 4, 300])
+    '\\x03\\x01\\xa8\\x02'
+    >>> decode('\\x03\\x01\\xa8\\x02')
+    [3, 4, 300]
+
+Densely allocated document IDs cost about a byte apiece:
+
+    >>> doc_ids = range(5000000, 5010000)
+    >>> len(encode(doc_ids))
+    10003
+    >>> decode(encode(doc_ids)) == doc_ids
+    True
+
+Since posting lists are sorted, we can intersect them (to find the bookmarks
+relevant to every word in a query) without ever loading a bookmark:
+
+    >>> intersect([1, 3, 5, 7, 9], [3, 4, 5], [0, 5, 9])
+    [5]
+
+A shard can also keep an impact-ordered posting list:  the same document IDs,
+each paired with its bookmark's count for the stem (quantized into an impact
+between 1 and 255), sorted by descending impact.  Reading the most relevant
+postings first lets search stop early, once it's found enough of them to fill
+a page:
+
+    >>> blob = encode_impacts([(quantize(0.5), 7), (255, 3), (128, 4)])
+    >>> count_impacts(blob)
+    3
+    >>> list(iter_impacts(blob))
+    [(255, 3), (128, 4), (128, 7)]
+"""
+
+
+import bisect
+import heapq
+import math
+
+
+# Every byte of a compressed list, and the bytes that continue a number:
+_ALL_BYTES = ''.join([chr(byte) for byte in range(256)])
+_CONTINUATION_BYTES = _ALL_BYTES[0x80:]
+
+
+def encode(doc_ids):
+    """Compress a sorted list of unique document IDs into a string.
+
+    Example usage:
+        >>> encode([])
+        ''
+        >>> encode([0, 127, 128])
+        '\\x00\\x7f\\x01'
+    """
+    chars, previous = [], 0
+    for doc_id in doc_ids:
+        delta, previous = doc_id - previous, doc_id
+        while delta > 0x7F:
+            chars.append(chr(delta & 0x7F | 0x80))
+            delta >>= 7
+        chars.append(chr(delta))
+    return ''.join(chars)
+
+
+def decode(blob):
+    """Decompress a string into a sorted list of unique document IDs.
+
+    Example usage:
+        >>> decode('')
+        []
+        >>> decode('\\x00\\x7f\\x01')
+        [0, 127, 128]
+    """
+    doc_ids, doc_id, delta, shift = [], 0, 0, 0
+    for char in blob:
+        byte = ord(char)
+        if byte & 0x80:
+            delta |= (byte & 0x7F) << shift
+            shift += 7
+        else:
+            doc_id += delta | byte << shift
+            doc_ids.append(doc_id)
+            delta, shift = 0, 0
+    return doc_ids
+
+
+def count(blob):
+    """Return the number of document IDs in a compressed list.
+
+    Each document ID ends in exactly one byte without the high bit set, so we
+    count those rather than decompress the list.
+
+    Example usage:
+        >>> count(''), count('\\x03\\x01\\xa8\\x02')
+        (0, 3)
+    """
+    return len(blob.translate(_ALL_BYTES, _CONTINUATION_BYTES))
+
+
+def add(doc_ids, doc_id):
+    """Add a document ID to a sorted list of document IDs (if it's not there).
+
+    Return whether or not the list changed.
+
+    Example usage:
+        >>> doc_ids = [1, 5]
+        >>> add(doc_ids, 3), add(doc_ids, 3), doc_ids
+        (True, False, [1, 3, 5])
+    """
+    index = bisect.bisect_left(doc_ids, doc_id)
+    if index < len(doc_ids) and doc_ids[index] == doc_id:
+        return False
+    doc_ids.insert(index, doc_id)
+    return True
+
+
+def remove(doc_ids, doc_id):
+    """Remove a document ID from a sorted list of document IDs (if it's there).
+
+    Return whether or not the list changed.
+
+    Example usage:
+        >>> doc_ids = [1, 3, 5]
+        >>> remove(doc_ids, 3), remove(doc_ids, 3), doc_ids
+        (True, False, [1, 5])
+    """
+    index = bisect.bisect_left(doc_ids, doc_id)
+    if index < len(doc_ids) and doc_ids[index] == doc_id:
+        del doc_ids[index]
+        return True
+    return False
+
+
+def contains(doc_ids, doc_id):
+    """Return whether a sorted list of document IDs contains a document ID.
+
+    Example usage:
+        >>> contains([1, 3, 5], 3), contains([1, 3, 5], 4)
+        (True, False)
+    """
+    index = bisect.bisect_left(doc_ids, doc_id)
+    return index < len(doc_ids) and doc_ids[index] == doc_id
+
+
+def intersect(*doc_id_lists):
+    """Intersect sorted lists of unique document IDs.
+
+    We intersect the shortest list with the next shortest, then the result
+    with the next shortest, and so on, so that the intermediate result only
+    ever shrinks - and can bail out as soon as it's empty.
+
+    Example usage:
+        >>> intersect()
+        []
+        >>> intersect([2, 4, 6])
+        [2, 4, 6]
+        >>> intersect(range(0, 1000, 2), range(0, 1000, 3), [0, 6, 7, 996])
+        [0, 6, 996]
+        >>> intersect([1, 2], [], range(1000))
+        []
+    """
+    doc_id_lists = sorted(doc_id_lists, key=len)
+    if not doc_id_lists:
+        return []
+    doc_ids = list(doc_id_lists[0])
+    for other_doc_ids in doc_id_lists[1:]:
+        if not doc_ids:
+            break
+        doc_ids = _gallop(doc_ids, other_doc_ids)
+    return doc_ids
+
+
+def _gallop(shorter, longer):
+    """Intersect a short sorted list with a long one.
+
+    For each document ID in the short list, we search for it in the long list
+    from where we found the last one - first by doubling our stride until we
+    overshoot, then by binary searching the last stride.  That costs on the
+    order of len(shorter) * log(len(longer) / len(shorter)) comparisons,
+    rather than len(shorter) + len(longer) for a straight merge.
+
+    Example usage:
+        >>> _gallop([3, 50, 51, 99], range(100))
+        [3, 50, 51, 99]
+        >>> _gallop([-1, 100], range(100))
+        []
+    """
+    doc_ids, low, length = [], 0, len(longer)
+    for doc_id in shorter:
+        high, stride = low, 1
+        while high < length and longer[high] < doc_id:
+            low, high, stride = high + 1, high + 1 + stride, stride * 2
+        index = bisect.bisect_left(longer, doc_id, low, min(high, length))
+        if index == length:
+            break
+        if longer[index] == doc_id:
+            doc_ids.append(doc_id)
+            index += 1
+        low = index
+    return doc_ids
+
+
+def quantize(count):
+    """Convert a tag count (between 0 and 1) into an impact (from 1 to 255).
+
+    We round up, so that impact / 255.0 is never less than the original count.
+
+    Example usage:
+        >>> quantize(1.0), quantize(0.125), quantize(0.0001)
+        (255, 32, 1)
+    """
+    return max(1, min(255, int(math.ceil(count * 255))))
+
+
+def encode_impacts(postings):
+    """Compress a list of (impact, document ID) pairs into a string.
+
+    The string starts with the number of postings.  Then, for each impact
+    (from highest to lowest), comes the impact, the number of postings with
+    that impact, and those postings' document IDs - sorted, delta encoded.
+
+    Example usage:
+        >>> encode_impacts([])
+        ''
+        >>> encode_impacts([(1, 2), (255, 1), (1, 1)])
+        '\\x03\\xff\\x01\\x01\\x01\\x02\\x01\\x01'
+    """
+    if not postings:
+        return ''
+    chars, impacts = [encode([len(postings)])], {}
+    for impact, doc_id in postings:
+        impacts.setdefault(impact, []).append(doc_id)
+    for impact in sorted(impacts, reverse=True):
+        doc_ids = sorted(impacts[impact])
+        chars.extend([chr(impact), encode([len(doc_ids)]), encode(doc_ids)])
+    return ''.join(chars)
+
+
+def decode_impacts(blob):
+    """Decompress a string into a list of (impact, document ID) pairs.
+
+    Example usage:
+        >>> decode_impacts('\\x03\\xff\\x01\\x01\\x01\\x02\\x01\\x01')
+        [(255, 1), (1, 1), (1, 2)]
+    """
+    return list(iter_impacts(blob))
+
+
+def count_impacts(blob):
+    """Return the number of postings in a compressed impact-ordered list.
+
+    Example usage:
+        >>> count_impacts(''), count_impacts('\\x01\\x05\\x01\\x09')
+        (0, 1)
+    """
+    return _read_varint(blob, 0)[0] if blob else 0
+
+
+def iter_impacts(blob):
+    """Lazily decompress a string into (impact, document ID) pairs.
+
+    We decompress the pairs in order of descending impact, and only as we're
+    asked for them.
+    """
+    if not blob:
+        return
+    index = _read_varint(blob, 0)[1]
+    while index < len(blob):
+        impact = ord(blob[index])
+        num_doc_ids, index = _read_varint(blob, index + 1)
+        doc_id = 0
+        for unused in xrange(num_doc_ids):
+            delta, index = _read_varint(blob, index)
+            doc_id += delta
+            yield impact, doc_id
+
+
+def merge_impacts(iterators):
+    """Merge impact-ordered iterators into one impact-ordered iterator.
+
+    Example usage:
+        >>> iterators = [iter([(9, 1), (2, 5)]), iter([]), iter([(5, 3)])]
+        >>> list(merge_impacts(iterators))
+        [(9, 1), (5, 3), (2, 5)]
+    """
+    heap = []
+    for iterator in iterators:
+        for impact, doc_id in iterator:
+            heap.append((-impact, doc_id, iterator))
+            break
+    heapq.heapify(heap)
+    while heap:
+        impact, doc_id, iterator = heap[0]
+        yield -impact, doc_id
+        for impact, doc_id in iterator:
+            heapq.heapreplace(heap, (-impact, doc_id, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+def _read_varint(blob, index):
+    """Decode the variable length integer at index.  Return it & next index.
+
+    Example usage:
+        >>> _read_varint('\\x05\\xa8\\x02', 1)
+        (296, 3)
+    """
+    value, shift = 0, 0
+    while True:
+        byte = ord(blob[index])
+        index += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, index
+        shift += 7
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)
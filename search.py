@@ -21,19 +21,19 @@
 """Bookmark search logic."""
 
 
+import heapq
 import logging
 
 from google.appengine.ext import db
 from google.appengine.ext import webapp
 
-import packages
-from nltk.stem.porter import PorterStemmer
-
 from config import SEARCH_CACHE_SECS, SEARCH_PER_PAGE
 import auto_tag
 import decorators
 import errors
 import models
+import postings
+import stemmer
 
 
 _log = logging.getLogger(__name__)
@@ -52,13 +52,7 @@ class RequestHandler(webapp.RequestHandler):
         """
         query_words = query_string.split()
         query_stems = self._query_words_to_stems(query_words)
-        bookmarks = None if query_stems else set()
-        for s in query_stems:
-            k = set(self._query_stems_to_bookmark_keys([s]))
-            b = set([b.url for b in db.get(k) if b is not None])
-            bookmarks = b if bookmarks is None else bookmarks & b
-            if not bookmarks:
-                break
+        bookmarks = self._query_stems_to_matching_postings(query_stems)
         return len(bookmarks)
 
     def _get_bookmarks(self, references=False, query_users=tuple(), before=None,
@@ -99,20 +93,26 @@ class RequestHandler(webapp.RequestHandler):
             else:
                 raise e
         else:
-            num_bookmarks = len(bookmarks)
+            num_bookmarks, bookmarks = bookmarks
             bookmarks, more = self._search_bookmarks_specific(bookmarks, **kwds)
         return num_bookmarks, bookmarks, more
 
-    @decorators.memcache_results(cache_secs=SEARCH_CACHE_SECS)
+    # Version 2 returns the number of bookmarks along with them:
+    @decorators.memcache_results(cache_secs=SEARCH_CACHE_SECS, version=2)
     def _search_bookmarks_generic(self, query_users=tuple(),
                                   query_words=tuple(), before=None, page=0,
                                   per_page=SEARCH_PER_PAGE):
-        """Return a list of bookmarks that match some given criteria.
+        """Return the number and a list of bookmarks that match some criteria.
         
         The sort order is implicit in the criteria.  If search terms are
         specified, then the bookmarks should be sorted by relevance.
         Otherwise, they should be sorted in reverse chronological order.
 
+        When sorting by relevance, we only rank as many bookmarks as we need
+        to fill the requested page (plus one, so that we know whether there
+        are more).  If we're filtering by date, then we can't tell how many
+        bookmarks we'll need, so we rank all of them.
+
         If there's some problem with the search criteria, then raise a
         SearchError exception.
         """
@@ -127,6 +127,15 @@ class RequestHandler(webapp.RequestHandler):
             if not query_stems:
                 _log.warning("couldn't compute bookmarks - generic query")
                 raise errors.SearchError(error_message='generic query')
+            num = None
+            if per_page and before is None:
+                num = (page + 1) * per_page + 1
+            if num is not None and not query_users:
+                results = self._search_by_impact(query_stems, num)
+                if results is not None:
+                    _log.debug("computed bookmarks for query '%s' by impact" %
+                               query_key)
+                    return results
             bookmark_keys = self._query_stems_to_bookmark_keys(query_stems)
             bookmarks = db.get(bookmark_keys)
         else:
@@ -135,10 +144,119 @@ class RequestHandler(webapp.RequestHandler):
         bookmarks = self._query_to_list(bookmarks)
         if query_users:
             bookmarks = self._filter_query_users(query_users, bookmarks)
+        num_bookmarks = len(bookmarks)
         if query_words:
-            bookmarks.sort(cmp=lambda x, y: self._cmp(query_stems, x, y))
+            bookmarks = self._rank(query_stems, bookmarks, num=num)
         _log.debug("computed bookmarks for query '%s'" % query_key)
-        return bookmarks
+        return num_bookmarks, bookmarks
+
+    def _search_by_impact(self, query_stems, num):
+        """Return the number of matches and the num most relevant bookmarks.
+
+        Our ranking is dominated by how many of the stems a bookmark matches,
+        so we count that for every match from the stems' document IDs.  We
+        only have to load the bookmarks that match the most stems, down to the
+        group of bookmarks that straddles the num cutoff - and from that
+        group, only the candidates whose impacts say that they could make the
+        cut (see _threshold).  Then we rank the bookmarks that we loaded as
+        usual.
+
+        With only one stem, every match is in the same group, and the impacts
+        say how many matches there are.  So we don't decompress the stem's
+        document IDs at all, and only read as many impacts as it takes.  (With
+        more stems, we still decompress the document IDs to count each match's
+        stems:  that's faster than reading all of the impacts, whose document
+        IDs don't compress as well.)
+
+        If any of the stems' shards don't have impacts, return None.
+        """
+        stems_to_doc_ids, stems_to_keys, stems_to_impacts = (
+            self._query_stems_to_postings(query_stems,
+                                          decode=len(query_stems) > 1))
+        if [stem for stem in query_stems if stems_to_impacts[stem] is None]:
+            return None
+        if stems_to_doc_ids[query_stems[0]] is None:
+            num_matches = sum([postings.count_impacts(blob)
+                               for blob in stems_to_impacts[query_stems[0]]])
+            doc_ids = self._threshold(query_stems, stems_to_doc_ids,
+                                      stems_to_impacts, None, num)
+        else:
+            matched, groups, doc_ids = {}, {}, []
+            for stem in query_stems:
+                for doc_id in stems_to_doc_ids[stem]:
+                    matched[doc_id] = matched.get(doc_id, 0) + 1
+            for doc_id, num_matched in matched.items():
+                groups.setdefault(num_matched, []).append(doc_id)
+            for num_matched in sorted(groups, reverse=True):
+                need = num - len(doc_ids)
+                if need <= 0:
+                    break
+                group = groups[num_matched]
+                if len(group) > need:
+                    group = self._threshold(query_stems, stems_to_doc_ids,
+                                            stems_to_impacts, set(group), need)
+                doc_ids.extend(group)
+            num_matches = len(matched)
+        bookmark_keys = self._doc_ids_to_bookmark_keys(doc_ids).values()
+        bookmarks = [b for b in db.get(bookmark_keys) if b is not None]
+        return num_matches, self._rank(query_stems, bookmarks, num=num)
+
+    def _threshold(self, query_stems, stems_to_doc_ids, stems_to_impacts,
+                   group, need):
+        """Return candidates for the need most relevant bookmarks in a group.
+
+        Every bookmark in the group matches the same number of the stems, so
+        we rank them by their summed counts.  An impact bounds its count:
+        (impact - 1) / 255 < count <= impact / 255.  So we read each stem's
+        postings in order of descending impact, round robin, keeping track of
+        each bookmark's bounds.  A bookmark that we haven't read yet can't sum
+        to more than the impacts that we're currently reading.  Once that's
+        less than the need-th best lower bound that we've read, no unread
+        bookmark can tie or beat the need best, so we stop reading.  We return
+        every bookmark that we've read whose upper bound reaches that lower
+        bound.  If group is None, then the group is every bookmark.
+        """
+        streams, cursors, impacts = {}, {}, {}
+        for stem in query_stems:
+            blobs = stems_to_impacts[stem]
+            streams[stem] = postings.merge_impacts(
+                [postings.iter_impacts(blob) for blob in blobs])
+            cursors[stem] = 255
+        rounds, next_check, lower_bounds = 0, 1, []
+        while True:
+            reading = False
+            for stem in query_stems:
+                for impact, doc_id in streams[stem]:
+                    if group is None or doc_id in group:
+                        cursors[stem], reading = impact, True
+                        impacts.setdefault(doc_id, {})[stem] = impact
+                        break
+                else:
+                    cursors[stem] = 0
+            rounds += 1
+            if rounds == next_check or not reading:
+                # Checking is linear in the number of bookmarks read so far,
+                # so only check after 1, 2, 4, 8... rounds.
+                next_check *= 2
+                lower_bounds = heapq.nlargest(need,
+                    [sum(i.values()) - len(i) for i in impacts.values()])
+                if not reading or (len(lower_bounds) == need and
+                                   sum(cursors.values()) < lower_bounds[-1]):
+                    break
+        threshold = lower_bounds[-1] if len(lower_bounds) == need else -1
+        candidates = []
+        for doc_id, doc_impacts in impacts.items():
+            upper_bound = sum(doc_impacts.values())
+            for stem in query_stems:
+                if stem not in doc_impacts and postings.contains(
+                    stems_to_doc_ids[stem], doc_id):
+                    upper_bound += cursors[stem]
+            if upper_bound >= threshold:
+                candidates.append(doc_id)
+        _log.debug('read %s postings by impact; %s candidates for %s places' %
+                   (sum([len(i) for i in impacts.values()]), len(candidates),
+                    need))
+        return candidates
 
     def _search_bookmarks_specific(self, bookmarks, query_users=tuple(),
                                    query_words=tuple(), before=None, page=0,
@@ -171,7 +289,6 @@ class RequestHandler(webapp.RequestHandler):
 
     def _query_words_to_stems(self, query_words):
         """Convert words into stems, throwing away dupes and common words."""
-        stemmer = PorterStemmer()
         stop_words, stop_words_hash = auto_tag.read_stop_words()
         query_words = [w for w in query_words if not w in stop_words]
         query_words = list(set(query_words))
@@ -181,15 +298,138 @@ class RequestHandler(webapp.RequestHandler):
 
     def _query_stems_to_bookmark_keys(self, query_stems):
         """Convert a list of stems into a list of relevant bookmark keys."""
-        bookmark_keys = []
+        stems_to_doc_ids, stems_to_keys, stems_to_impacts = (
+            self._query_stems_to_postings(query_stems))
+        doc_ids, bookmark_keys = set(), []
         for stem in query_stems:
-            keychain_key_name = models.Keychain.key_name(stem)
-            keychain = models.Keychain.get_by_key_name(keychain_key_name)
-            if keychain is not None:
-                bookmark_keys.extend(keychain.keys)
+            doc_ids.update(stems_to_doc_ids[stem])
+            bookmark_keys.extend(stems_to_keys[stem])
+        bookmark_keys.extend(self._doc_ids_to_bookmark_keys(doc_ids).values())
         bookmark_keys = list(set(bookmark_keys))
         return bookmark_keys
 
+    def _query_stems_to_matching_postings(self, query_stems):
+        """Return the bookmarks relevant to every one of the stems.
+
+        We intersect the stems' posting lists without loading a single
+        bookmark.  Normally, that means intersecting document IDs.  But if any
+        of the stems' keychains still hold bookmark keys that haven't been
+        migrated to document IDs yet, then we map the document IDs to bookmark
+        keys (one batch get of small Document entities) and intersect bookmark
+        keys instead.
+        """
+        if not query_stems:
+            return []
+        stems_to_doc_ids, stems_to_keys, stems_to_impacts = (
+            self._query_stems_to_postings(query_stems))
+        if not [stem for stem in query_stems if stems_to_keys[stem]]:
+            posting_lists = [stems_to_doc_ids[stem] for stem in query_stems]
+        else:
+            doc_ids = set()
+            for stem in query_stems:
+                doc_ids.update(stems_to_doc_ids[stem])
+            doc_ids_to_keys = self._doc_ids_to_bookmark_keys(doc_ids)
+            posting_lists = []
+            for stem in query_stems:
+                keys = set(stems_to_keys[stem])
+                keys.update([doc_ids_to_keys[doc_id]
+                             for doc_id in stems_to_doc_ids[stem]
+                             if doc_id in doc_ids_to_keys])
+                posting_lists.append(sorted(keys))
+        return postings.intersect(*posting_lists)
+
+    def _query_stems_to_postings(self, query_stems, decode=True):
+        """Map each stem to the bookmarks in its keychain's shards.
+
+        Return three dictionaries:  one mapping each stem to a sorted list of
+        document IDs, one mapping each stem to a list of the bookmark keys in
+        keychains or shards that haven't been migrated to document IDs yet, and
+        one mapping each stem to a list of its shards' compressed impact-ordered
+        postings (or to None, if any of its shards don't have usable impacts).
+        Include the postings that we've yet to merge into the shards (see
+        models.KeychainPosting).  If decode is False, then don't decompress
+        the document IDs of stems whose impacts are usable (the impacts hold
+        the same document IDs), and map those stems to None in the first
+        dictionary instead.
+
+        No matter how many shards, this costs two datastore round trips - one
+        batch get for the keychains, and one for all of their shards - plus
+        one query per stem for its pending postings.
+        """
+        keychain_key_names = [models.Keychain.key_name(s) for s in query_stems]
+        keychains = models.Keychain.get_by_key_name(keychain_key_names)
+        stems_to_doc_ids, stems_to_keys, stems_to_impacts = {}, {}, {}
+        shard_stems, shard_key_names = [], []
+        for stem, keychain in zip(query_stems, keychains):
+            stems_to_doc_ids[stem], stems_to_keys[stem] = [], []
+            stems_to_impacts[stem] = [] if keychain is not None else None
+            if keychain is not None:
+                stems_to_keys[stem].extend(keychain.keys)
+                for shard_key_name in keychain.shard_key_names():
+                    shard_stems.append(stem)
+                    shard_key_names.append(shard_key_name)
+        shards = models.KeychainShard.get_by_key_name(shard_key_names)
+        stems_to_shards = {}
+        for stem, shard in zip(shard_stems, shards):
+            if shard is not None:
+                stems_to_shards.setdefault(stem, []).append(shard)
+                stems_to_keys[stem].extend(shard.keys)
+                if stems_to_impacts[stem] is not None:
+                    if shard.has_impacts():
+                        stems_to_impacts[stem].append(shard.impacts)
+                    else:
+                        stems_to_impacts[stem] = None
+        for stem in query_stems:
+            if stems_to_keys[stem]:
+                stems_to_impacts[stem] = None
+            pending = list(models.KeychainPosting.pending(stem))
+            usable = stems_to_impacts[stem] is not None
+            if not decode and usable and not pending:
+                stems_to_doc_ids[stem] = None
+                continue
+            for shard in stems_to_shards.get(stem, []):
+                stems_to_doc_ids[stem].extend(postings.decode(shard.doc_ids))
+            # Each shard's document IDs are already sorted, so this just
+            # merges the shards' runs.
+            stems_to_doc_ids[stem].sort()
+            self._apply_pending(stem, pending, stems_to_doc_ids,
+                                stems_to_impacts)
+        return stems_to_doc_ids, stems_to_keys, stems_to_impacts
+
+    def _apply_pending(self, stem, pending, stems_to_doc_ids,
+                       stems_to_impacts):
+        """Apply a stem's pending postings to its document IDs and impacts.
+
+        New bookmarks get impacts of their own.  But if a posting changes a
+        bookmark that's already in the shards, then the shards' impacts for it
+        are stale, so the stem's impacts aren't usable until we merge it.
+        """
+        doc_ids, added = stems_to_doc_ids[stem], []
+        for posting in pending:
+            if postings.contains(doc_ids, posting.doc_id):
+                stems_to_impacts[stem] = None
+            if posting.removed:
+                postings.remove(doc_ids, posting.doc_id)
+            else:
+                postings.add(doc_ids, posting.doc_id)
+                added.append((postings.quantize(posting.count),
+                              posting.doc_id))
+        if added and stems_to_impacts[stem] is not None:
+            stems_to_impacts[stem].append(postings.encode_impacts(added))
+
+    def _doc_ids_to_bookmark_keys(self, doc_ids):
+        """Map document IDs to bookmark keys with one batch get."""
+        doc_ids = list(doc_ids)
+        key_names = [models.Document.key_name(doc_id) for doc_id in doc_ids]
+        documents = models.Document.get_by_key_name(key_names)
+        doc_ids_to_keys = {}
+        for doc_id, document in zip(doc_ids, documents):
+            if document is not None:
+                bookmark_key = models.Document.bookmark.get_value_for_datastore(
+                    document)
+                doc_ids_to_keys[doc_id] = bookmark_key
+        return doc_ids_to_keys
+
     def _compute_cache_key(self, prefix, query_users, query_words):
         """Compute a string for a computation for use as a cache key."""
         cache_key = prefix
@@ -221,36 +461,56 @@ class RequestHandler(webapp.RequestHandler):
         bookmarks = [b for b in bookmarks if b.url in urls]
         return bookmarks
 
-    def _cmp(self, stems, x, y):
-        """Determine which bookmark is more relevant to the given stems."""
+    def _rank(self, stems, bookmarks, num=None):
+        """Sort bookmarks by relevance to the given stems, most relevant first.
+
+        Pick the bookmark relevant to more of the given stems.  If both
+        bookmarks are relevant to the same number of the given stems, then pick
+        the one more relevant to the given stems.  If both bookmarks are equally
+        relevant to the given stems, then pick the more popular one.  If both
+        bookmarks are equally popular, then pick the one updated more recently.
+        Finally, if both bookmarks are equally recent, then keep them in the
+        order that we found them.
+
+        Rather than comparing bookmarks pairwise (and recomputing the same
+        relevance over and over again), score each bookmark exactly once.  And
+        if num is specified, then we only need the num most relevant bookmarks,
+        so rather than sorting everything, keep a heap of the best num so far.
+        """
+        scores = []
+        for index, bookmark in enumerate(bookmarks):
+            score = self._score(stems, bookmark) + (-index, bookmark)
+            scores.append(score)
+        if num is None:
+            scores.sort(reverse=True)
+        else:
+            scores = heapq.nlargest(num, scores)
+        return [score[-1] for score in scores]
 
-        def get_count(stem, z):
-            """Determine a bookmark's relevance to the given stem."""
+    def _score(self, stems, bookmark):
+        """Score a bookmark's relevance to the given stems as a sortable tuple.
+
+        A query has only a few stems, so we look each one up in the bookmark's
+        stems list, rather than build a dictionary of all of its stems (which
+        only pays off for looking up all of its tags).
+
+        Example usage:
+            >>> class Bookmark(object):
+            ...     popularity, updated = 3, None
+            ...     stems, counts = ['cat', 'dog', 'pig'], [0.5, 1.0, 0.25]
+            >>> RequestHandler()._score(['cat', 'pig', 'cow'], Bookmark())
+            (2, 0.75, 3, None)
+        """
+        bookmark_stems, counts = bookmark.stems, bookmark.counts
+        matched, relevance = 0, 0
+        for stem in stems:
             try:
-                index = z.stems.index(stem)
+                index = bookmark_stems.index(stem)
             except ValueError:
-                count = 0
-            else:
-                count = z.counts[index]
-            return count
-
-        # Pick the bookmark relevant to more of the given stems.
-        x_val = len(set(stems) & set(x.stems))
-        y_val = len(set(stems) & set(y.stems))
-        if x_val == y_val:
-            # Both bookmarks are relevant to the same number of the given stems,
-            # so pick the one more relevant to the given stems.
-            x_val = sum(map(lambda stem: get_count(stem, x), stems))
-            y_val = sum(map(lambda stem: get_count(stem, y), stems))
-            if x_val == y_val:
-                # Both bookmarks are equally relevant to the given stems, so
-                # pick the more popular one.
-                x_val, y_val = x.popularity, y.popularity
-                if x_val == y_val:
-                    # Both bookmarks are equally popular, so pick the one
-                    # updated more recently.
-                    x_val, y_val = x.updated, y.updated
-        return 1 if x_val <= y_val else -1
+                continue
+            matched += 1
+            relevance += counts[index]
+        return matched, relevance, bookmark.popularity, bookmark.updated
 
     def _filter_before(self, bookmarks, before):
         """Return only the bookmarks updated before the specified date/time."""
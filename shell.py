@@ -22,6 +22,11 @@
 #------------------------------------------------------------------------------#
 """Launch an interactive Python console with access to imi-imi's datastore.
 
+By default, the console talks to the live datastore through the remote API.
+With --datastore_path, it talks to a local datastore file instead.  With
+--reindex, rather than launching a console, rebuild all of the keychains (see
+index.reindex) and exit.
+
 Some of this code was written by Nick Johnson and swiftly yoinked by Raj Shah.
 See:
     http://code.google.com/appengine/articles/remote_api.html
@@ -39,7 +44,7 @@ def main():
     """Launch a Python console able to interact with imi-imi's datastore."""
     # Parse the command-line arguments:
     parser = _config_parser()
-    app_id, host, auth_domain, email, base_dir = _parse_args(parser)
+    app_id, host, auth_domain, email, base_dir, opts = _parse_args(parser)
 
     # Set the environment variables required to authenticate in order to do
     # anything "interesting" with/to the datastore:
@@ -48,18 +53,29 @@ def main():
     # Get the necessary local Google App Engine modules:
     remote_api_stub = _import_modules(parser, base_dir)
 
-    # Connect to the remote datastore:
-    remote_api_stub.ConfigureRemoteDatastore(app_id, '/remote_api', _auth, host)
+    # Connect to the remote datastore (or to a local datastore file):
+    if opts.datastore_path is None:
+        remote_api_stub.ConfigureRemoteDatastore(app_id, '/remote_api', _auth,
+                                                 host)
+    else:
+        _configure_local_datastore(app_id, opts.datastore_path)
+    _configure_local_memcache()
 
-    # Finally, launch the interactive console:
-    code.interact('%s shell' % app_id, None, locals())
+    # Finally, launch the interactive console (or reindex):
+    if opts.reindex:
+        import index
+        index.reindex(retag=opts.retag, restart=opts.restart)
+    else:
+        code.interact('%s shell' % app_id, None, locals())
 
 
 def _config_parser():
     """Configure the command-line argument parser."""
     usage = '%prog [--host=app-id.appspot.com] [--auth_domain=gmail.com] '
     usage += '[--email=brainix@gmail.com] '
-    usage += '[--base_dir=/usr/local/google_appengine] app-id'
+    usage += '[--base_dir=/usr/local/google_appengine] '
+    usage += '[--datastore_path=/tmp/dev_appserver.datastore] '
+    usage += '[--reindex [--retag] [--restart]] app-id'
     parser = optparse.OptionParser(description=__doc__, usage=usage)
     parser.add_option('--host', dest='host', default=None,
                       help='Google App Engine app host name')
@@ -69,6 +85,14 @@ def _config_parser():
                       help='email address')
     parser.add_option('--base_dir', dest='base_dir', default=_base_dir(),
                       help='directory where Google App Engine SDK installed')
+    parser.add_option('--datastore_path', dest='datastore_path', default=None,
+                      help='local datastore file to use instead of remote one')
+    parser.add_option('--reindex', dest='reindex', action='store_true',
+                      default=False, help='rebuild keychains instead of shell')
+    parser.add_option('--retag', dest='retag', action='store_true',
+                      default=False, help='re-fetch and re-tag when reindexing')
+    parser.add_option('--restart', dest='restart', action='store_true',
+                      default=False, help="don't resume previous reindex")
     return parser
 
 
@@ -97,7 +121,9 @@ def _parse_args(parser):
     if not os.path.isdir(base_dir):
         parser.error('%s not a directory containing Google App Engine SDK' %
                      base_dir)
-    return app_id, host, auth_domain, email, base_dir
+    if (opts.retag or opts.restart) and not opts.reindex:
+        parser.error('--retag and --restart only make sense with --reindex')
+    return app_id, host, auth_domain, email, base_dir, opts
 
 
 def _import_modules(parser, base_dir):
@@ -109,7 +135,9 @@ def _import_modules(parser, base_dir):
     # Enumerate the directories containing the Google App Engine modules:
     google_app_engine_dirs = (
         base_dir,
+        os.path.join(base_dir, 'lib', 'django'),
         os.path.join(base_dir, 'lib', 'fancy_urllib'),
+        os.path.join(base_dir, 'lib', 'webob'),
         os.path.join(base_dir, 'lib', 'yaml', 'lib'),
     )
 
@@ -127,6 +155,33 @@ def _import_modules(parser, base_dir):
     return remote_api_stub
 
 
+def _configure_local_datastore(app_id, datastore_path):
+    """Point the datastore API at a local datastore file.
+
+    This is the same kind of file that the development web server uses, so we
+    can reindex a copy of the datastore without touching the live one.
+    """
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import datastore_file_stub
+    os.environ['APPLICATION_ID'] = app_id
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    stub = datastore_file_stub.DatastoreFileStub(app_id, datastore_path)
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+
+
+def _configure_local_memcache():
+    """Give the memcache API a local, in-process cache (if it has none).
+
+    The remote API only talks to the datastore, but tokenizing pages (when we
+    re-tag bookmarks) caches their words in memcache.
+    """
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api.memcache import memcache_stub
+    if apiproxy_stub_map.apiproxy.GetStub('memcache') is None:
+        stub = memcache_stub.MemcacheServiceStub()
+        apiproxy_stub_map.apiproxy.RegisterStub('memcache', stub)
+
+
 def _auth():
     """Get and return a username and password.
 
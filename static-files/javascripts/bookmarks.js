@@ -23,6 +23,9 @@
 var createBookmarkSubmitted = false;
 var moreBookmarksClicked = false;
 
+var POLL_PENDING_MILLISECONDS = 2000;
+var POLL_PENDING_MAX_TRIES = 30;
+
 
 /*----------------------------------------------------------------------------*\
  |                              initBookmarks()                               |
@@ -53,6 +56,10 @@ function initBookmarks() {
     $(".update_bookmark .submit").val("update");
     $(".delete_bookmark .submit").val("delete");
     $("#more_bookmarks .submit").val("more bookmarks");
+
+    // Some of the bookmarks may still be getting auto-tagged in the
+    // background.  Keep an eye on them.
+    pollPendingBookmarks();
 }
 
 
@@ -319,6 +326,66 @@ function addBookmarks(htmlSnippet, prepend, increment) {
             changeNumBookmarks(1);
         }
     });
+
+    // If any of the bookmarks are still getting auto-tagged in the
+    // background, then keep an eye on them.
+    pollPendingBookmarks();
+}
+
+
+/*----------------------------------------------------------------------------*\
+ |                           pollPendingBookmarks()                           |
+\*----------------------------------------------------------------------------*/
+
+function pollPendingBookmarks() {
+    // When the user saves a bookmark, we auto-tag it in the background.  In
+    // the meantime, the bookmark's HTML snippet says so.  Start polling for
+    // each such bookmark that we aren't polling for already.
+
+    $(".pending_bookmark").each(function() {
+        var pendingBookmark = $(this);
+        if (!pendingBookmark.data("polling")) {
+            pendingBookmark.data("polling", true);
+            pollPendingBookmark(pendingBookmark, 0);
+        }
+    });
+}
+
+
+/*----------------------------------------------------------------------------*\
+ |                           pollPendingBookmark()                            |
+\*----------------------------------------------------------------------------*/
+
+function pollPendingBookmark(pendingBookmark, numTries) {
+    // Every so often, ask whether we're done auto-tagging the bookmark.  Until
+    // we are, we get back nothing.  Once we are, we get back the bookmark's
+    // new HTML snippet, so swap it in for the old one.  (If it takes too long,
+    // then give up - reloading the page will show the bookmark as it is.)
+
+    if (numTries >= POLL_PENDING_MAX_TRIES) {
+        return;
+    }
+
+    setTimeout(function() {
+        $.ajax({
+            type: "POST",
+            url: "/users",
+            data: {
+                "url_to_poll": pendingBookmark.find("[name='url_to_poll']").val()
+            },
+            success: function(data, textStatus, xmlHttpRequest) {
+                if ($.trim(data) == "") {
+                    pollPendingBookmark(pendingBookmark, numTries + 1);
+                }
+                else {
+                    pendingBookmark.closest("li").replaceWith(data);
+                    preloadImagesSelector(".bookmark:hidden");
+                    $(".bookmark:hidden img.bookmark[rel]").overlay();
+                    $(".bookmark:hidden").show();
+                }
+            }
+        });
+    }, POLL_PENDING_MILLISECONDS);
 }
 
 
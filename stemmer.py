@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+#------------------------------------------------------------------------------#
+#   stemmer.py                                                                 #
+#                                                                              #
+#   Copyright (c) 2009-2010, Code A La Mode, original authors.                 #
+#                                                                              #
+#       This file is part of imi-imi.                                          #
+#                                                                              #
+#       imi-imi is free software; you can redistribute it and/or modify        #
+#       it under the terms of the GNU General Public License as published by   #
+#       the Free Software Foundation, either version 3 of the License, or      #
+#       (at your option) any later version.                                    #
+#                                                                              #
+#       imi-imi is distributed in the hope that it will be useful,             #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#       GNU General Public License for more details.                           #
+#                                                                              #
+#       You should have received a copy of the GNU General Public License      #
+#       along with imi-imi.  If not, see <http://www.gnu.org/licenses/>.       #
+#------------------------------------------------------------------------------#
+"""Memoized word stemming, shared by indexing and search.
+
+Auto-tagging a page stems every distinct word on the page, and searching stems
+every word in the query.  Stemming a word runs it through the Porter
+stemmer's whole multi-step pipeline, but word frequencies are heavily skewed:
+the same few thousand words account for most of what we stem.  So we remember
+the stems of the most recently used words (see lru.py).
+
+On a miss, we stem the word with either the Porter stemmer that we vendor from
+NLTK or our faster implementation of it (see fast_porter.py), depending on
+STEMMER_ALGORITHM.  Both produce the same stems.
+"""
+
+
+import logging
+
+import packages
+from nltk.stem.porter import PorterStemmer
+
+from config import STEMMER_ALGORITHM, STEMMER_CACHE_SIZE
+import fast_porter
+import lru
+
+
+_log = logging.getLogger(__name__)
+_ALGORITHMS = {'fast': fast_porter.PorterStemmer, 'porter': PorterStemmer}
+
+
+class Stemmer(object):
+    """A word stemmer that remembers the stems of recently stemmed words.
+
+    Example usage:
+        >>> stemmer = Stemmer(size=100)
+        >>> [stemmer.stem(word) for word in ('running', 'runs', 'running')]
+        ['run', 'run', 'run']
+        >>> stemmer.stats()
+        {'hits': 1, 'misses': 2, 'size': 2}
+    """
+
+    def __init__(self, size=STEMMER_CACHE_SIZE, algorithm=STEMMER_ALGORITHM):
+        """Initialize a cache of size words over a stemming algorithm."""
+        self._stemmer = _ALGORITHMS[algorithm]()
+        self._cache = lru.LRUCache(size)
+
+    def stem(self, word):
+        """Return a word's stem."""
+        stem = self._cache.get(word)
+        if stem is None:
+            stem = self._stemmer.stem(word)
+            self._cache[word] = stem
+        return stem
+
+    def stats(self):
+        """Return the cache's hit and miss counts and its number of words."""
+        return {'hits': self._cache.hits, 'misses': self._cache.misses,
+                'size': len(self._cache)}
+
+
+_stemmer = Stemmer()
+
+
+def stem(word):
+    """Return a word's stem, using the stemmer shared by this process."""
+    return _stemmer.stem(word)
+
+
+def stats():
+    """Return the shared stemmer's cache statistics."""
+    return _stemmer.stats()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(verbose=True)